@@ -58,15 +58,23 @@ def logginglevel(name, new_level):
         logger.setLevel(prev_level)
 
 
-def use_headless():
+def use_headless(env=None):
+    """
+    env: environment Chromium is run with, default to os.environ
+    """
+    env = os.environ if env is None else env
     log = logging.getLogger('quibble.use_headless')
-    log.info("Display: %s", os.environ.get('DISPLAY', '<None>'))
+    log.info("Display: %s", env.get('DISPLAY', '<None>'))
 
-    return not bool(os.environ.get('DISPLAY'))
+    return not bool(env.get('DISPLAY'))
 
 
-def chromium_flags():
-    args = [os.environ.get('CHROMIUM_FLAGS', '')]
+def chromium_flags(env=None):
+    """
+    env: environment Chromium is run with, default to os.environ
+    """
+    env = os.environ if env is None else env
+    args = [env.get('CHROMIUM_FLAGS', '')]
 
     # play() would fail if the user didn't interact with the document
     # first. The autoplay policy got changed with v66
@@ -79,7 +87,7 @@ def chromium_flags():
 
     if is_in_docker():
         args.append('--no-sandbox')
-    if use_headless():
+    if use_headless(env):
         args.extend(
             [
                 '--headless',
@@ -17,6 +17,7 @@ import json
 import logging
 import os
 import pwd
+import shutil
 import signal
 import socket
 import subprocess
@@ -26,6 +27,7 @@ import time
 import urllib
 
 import quibble
+import quibble.process
 
 backend_registry = {}
 
@@ -91,11 +93,15 @@ def db_backend(key):
     return backend(DatabaseServer, key)
 
 
-def getDatabase(engine, db_dir, dump_dir):
+def getDatabase(engine, db_dir, dump_dir, persistent=False):
     '''Set up a database backend, without starting it.'''
     dbclass = get_backend(DatabaseServer, engine)
     db = dbclass(base_dir=db_dir, dump_dir=dump_dir)
     db.type = engine
+    if persistent and not dbclass.can_persist:
+        db.log.warning('%s data can not be kept between runs', engine)
+    else:
+        db.persistent = persistent
     return db
 
 
@@ -105,6 +111,23 @@ def getWebserver(engine, mw_install_path, web_url):
     return backend
 
 
+def _copy_data(src, dest, exclude=()):
+    """
+    Copy the files of a data directory. The content is copied without the
+    permissions so that a read-only source yields writable files.
+    """
+    os.makedirs(dest, exist_ok=True)
+    for name in os.listdir(src):
+        if name in exclude:
+            continue
+        src_path = os.path.join(src, name)
+        dest_path = os.path.join(dest, name)
+        if os.path.isdir(src_path):
+            _copy_data(src_path, dest_path)
+        else:
+            shutil.copyfile(src_path, dest_path)
+
+
 def _stream_relay(process, stream, log_function):
     thread = threading.Thread(
         target=_stream_to_log, args=(process, stream, log_function)
@@ -125,6 +148,10 @@ class BackendServer:
 
     server = None
 
+    # Resources used and provided, see quibble.commands.execute_plan()
+    needs = ()
+    produces = ()
+
     def __init__(self):
         self.log = logging.getLogger('backend.%s' % self.__class__.__name__)
 
@@ -152,6 +179,13 @@ class BackendServer:
 class DatabaseServer(BackendServer):
 
     dump_dir = None
+    produces = ('db',)
+
+    # Whether data are kept in base_dir between runs
+    can_persist = False
+    persistent = False
+    # Whether snapshot() and restore() are supported
+    can_snapshot = False
 
     def __init__(self, base_dir=None, dump_dir=None):
         super(DatabaseServer, self).__init__()
@@ -159,6 +193,15 @@ class DatabaseServer(BackendServer):
         self.dump_dir = dump_dir
 
     def _init_rootdir(self, base_dir):
+        if self.persistent:
+            self.rootdir = os.path.join(
+                os.path.abspath(base_dir or '.'),
+                'quibble-%s' % self.__class__.__name__.lower(),
+            )
+            os.makedirs(self.rootdir, exist_ok=True)
+            self.log.debug('Persistent root dir: %s', self.rootdir)
+            return
+
         # Create a temporary data directory
         prefix = 'quibble-%s-' % self.__class__.__name__.lower()
 
@@ -184,9 +227,34 @@ class DatabaseServer(BackendServer):
             '%s does not support dumping database', self.__class__.__name__
         )
 
+    def clear(self):
+        """Drop the wiki database so MediaWiki can be installed again"""
+        pass
+
+    def snapshot(self, dest):
+        """Save the content of the running database to the dest directory"""
+        raise Exception(
+            '%s does not support snapshots' % self.__class__.__name__
+        )
+
+    def restore(self, src):
+        """Replace the content of the running database by a snapshot"""
+        raise Exception(
+            '%s does not support snapshots' % self.__class__.__name__
+        )
+
+    def snapshot_variables(self):
+        """
+        Values which differ from a run to another and might be embedded in
+        the settings generated by the MediaWiki installer.
+        """
+        return {'rootdir': self.rootdir}
+
 
 @db_backend('postgres')
 class Postgres(DatabaseServer):
+    can_snapshot = True
+
     def __init__(self, base_dir=None, dump_dir=None):
         super(Postgres, self).__init__(base_dir, dump_dir)
 
@@ -234,9 +302,54 @@ class Postgres(DatabaseServer):
         os.kill(self.hook_pid, signal.SIGUSR1)
         super(Postgres, self).stop()
 
+    def _env(self):
+        env = dict(os.environ)
+        env.update(
+            {
+                'PGHOST': self.socket,
+                'PGUSER': self.user,
+                'PGPASSWORD': self.password,
+                'PGDATABASE': self.dbname,
+            }
+        )
+        return env
+
+    def snapshot(self, dest):
+        os.makedirs(dest, exist_ok=True)
+        quibble.process.check_call(
+            [
+                'pg_dump',
+                '--format=custom',
+                '--file=%s' % os.path.join(dest, 'dump.pgdump'),
+            ],
+            env=self._env(),
+        )
+
+    def restore(self, src):
+        # The cluster and its user are new: do not restore ownership
+        quibble.process.check_call(
+            [
+                'pg_restore',
+                '--clean',
+                '--if-exists',
+                '--no-owner',
+                '--dbname=%s' % self.dbname,
+                os.path.join(src, 'dump.pgdump'),
+            ],
+            env=self._env(),
+        )
+
+    def snapshot_variables(self):
+        variables = super(Postgres, self).snapshot_variables()
+        variables.update({'user': self.user, 'password': self.password})
+        return variables
+
 
 @db_backend('mysql')
 class MySQL(DatabaseServer):
+    can_persist = True
+    can_snapshot = True
+
     def __init__(
         self,
         base_dir=None,
@@ -254,42 +367,49 @@ class MySQL(DatabaseServer):
 
     def _install_db(self):
         self.log.info('Initializing MySQL data directory')
-        p = subprocess.Popen(
-            [
-                'mysql_install_db',
-                '--datadir=%s' % self.rootdir,
-                '--user=%s' % pwd.getpwuid(os.getuid())[0],
-            ],
+        cmd = [
+            'mysql_install_db',
+            '--datadir=%s' % self.rootdir,
+            '--user=%s' % pwd.getpwuid(os.getuid())[0],
+        ]
+        p = quibble.process.run(
+            cmd,
             universal_newlines=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
-        outs, errs = p.communicate()
         if p.returncode != 0:
-            raise Exception("FAILED (%s): %s" % (p.returncode, outs))
+            raise Exception("FAILED (%s): %s" % (p.returncode, p.stdout))
 
-    def _createwikidb(self):
-        self.log.info('Creating the wiki database and grant')
-        p = subprocess.Popen(
-            [
-                'mysql',
-                '--user=root',
-                '--socket=%s' % self.socket,
-            ],
+    def _mysql(self, sql):
+        cmd = [
+            'mysql',
+            '--user=root',
+            '--socket=%s' % self.socket,
+        ]
+        p = quibble.process.run(
+            cmd,
+            input=sql,
             universal_newlines=True,
-            stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
-        grant = (
+        if p.returncode != 0:
+            raise Exception("FAILED (%s): %s" % (p.returncode, p.stdout))
+
+    def _createwikidb(self):
+        self.log.info('Creating the wiki database and grant')
+        self._mysql(
             "CREATE DATABASE IF NOT EXISTS %s;"
             "GRANT ALL ON %s.* TO '%s'@'localhost'"
             "IDENTIFIED BY '%s';\n"
             % (self.dbname, self.dbname, self.user, self.password)
         )
-        outs, errs = p.communicate(input=grant)
-        if p.returncode != 0:
-            raise Exception("FAILED (%s): %s" % (p.returncode, outs))
+
+    def clear(self):
+        self.log.info('Dropping the wiki database')
+        self._mysql("DROP DATABASE IF EXISTS %s;\n" % self.dbname)
+        self._createwikidb()
 
     def start(self):
         self.log.info('Starting MySQL')
@@ -300,8 +420,19 @@ class MySQL(DatabaseServer):
         self.socket = os.path.join(self.rootdir, 'socket')
         self.dbserver = 'localhost:' + self.socket
 
-        self._install_db()
+        if os.path.isdir(os.path.join(self.rootdir, 'mysql')):
+            self.log.info('Reusing MySQL data directory')
+            # Left behind if the server has not been shutdown properly
+            if os.path.exists(self.socket):
+                os.unlink(self.socket)
+        else:
+            self._install_db()
+
+        self._start_server()
+        self._createwikidb()
+        self.log.info('MySQL is ready')
 
+    def _start_server(self):
         self.server = subprocess.Popen(
             [
                 '/usr/sbin/mysqld',  # fixme drop path
@@ -325,25 +456,59 @@ class MySQL(DatabaseServer):
             self.log.info("Waiting for MySQL socket")
             time.sleep(1)
 
-        self._createwikidb()
-        self.log.info('MySQL is ready')
+    def _stop_server(self):
+        # Let it shutdown cleanly so the data directory is consistent
+        self.server.terminate()
+        self.server.wait()
+        self.server = None
+
+    def _runtime_files(self):
+        return [
+            os.path.basename(f)
+            for f in [self.errorlog, self.pidfile, self.socket]
+        ]
+
+    def snapshot(self, dest):
+        self.log.info('Stopping MySQL to snapshot its data directory')
+        self._stop_server()
+        try:
+            _copy_data(self.rootdir, dest, exclude=self._runtime_files())
+        finally:
+            self._start_server()
+
+    def restore(self, src):
+        self.log.info('Stopping MySQL to restore its data directory')
+        self._stop_server()
+        try:
+            for name in os.listdir(self.rootdir):
+                if name in self._runtime_files():
+                    continue
+                path = os.path.join(self.rootdir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            _copy_data(src, self.rootdir)
+        finally:
+            self._start_server()
 
     def dump(self):
         dumpfile = os.path.join(self.dump_dir, 'mysqldump.sql')
         self.log.info('Dumping database to %s', dumpfile)
 
         mysqldump = open(dumpfile, 'wb')
-        subprocess.Popen(
-            [
-                'mysqldump',
-                '--socket=%s' % self.socket,
-                '--user=root',
-                '--all-databases',
-            ],
-            stdin=subprocess.PIPE,
+        cmd = [
+            'mysqldump',
+            '--socket=%s' % self.socket,
+            '--user=root',
+            '--all-databases',
+        ]
+        quibble.process.run(
+            cmd,
+            stdin=subprocess.DEVNULL,
             stdout=mysqldump,
             stderr=subprocess.STDOUT,
-        ).wait()
+        )
 
     def __str__(self):
         return "<{} {}>".format(
@@ -354,13 +519,39 @@ class MySQL(DatabaseServer):
 
 @db_backend('sqlite')
 class SQLite(DatabaseServer):
+    can_persist = True
+    can_snapshot = True
+
     def __init__(self, base_dir=None, dump_dir=None, dbname='wikidb'):
         super(SQLite, self).__init__(base_dir, dump_dir)
 
         self.dbname = dbname
 
+    def clear(self):
+        for name in os.listdir(self.rootdir):
+            if name.endswith('.sqlite'):
+                self.log.info('Removing %s', name)
+                os.unlink(os.path.join(self.rootdir, name))
+
+    def snapshot(self, dest):
+        _copy_data(
+            self.rootdir,
+            dest,
+            exclude=[
+                name
+                for name in os.listdir(self.rootdir)
+                if not name.endswith('.sqlite')
+            ],
+        )
+
+    def restore(self, src):
+        self.clear()
+        _copy_data(src, self.rootdir)
+
 
 class ChromeWebDriver(BackendServer):
+    produces = ('display',)
+
     def __init__(self, display=None, port=4444, url_base='/wd/hub'):
         super(ChromeWebDriver, self).__init__()
 
@@ -370,39 +561,33 @@ class ChromeWebDriver(BackendServer):
 
     def start(self):
         self.log.info('Starting Chromedriver')
-        try:
-            prev_display = os.environ.get('DISPLAY', None)
-            if self.display:
-                # We need DISPLAY in the env for chromium_flags()
-                os.environ.update({'DISPLAY': self.display})
-            env = {
-                'CHROMIUM_FLAGS': quibble.chromium_flags(),
-                'PATH': os.environ.get('PATH'),
-            }
-
-            if self.display is not None:
-                # Pass it to chromedriver
-                env.update({'DISPLAY': self.display})
-
-            self.server = subprocess.Popen(
-                [
-                    'chromedriver',
-                    '--port=%s' % self.port,
-                    '--url-base=%s' % self.url_base,
-                ],
-                env=env,
-                universal_newlines=True,
-                bufsize=1,  # line buffered
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-            )
-            _stream_relay(self.server, self.server.stderr, self.log.warning)
+        # Concurrent commands share os.environ, only pass DISPLAY to
+        # chromedriver
+        display_env = dict(os.environ)
+        if self.display:
+            display_env['DISPLAY'] = self.display
+        env = {
+            'CHROMIUM_FLAGS': quibble.chromium_flags(display_env),
+            'PATH': os.environ.get('PATH'),
+        }
+
+        if self.display is not None:
+            # Pass it to chromedriver
+            env.update({'DISPLAY': self.display})
 
-        finally:
-            if prev_display:
-                os.environ.update({'DISPLAY': prev_display})
-            elif prev_display is None and self.display:
-                del os.environ['DISPLAY']
+        self.server = subprocess.Popen(
+            [
+                'chromedriver',
+                '--port=%s' % self.port,
+                '--url-base=%s' % self.url_base,
+            ],
+            env=env,
+            universal_newlines=True,
+            bufsize=1,  # line buffered
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        _stream_relay(self.server, self.server.stderr, self.log.warning)
 
     def __str__(self):
         return "<ChromeWebDriver {}>".format(self.display)
@@ -410,6 +595,8 @@ class ChromeWebDriver(BackendServer):
 
 class WebserverEngine(BackendServer):
     default_url = None
+    needs = ('workspace',)
+    produces = ('web',)
 
     def __init__(self, url=None, mwdir=None):
         super(WebserverEngine, self).__init__()
@@ -475,6 +662,8 @@ class PhpWebserver(WebserverEngine):
 
 
 class Xvfb(BackendServer):
+    produces = ('display',)
+
     def __init__(self, display=':94'):
         super(Xvfb, self).__init__()
         self.display = display
@@ -25,9 +25,17 @@ import tempfile
 
 import quibble
 import quibble.mediawiki.maintenance
+import quibble.mediawiki.registry
 import quibble.backend
 import quibble.zuul
 import quibble.commands
+import quibble.gitcache
+import quibble.history
+import quibble.impact
+import quibble.manifest
+import quibble.process
+import quibble.store
+import quibble.trace
 import quibble.util
 
 log = logging.getLogger('quibble.cmd')
@@ -67,6 +75,7 @@ class MultipleChoices(list):
 class QuibbleCmd(object):
     def __init__(self):
         self._context_stack = contextlib.ExitStack()
+        self.log_dir = None
 
     def _setup_environment(self, workspace, mw_install_path, log_dir, tmp_dir):
         """
@@ -155,6 +164,8 @@ class QuibbleCmd(object):
         log_dir = os.path.join(workspace, args.log_dir)
         if args.db_dir is not None:
             db_dir = os.path.join(workspace, args.db_dir)
+        elif args.incremental:
+            db_dir = workspace
         else:
             db_dir = None
 
@@ -164,6 +175,7 @@ class QuibbleCmd(object):
             dump_dir = None
 
         tmp_dir = tempfile.gettempdir()
+        self.log_dir = log_dir
 
         self._setup_environment(workspace, mw_install_path, log_dir, tmp_dir)
 
@@ -205,9 +217,85 @@ class QuibbleCmd(object):
         run_npm = 'npm-test' in stages
 
         database_backend = quibble.backend.getDatabase(
-            args.db, db_dir, dump_dir
+            args.db, db_dir, dump_dir, persistent=args.incremental
         )
 
+        npm_store = None
+        if args.node_modules_cache:
+            npm_store = quibble.store.TreeStore(
+                os.path.join(args.cache_dir, 'node_modules'), args.cache_size
+            )
+
+        vendor_store = None
+        if args.vendor_cache:
+            vendor_store = quibble.store.TreeStore(
+                os.path.join(args.cache_dir, 'vendor'), args.cache_size
+            )
+
+        snapshot_store = None
+        if args.db_snapshot:
+            snapshot_store = quibble.store.TreeStore(
+                os.path.join(args.cache_dir, 'db'), args.cache_size
+            )
+
+        history = None
+        if args.phpunit_history or args.failed_first:
+            history = quibble.history.History(
+                args.cache_dir, args.cache_size, project=zuul_project
+            )
+        phpunit_history = history if args.phpunit_history else None
+
+        test_order = None
+        if args.failed_first:
+            test_order = quibble.history.TestOrder(
+                history,
+                (
+                    os.path.join(mw_install_path, repo_path)
+                    if is_extension or is_skin
+                    else None
+                ),
+            )
+
+        impact_index = None
+        if (
+            args.phpunit_affected_first
+            or args.phpunit_affected_only
+            or args.phpunit_coverage_index
+        ):
+            impact_index = quibble.impact.ImpactIndex(args.cache_dir)
+
+        phpunit_impact = None
+        if args.phpunit_affected_first or args.phpunit_affected_only:
+            phpunit_impact = quibble.impact.Impact(
+                impact_index,
+                mw_install_path,
+                repo_path,
+                only=args.phpunit_affected_only,
+            )
+
+        coverage_index = None
+        if args.phpunit_coverage_index:
+            coverage_index = impact_index
+
+        requires_cache = None
+        if args.requires_cache:
+            requires_cache = quibble.mediawiki.registry.RequiresCache(
+                args.cache_dir
+            )
+
+        if args.incremental:
+            manifest = quibble.manifest.Manifest(mw_install_path)
+
+            def incremental(command, **kwargs):
+                return quibble.commands.Incremental(
+                    command, manifest, **kwargs
+                )
+
+        else:
+
+            def incremental(command, **kwargs):
+                return command
+
         web_backend = quibble.backend.getWebserver(
             args.web_backend, mw_install_path, args.web_url
         )
@@ -221,19 +309,27 @@ class QuibbleCmd(object):
             zuul_params = {
                 'branch': args.branch,
                 'cache_dir': args.git_cache,
+                'cache_shared': args.git_cache_shared,
                 'project_branch': args.project_branch,
                 'workers': args.git_parallel,
+                'checkout_workers': args.git_checkout_parallel,
                 'workspace': os.path.join(workspace, 'src'),
                 'zuul_branch': os.getenv('ZUUL_BRANCH'),
                 'zuul_newrev': os.getenv('ZUUL_NEWREV'),
                 'zuul_project': os.getenv('ZUUL_PROJECT'),
                 'zuul_ref': os.getenv('ZUUL_REF'),
                 'zuul_url': os.getenv('ZUUL_URL'),
+                'minimal_fetch': args.git_minimal_fetch,
+                'clone_depth': args.clone_depth,
+                'clone_filter': args.clone_filter,
             }
 
             plan.append(
-                quibble.commands.ZuulClone(
-                    projects=dependencies, **zuul_params
+                incremental(
+                    quibble.commands.ZuulClone(
+                        projects=dependencies, **zuul_params
+                    ),
+                    resets_workspace=True,
                 )
             )
 
@@ -244,11 +340,16 @@ class QuibbleCmd(object):
                         projects=dependencies,
                         zuul_params=zuul_params,
                         fail_on_extra_requires=args.fail_on_extra_requires,
+                        requires_cache=requires_cache,
                     )
                 )
 
             plan.append(
-                quibble.commands.ExtSkinSubmoduleUpdate(mw_install_path)
+                quibble.commands.ExtSkinSubmoduleUpdate(
+                    mw_install_path,
+                    workers=args.git_parallel,
+                    cache_dir=args.git_cache,
+                )
             )
 
         if is_extension or is_skin:
@@ -257,7 +358,7 @@ class QuibbleCmd(object):
 
                 plan.append(
                     quibble.commands.ExtSkinComposerNpmTest(
-                        project_dir, run_composer, run_npm
+                        project_dir, run_composer, run_npm, npm_store
                     )
                 )
 
@@ -276,15 +377,24 @@ class QuibbleCmd(object):
             # takes a while and the phpunit-unit phase below may fail.
             if use_vendor:
                 plan.append(
-                    quibble.commands.VendorComposerDependencies(
-                        mw_install_path, log_dir
+                    incremental(
+                        quibble.commands.VendorComposerDependencies(
+                            mw_install_path, log_dir, vendor_store
+                        )
                     )
                 )
 
         # phpunit-unit does not need the database populated or
         # LocalSettings.php in order to run.
         if 'phpunit-unit' in stages:
-            plan.append(quibble.commands.PhpUnitUnit(mw_install_path, log_dir))
+            plan.append(
+                quibble.commands.PhpUnitUnit(
+                    mw_install_path,
+                    log_dir,
+                    phpunit_history,
+                    stop_on_failure=args.phpunit_stop_on_failure,
+                )
+            )
 
         if not args.skip_install:
             plan.append(
@@ -294,18 +404,25 @@ class QuibbleCmd(object):
             )
 
             plan.append(
-                quibble.commands.InstallMediaWiki(
-                    mw_install_path=mw_install_path,
-                    db=database_backend,
-                    web_url=web_backend.url,
-                    log_dir=log_dir,
-                    tmp_dir=tmp_dir,
-                    use_vendor=use_vendor,
+                incremental(
+                    quibble.commands.InstallMediaWiki(
+                        mw_install_path=mw_install_path,
+                        db=database_backend,
+                        web_url=web_backend.url,
+                        log_dir=log_dir,
+                        tmp_dir=tmp_dir,
+                        use_vendor=use_vendor,
+                        snapshot_store=snapshot_store,
+                    )
                 )
             )
 
         if not args.skip_deps:
-            plan.append(quibble.commands.NpmInstall(mw_install_path))
+            plan.append(
+                incremental(
+                    quibble.commands.NpmInstall(mw_install_path, npm_store)
+                )
+            )
 
         phpunit_testsuite = None
         if args.phpunit_testsuite:
@@ -318,7 +435,15 @@ class QuibbleCmd(object):
         if 'phpunit' in stages:
             plan.append(
                 quibble.commands.PhpUnitDatabaseless(
-                    mw_install_path, phpunit_testsuite, log_dir
+                    mw_install_path,
+                    phpunit_testsuite,
+                    log_dir,
+                    args.phpunit_parallel,
+                    phpunit_history,
+                    phpunit_impact,
+                    coverage_index,
+                    test_order=test_order,
+                    stop_on_failure=args.phpunit_stop_on_failure,
                 )
             )
 
@@ -366,6 +491,8 @@ class QuibbleCmd(object):
                     dependencies_with_project_first,
                     display,
                     web_backend.url,
+                    npm_store,
+                    test_order=test_order,
                 )
             )
 
@@ -375,13 +502,21 @@ class QuibbleCmd(object):
                     mw_install_path,
                     dependencies_with_project_first,
                     web_backend.url,
+                    npm_store,
                 )
             )
 
         if 'phpunit' in stages:
             plan.append(
                 quibble.commands.PhpUnitDatabase(
-                    mw_install_path, phpunit_testsuite, log_dir
+                    mw_install_path,
+                    phpunit_testsuite,
+                    log_dir,
+                    phpunit_history,
+                    phpunit_impact,
+                    coverage_index,
+                    test_order=test_order,
+                    stop_on_failure=args.phpunit_stop_on_failure,
                 )
             )
 
@@ -392,17 +527,43 @@ class QuibbleCmd(object):
 
         return plan
 
-    def execute(self, plan, dry_run=False):
+    def execute(self, plan, dry_run=False, workers=1):
         log.debug("Execution plan:")
-        for cmd in plan:
-            log.debug(cmd)
+        if workers > 1:
+            dependencies = quibble.commands.plan_dependencies(plan)
+            for index, cmd in enumerate(plan):
+                log.debug(
+                    '%s. %s (after: %s)',
+                    index,
+                    cmd,
+                    ', '.join(str(d) for d in sorted(dependencies[index]))
+                    or '-',
+                )
+        else:
+            for cmd in plan:
+                log.debug(cmd)
         if dry_run:
             log.warning("Exiting without execution: --dry-run")
             return
 
-        with self._context_stack:
-            for command in plan:
-                quibble.commands.execute_command(command)
+        quibble.trace.start()
+        quibble.process.reset_stages()
+        try:
+            with self._context_stack:
+                quibble.commands.execute_plan(plan, workers=workers)
+        finally:
+            self._write_reports()
+
+    def _write_reports(self):
+        # The log directory is created by the plan, we might have failed
+        # before reaching that point.
+        if self.log_dir is None or not os.path.isdir(self.log_dir):
+            quibble.trace.stop()
+            return
+        quibble.trace.stop(os.path.join(self.log_dir, 'trace.json'))
+        quibble.process.write_usage(
+            os.path.join(self.log_dir, 'resources.json')
+        )
 
 
 def _parse_arguments(args):
@@ -443,12 +604,28 @@ def get_arg_parser():
         'Can be used to enforce extensions and skins to declare '
         'their requirements via the extension registry.',
     )
+    parser.add_argument(
+        '--requires-cache',
+        action='store_true',
+        help='With --resolve-requires, keep the requirements read from '
+        '--git-cache in --cache-dir. They are keyed on the blob of '
+        'extension.json/skin.json and only read again when it changes.',
+    )
     parser.add_argument(
         '--skip-deps', action='store_true', help='Do not run composer/npm'
     )
     parser.add_argument(
         '--skip-install', action='store_true', help='Do not install MediaWiki'
     )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Reuse the results of a previous run in the same workspace. '
+        'Skips cloning, installing dependencies and installing MediaWiki '
+        'when their inputs did not change. The database is kept in a '
+        '"quibble-" sub directory of --db-dir (default: the workspace), '
+        'postgres does not support it.',
+    )
     parser.add_argument(
         '--db',
         choices=['sqlite', 'mysql', 'postgres'],
@@ -461,7 +638,7 @@ def get_arg_parser():
         help=(
             'Base directory holding database files. A sub directory '
             'prefixed with "quibble-" will be created and deleted '
-            'on completion. '
+            'on completion (kept with --incremental). '
             'If set and relative, relatively to workspace. '
             'Default: %s' % tempfile.gettempdir()
         ),
@@ -478,11 +655,95 @@ def get_arg_parser():
         'operation. Passed to zuul-cloner as --cache-dir. '
         'In Docker: "/srv/git", else "ref"',
     )
+    parser.add_argument(
+        '--git-cache-shared',
+        action='store_true',
+        help='Clone from --git-cache with "git clone --shared": the objects '
+        'of the cache are used in place (git alternates) and only new '
+        'objects are written to the workspace. The workspace depends on the '
+        'cache for as long as it exists: "quibble cache update" never '
+        'deletes objects, the cache must not be garbage collected or pruned '
+        'by other means while workspaces sharing it are in use.',
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=quibble.store.default_cache_dir(),
+        help='Directory holding caches reused between runs. '
+        'Default: $XDG_CACHE_HOME/quibble or ~/.cache/quibble',
+    )
+    parser.add_argument(
+        '--cache-size',
+        default='5G',
+        type=quibble.store.parse_size,
+        metavar='SIZE',
+        help='Size budget of each cache in --cache-dir, such as 500M or 5G, '
+        'least recently used entries are evicted. Default: 5G',
+    )
+    parser.add_argument(
+        '--node-modules-cache',
+        action='store_true',
+        help='Restore node_modules from the cache when package-lock.json '
+        'and node/npm versions are the same as a previous npm install',
+    )
+    parser.add_argument(
+        '--vendor-cache',
+        action='store_true',
+        help='With mediawiki/vendor, restore the composer dev dependencies '
+        'from the cache when require-dev, the vendor commit and the composer '
+        'version are the same as a previous run',
+    )
+    parser.add_argument(
+        '--db-snapshot',
+        action='store_true',
+        help='Restore the database from the cache instead of running the '
+        'MediaWiki installer when core, the set of extensions and skins, '
+        'the database backend and the settings template are the same as a '
+        'previous run. update.php is still run.',
+    )
     parser.add_argument(
         '--git-parallel',
         default=4,
         type=int,
-        help='Number of workers to clone repositories. Default: 4',
+        help='Number of workers to clone repositories, also the number of '
+        'git submodules cloned at once. Default: 4',
+    )
+    parser.add_argument(
+        '--git-checkout-parallel',
+        type=int,
+        metavar='N',
+        help='Number of repositories to check out concurrently, once they '
+        'have been fetched by the --git-parallel workers. '
+        'Default: same as --git-parallel',
+    )
+    parser.add_argument(
+        '--git-minimal-fetch',
+        action='store_true',
+        help='Only fetch the branches and Zuul refs that might be checked '
+        'out, without tags, instead of every branches and tags',
+    )
+    parser.add_argument(
+        '--clone-depth',
+        type=int,
+        metavar='N',
+        help='Shallow clone the repositories with a history truncated to N '
+        'commits. Does not apply to the project being tested (ZUUL_PROJECT) '
+        'which keeps its full history.',
+    )
+    parser.add_argument(
+        '--clone-filter',
+        metavar='FILTER',
+        help='Partially clone the repositories with the given git filter, '
+        'eg "blob:none" to fetch file contents when they are checked out. '
+        'Does not apply to the project being tested (ZUUL_PROJECT).',
+    )
+    parser.add_argument(
+        '--parallel-steps',
+        default=1,
+        type=int,
+        metavar='N',
+        help='Number of commands of the execution plan to run concurrently. '
+        'A command starts once the commands it depends on have completed. '
+        'Default: 1 (one after the other)',
     )
     parser.add_argument(
         '--branch',
@@ -623,6 +884,56 @@ def get_arg_parser():
         metavar='pattern',
         help='PHPUnit: filter which testsuite to run',
     )
+    parser.add_argument(
+        '--phpunit-parallel',
+        default=1,
+        type=int,
+        metavar='N',
+        help='PHPUnit: split the tests without database in N shards run '
+        'concurrently. Default: 1',
+    )
+    parser.add_argument(
+        '--phpunit-history',
+        action='store_true',
+        help='PHPUnit: record the duration of test classes in --cache-dir and '
+        'use them to balance the --phpunit-parallel shards. The list of '
+        'tests is cached as well.',
+    )
+    parser.add_argument(
+        '--phpunit-coverage-index',
+        action='store_true',
+        help='PHPUnit: run with --coverage-xml and record in --cache-dir '
+        'which test classes cover each file. Requires a code coverage '
+        'driver such as pcov or xdebug, meant for periodic jobs.',
+    )
+    parser.add_argument(
+        '--phpunit-affected-first',
+        action='store_true',
+        help='PHPUnit: first run the test classes covering the files changed '
+        'by the patch under test, as recorded by --phpunit-coverage-index, '
+        'then the other ones.',
+    )
+    parser.add_argument(
+        '--phpunit-affected-only',
+        action='store_true',
+        help='PHPUnit: like --phpunit-affected-first but skip the other '
+        'test classes. Every tests are run when a changed file is not '
+        'covered by known tests. Not meant for gating.',
+    )
+    parser.add_argument(
+        '--phpunit-stop-on-failure',
+        action='store_true',
+        help='PHPUnit: stop at the first failure instead of running the '
+        'remaining tests.',
+    )
+    parser.add_argument(
+        '--failed-first',
+        action='store_true',
+        help='Remember in --cache-dir the PHPUnit test classes and browser '
+        'tests which failed for the project under test and run them first, '
+        'followed by the PHPUnit tests of the extension or skin under test. '
+        'Combine with --phpunit-stop-on-failure to get failures early.',
+    )
 
     return parser
 
@@ -631,6 +942,12 @@ def main():
     logging.basicConfig(level=logging.INFO)
     logging.getLogger('quibble').setLevel(logging.DEBUG)
 
+    # Sub commands are dispatched by hand since the main command accepts a
+    # list of projects as positional arguments.
+    if sys.argv[1:2] == ['cache']:
+        quibble.gitcache.main(sys.argv[2:])
+        return
+
     args = _parse_arguments(sys.argv[1:])
 
     if args.color:
@@ -639,7 +956,7 @@ def main():
     cmd = QuibbleCmd()
     plan = cmd.build_execution_plan(args)
 
-    cmd.execute(plan, dry_run=args.dry_run)
+    cmd.execute(plan, dry_run=args.dry_run, workers=args.parallel_steps)
 
 
 if __name__ == '__main__':
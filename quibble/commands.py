@@ -1,14 +1,26 @@
 """Encapsulates each step of a job"""
 
 import contextlib
+import hashlib
 import json
 import logging
 import os
 import os.path
 import pkg_resources
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from quibble.gitchangedinhead import GitChangedInHead
 from quibble.util import copylog, parallel_run, isExtOrSkin
+import quibble.gitcache
+import quibble.history
+import quibble.manifest
 import quibble.mediawiki.registry
+import quibble.phpunit
+import quibble.process
+import quibble.trace
 import quibble.zuul
 import subprocess
 import sys
@@ -19,21 +31,209 @@ log = logging.getLogger(__name__)
 def execute_command(command):
     '''Shared decorator for execution'''
     with quibble.Chronometer(str(command), log.info):
-        command.execute()
+        with quibble.trace.span(str(command), 'command'):
+            with quibble.process.stage(str(command)) as stage:
+                command.execute()
+        if stage.processes:
+            log.info('Resources used: %s', stage.usage)
+
+
+# Commands declare the resources they need to run and the resources they
+# produce or alter, which let the plan run independent commands concurrently:
+#
+# workspace: the cloned repositories
+# deps:      PHP dependencies (vendor, composer.local.json)
+# npm:       node_modules
+# db:        a running database holding the installed MediaWiki
+# web:       a web server serving MediaWiki
+# display:   a X display and the browser driver
+# logs:      the log directory
+#
+# A command lacking a declaration acts as a barrier: it waits for every
+# previous command and every later command waits for it.
+def _declares_resources(command):
+    return hasattr(command, 'needs') and hasattr(command, 'produces')
+
+
+def _depends_on(command, previous):
+    if not (_declares_resources(command) and _declares_resources(previous)):
+        return True
+
+    needs = set(command.needs)
+    produces = set(command.produces)
+    return bool(
+        needs & set(previous.produces)
+        or produces & set(previous.needs)
+        or produces & set(previous.produces)
+    )
+
+
+def plan_dependencies(plan):
+    """
+    For each command of the plan, the set of indexes of earlier commands it
+    has to wait for.
+    """
+    return [
+        {
+            index
+            for (index, previous) in enumerate(plan[:position])
+            if _depends_on(command, previous)
+        }
+        for (position, command) in enumerate(plan)
+    ]
+
 
+def execute_plan(plan, workers=1):
+    """
+    Execute each command of the plan.
+
+    With a single worker, the commands are run one after the other following
+    the plan order. Otherwise up to `workers` commands are run concurrently,
+    each one being started once the commands it depends on have completed.
 
-def _npm_install(project_dir):
+    On failure, no more commands are started and the first exception is
+    raised once the running commands have completed.
+    """
+    if workers <= 1:
+        for command in plan:
+            execute_command(command)
+        return
+
+    dependencies = plan_dependencies(plan)
+    pending = list(range(len(plan)))
+    completed = set()
+    running = {}
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while running or (pending and failure is None):
+            if failure is None:
+                for index in list(pending):
+                    if len(running) >= workers:
+                        break
+                    if dependencies[index] <= completed:
+                        pending.remove(index)
+                        future = executor.submit(execute_command, plan[index])
+                        running[future] = index
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    log.error('Failed: %s', plan[index])
+                    if failure is None:
+                        failure = e
+                else:
+                    completed.add(index)
+
+    if failure is not None:
+        if pending:
+            log.warning(
+                'Not running: %s', ', '.join(str(plan[i]) for i in pending)
+            )
+        raise failure
+
+
+def _node_modules_key(project_dir):
+    key = hashlib.sha256()
+    with open(os.path.join(project_dir, 'package-lock.json'), 'rb') as f:
+        key.update(f.read())
+    for tool in ['node', 'npm']:
+        key.update(quibble.process.check_output([tool, '--version']))
+    return key.hexdigest()
+
+
+def _npm_install(project_dir, store=None):
+    """
+    store: a quibble.store.TreeStore of node_modules directories. Only used
+    when there is a package-lock.json.
+    """
     if _repo_has_npm_lock(project_dir):
-        subprocess.check_call(['npm', 'ci'], cwd=project_dir)
+        node_modules = os.path.join(project_dir, 'node_modules')
+        key = None
+        if store is not None:
+            key = _node_modules_key(project_dir)
+            # Install scripts and tools write in node_modules
+            if store.get(key, node_modules, link=False):
+                return
+
+        quibble.process.check_call(['npm', 'ci'], cwd=project_dir)
+
+        if key is not None:
+            store.put(key, node_modules)
     else:
-        subprocess.check_call(['npm', 'prune'], cwd=project_dir)
-        subprocess.check_call(
+        quibble.process.check_call(['npm', 'prune'], cwd=project_dir)
+        quibble.process.check_call(
             ['npm', 'install', '--no-progress', '--prefer-offline'],
             cwd=project_dir,
         )
 
 
+class Incremental:
+    """
+    Skip a command when its inputs are the same as when it last completed.
+
+    The command has to provide inputs() returning a JSON serializable value
+    describing what it depends upon, or None when it can not be skipped, and
+    outputs() listing paths it creates. It may provide clear() to remove
+    stale outputs before it is run again.
+    """
+
+    def __init__(self, command, manifest, resets_workspace=False):
+        """
+        command: the command to run unless unchanged
+        manifest: a quibble.manifest.Manifest
+        resets_workspace: whether the command wipes the outputs of every other
+        commands, the manifest is then cleared before running it.
+        """
+        self.command = command
+        self.manifest = manifest
+        self.resets_workspace = resets_workspace
+
+    @property
+    def needs(self):
+        return self.command.needs
+
+    @property
+    def produces(self):
+        return self.command.produces
+
+    def _step(self):
+        return self.command.__class__.__name__
+
+    def execute(self):
+        inputs = self.command.inputs()
+        if (
+            inputs is not None
+            and self.manifest.unchanged(self._step(), inputs)
+            and all(os.path.exists(p) for p in self.command.outputs())
+        ):
+            log.info('Inputs unchanged, skipping: %s', self.command)
+            return
+
+        if self.resets_workspace:
+            self.manifest.forget()
+        else:
+            self.manifest.forget(self._step())
+            if hasattr(self.command, 'clear'):
+                self.command.clear()
+
+        self.command.execute()
+
+        inputs = self.command.inputs()
+        if inputs is not None:
+            self.manifest.record(self._step(), inputs)
+
+    def __str__(self):
+        return str(self.command)
+
+
 class ReportVersions:
+    needs = ()
+    produces = ()
+
     def execute(self):
         log.info("Python version: %s", sys.version)
 
@@ -53,7 +253,7 @@ class ReportVersions:
 
     def _logged_call(self, cmd):
         try:
-            res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+            res = quibble.process.check_output(cmd, stderr=subprocess.STDOUT)
             message = '{}: {}'.format(
                 ' '.join(cmd), res.strip().decode('utf-8')
             )
@@ -69,6 +269,9 @@ class ReportVersions:
 
 
 class ZuulClone:
+    needs = ()
+    produces = ('workspace',)
+
     def __init__(
         self,
         branch,
@@ -82,6 +285,11 @@ class ZuulClone:
         zuul_project,
         zuul_ref,
         zuul_url,
+        minimal_fetch=False,
+        clone_depth=None,
+        clone_filter=None,
+        cache_shared=False,
+        checkout_workers=None,
     ):
         self.branch = branch
         self.cache_dir = cache_dir
@@ -94,6 +302,11 @@ class ZuulClone:
         self.zuul_project = zuul_project
         self.zuul_ref = zuul_ref
         self.zuul_url = zuul_url
+        self.minimal_fetch = minimal_fetch
+        self.clone_depth = clone_depth
+        self.clone_filter = clone_filter
+        self.cache_shared = cache_shared
+        self.checkout_workers = checkout_workers
 
     def execute(self):
         quibble.zuul.clone(
@@ -108,11 +321,39 @@ class ZuulClone:
             self.zuul_project,
             self.zuul_ref,
             self.zuul_url,
+            minimal_fetch=self.minimal_fetch,
+            clone_depth=self.clone_depth,
+            clone_filter=self.clone_filter,
+            cache_shared=self.cache_shared,
+            checkout_workers=self.checkout_workers,
         )
 
+    def _project_dirs(self):
+        return [
+            os.path.join(self.workspace, quibble.zuul.repo_dir(project))
+            for project in sorted(self.projects)
+        ]
+
+    def inputs(self):
+        # Parameters having no effect on the repositories checked out
+        ignored = ('cache_dir', 'cache_shared', 'checkout_workers', 'workers')
+        params = {k: v for k, v in self.__dict__.items() if k not in ignored}
+        params['projects'] = sorted(self.projects)
+        return {
+            'parameters': params,
+            'heads': [
+                quibble.manifest.git_head(d) for d in self._project_dirs()
+            ],
+        }
+
+    def outputs(self):
+        return self._project_dirs()
+
     def __str__(self):
         pruned_params = {
-            k: v for k, v in self.__dict__.items() if v is not None and v != []
+            k: v
+            for k, v in self.__dict__.items()
+            if v is not None and v is not False and v != []
         }
         return "Zuul clone with parameters {}".format(
             json.dumps(pruned_params, sort_keys=True)
@@ -120,12 +361,16 @@ class ZuulClone:
 
 
 class ResolveRequires:
+    needs = ('workspace',)
+    produces = ('workspace',)
+
     def __init__(
         self,
         mw_install_path,
         projects,
         zuul_params,
         fail_on_extra_requires=False,
+        requires_cache=None,
     ):
         """
         mw_install_path: root dir of MediaWiki
@@ -133,6 +378,8 @@ class ResolveRequires:
         zuul_params: other parameters for ZuulClone
         fail_on_extra_requires: if any repositories has been cloned and has
         not been given in the initial list of projects, raise an exception.
+        requires_cache: quibble.mediawiki.registry.RequiresCache holding the
+        requirements already read from the git cache.
         """
         self.mw_install_path = mw_install_path
         self.projects = projects
@@ -140,11 +387,11 @@ class ResolveRequires:
         if 'projects' in self.zuul_params:
             del self.zuul_params['projects']
         self.fail_on_extra_requires = fail_on_extra_requires
+        self.requires_cache = requires_cache
 
     def execute(self):
         ext_cloned = set(filter(isExtOrSkin, self.projects))
-        with quibble.logginglevel('zuul.CloneMapper', logging.WARNING):
-            required = self._clone_requires(ext_cloned, ext_cloned)
+        required = self._clone_requires(ext_cloned)
         extras = set(required) - set(self.projects)
 
         msg = 'Found extra requirements: %s' % ', '.join(extras)
@@ -153,16 +400,46 @@ class ResolveRequires:
         else:
             log.warning(msg)
 
-    def _clone_requires(self, new_projects, cloned):
-        to_be_cloned = new_projects - cloned
-        if to_be_cloned:
-            log.info('Cloning: %s', ', '.join(to_be_cloned))
-            execute_command(
-                ZuulClone(projects=to_be_cloned, **self.zuul_params)
-            )
+    def _branch(self, project):
+        """Branch the cloner would look for"""
+        for project_branch in self.zuul_params.get('project_branch') or []:
+            name, branch = project_branch[0].split('=')
+            if name == project:
+                return branch
+        return (
+            self.zuul_params.get('branch')
+            or self.zuul_params.get('zuul_branch')
+            or 'master'
+        )
+
+    def _cached_requires(self, projects):
+        """
+        Requirements of projects read from the git cache. Projects which can
+        not be found there are omitted.
+        """
+        cache_dir = self.zuul_params.get('cache_dir')
+        if not cache_dir:
+            return {}
+
+        repos = {}
+        for project in projects:
+            repo = quibble.gitcache.cache_path(cache_dir, project)
+            if repo is None:
+                continue
+            revs = []
+            for branch in [self._branch(project), 'master']:
+                for rev in [branch, 'origin/' + branch]:
+                    if rev not in revs:
+                        revs.append(rev)
+            repos[project] = (repo, revs)
+
+        return quibble.mediawiki.registry.requires_from_git(
+            repos, self.requires_cache
+        )
 
+    def _requires_on_disk(self, projects):
         found = set()
-        for project in sorted(new_projects):
+        for project in sorted(projects):
             log.info('Looking for requirements of %s', project)
 
             project_dir = os.path.join(
@@ -170,16 +447,52 @@ class ResolveRequires:
             )
             deps = quibble.mediawiki.registry.from_path(project_dir)
             found.update(deps.getRequiredRepos())
+        return found
 
-        if not found:
-            log.debug(
-                'No additional requirements from %s', ', '.join(new_projects)
+    def _cached_closure(self, projects, known):
+        """
+        Projects and recursively their requirements found in the git cache,
+        ignoring the known ones.
+        """
+        closure = set(projects)
+        to_inspect = set(projects)
+        while to_inspect:
+            cached = self._cached_requires(to_inspect)
+            new = set()
+            for project in sorted(to_inspect):
+                if project in cached:
+                    new.update(cached[project])
+                else:
+                    log.debug('Requirements of %s not in the cache', project)
+            to_inspect = new - closure - known
+            closure.update(to_inspect)
+        return closure
+
+    def _clone_requires(self, projects):
+        """
+        Clone the requirements of projects recursively.
+
+        Requirements of requirements are looked up in the git cache to clone
+        them all at once. Cloned repositories are then inspected since they
+        might differ from the cache.
+
+        Returns all the requirements found.
+        """
+        cloned = set(projects)
+        required = self._requires_on_disk(projects)
+        to_be_cloned = self._cached_closure(required - cloned, cloned)
+        while to_be_cloned:
+            log.info('Cloning: %s', ', '.join(sorted(to_be_cloned)))
+            execute_command(
+                ZuulClone(projects=to_be_cloned, **self.zuul_params)
             )
-            return set()
+            cloned.update(to_be_cloned)
 
-        if found:
-            log.info('Found requirement(s): %s', ', '.join(found))
-            return found.union(self._clone_requires(found, cloned))
+            found = self._requires_on_disk(to_be_cloned)
+            required.update(found)
+            to_be_cloned = self._cached_closure(found - cloned, cloned)
+
+        return required
 
     def __str__(self):
         return (
@@ -189,39 +502,132 @@ class ResolveRequires:
 
 
 class ExtSkinSubmoduleUpdate:
-    def __init__(self, mw_install_path):
+    needs = ('workspace',)
+    produces = ('workspace',)
+
+    def __init__(self, mw_install_path, workers=1, cache_dir=None):
+        """
+        mw_install_path: root dir of MediaWiki
+        workers: number of git processes cloning submodules at once. It is
+        divided between the repositories updated concurrently and the
+        `git submodule update --jobs` of each of them.
+        cache_dir: git cache to clone submodules from when it has them
+        """
         self.mw_install_path = mw_install_path
+        self.workers = workers
+        self.cache_dir = cache_dir
 
     def execute(self):
         log.info('Updating git submodules of extensions and skins')
 
-        cmds = [
-            ['git', 'submodule', 'foreach', 'git', 'clean', '-xdff', '-q'],
-            ['git', 'submodule', 'update', '--init', '--recursive'],
-            ['git', 'submodule', 'status'],
-        ]
-
         tops = [
             os.path.join(self.mw_install_path, top)
             for top in ['extensions', 'skins']
         ]
 
+        repos = []
         for top in tops:
             for dirpath, dirnames, filenames in os.walk(top):
                 if dirpath not in tops:
                     # Only look at the first level
                     dirnames[:] = []
-                if '.gitmodules' not in filenames:
-                    continue
+                if '.gitmodules' in filenames:
+                    repos.append(dirpath)
+
+        # Submodules are mostly cloned from the network, update several
+        # repositories at once. Each one runs up to `jobs` clones, keep the
+        # total within the number of workers.
+        concurrent = max(1, min(self.workers, len(repos)))
+        jobs = max(1, self.workers // concurrent)
+        parallel_run(
+            [(self._update_submodules, repo, jobs) for repo in repos],
+            workers=concurrent,
+            tags=[
+                os.path.relpath(repo, self.mw_install_path) for repo in repos
+            ],
+        )
 
-                for cmd in cmds:
-                    try:
-                        subprocess.check_call(cmd, cwd=dirpath)
-                    except subprocess.CalledProcessError as e:
-                        log.error(
-                            "Failed to process git submodules for %s", dirpath
-                        )
-                        raise e
+    def _cached_submodules(self, dirpath):
+        """Submodule urls of a repository to the git cache repositories"""
+        cached = {}
+        if not self.cache_dir:
+            return cached
+        for url in quibble.gitcache.submodule_urls(dirpath):
+            project = quibble.gitcache.url_project(url)
+            if project is None:
+                continue
+            repo = quibble.gitcache.cache_path(self.cache_dir, project)
+            if repo is not None:
+                cached[url] = os.path.abspath(repo)
+        return cached
+
+    def _update_submodules(self, dirpath, jobs=1):
+        update = [
+            'submodule',
+            'update',
+            '--init',
+            '--recursive',
+            '--jobs',
+            str(jobs),
+        ]
+        cached = self._cached_submodules(dirpath)
+
+        start = time.monotonic()
+        try:
+            quibble.process.check_call(
+                ['git', 'submodule', 'foreach', 'git', 'clean', '-xdff', '-q'],
+                cwd=dirpath,
+            )
+            if cached:
+                self._update_from_cache(dirpath, update, cached)
+            else:
+                quibble.process.check_call(['git'] + update, cwd=dirpath)
+            quibble.process.check_call(
+                ['git', 'submodule', 'status'], cwd=dirpath
+            )
+        except subprocess.CalledProcessError as e:
+            log.error("Failed to process git submodules for %s", dirpath)
+            raise e
+        log.info(
+            'Updated git submodules of %s in %.1fs',
+            dirpath,
+            time.monotonic() - start,
+        )
+
+    def _update_from_cache(self, dirpath, update, cached):
+        """
+        Fetch submodules from the git cache instead of their upstream. The
+        upstream urls are kept as the submodules remotes.
+
+        Objects are copied: unlike --git-cache-shared workspaces, the
+        submodules do not depend on the cache once updated.
+        """
+        rewrites = []
+        for url, repo in sorted(cached.items()):
+            rewrites += ['-c', 'url.%s.insteadOf=%s' % (repo, url)]
+        # The cache is a local path, which git refuses for submodules
+        rewrites += ['-c', 'protocol.file.allow=always']
+
+        log.info(
+            'Updating submodules of %s from the git cache: %s',
+            dirpath,
+            ', '.join(sorted(cached.values())),
+        )
+        with contextlib.ExitStack() as stack:
+            for repo in sorted(set(cached.values())):
+                stack.enter_context(quibble.gitcache.shared_lock(repo))
+            try:
+                quibble.process.check_call(
+                    ['git'] + rewrites + update, cwd=dirpath
+                )
+                return
+            except subprocess.CalledProcessError:
+                log.warning(
+                    'Git cache lacks submodule commits of %s, '
+                    'updating from upstream',
+                    dirpath,
+                )
+        quibble.process.check_call(['git'] + update, cwd=dirpath)
 
     def __str__(self):
         # TODO: Would be nicer to extract the directory crawl into a subroutine
@@ -233,6 +639,9 @@ class ExtSkinSubmoduleUpdate:
 
 # Used to be bin/mw-create-composer-local.py
 class CreateComposerLocal:
+    needs = ('workspace',)
+    produces = ('deps',)
+
     def __init__(self, mw_install_path, dependencies):
         self.mw_install_path = mw_install_path
         self.dependencies = dependencies
@@ -259,10 +668,14 @@ class CreateComposerLocal:
 
 
 class ExtSkinComposerNpmTest:
-    def __init__(self, directory, composer, npm):
+    needs = ('workspace',)
+    produces = ('workspace',)
+
+    def __init__(self, directory, composer, npm, npm_store=None):
         self.directory = directory
         self.composer = composer
         self.npm = npm
+        self.npm_store = npm_store
 
     def execute(self):
         tasks = []
@@ -297,7 +710,7 @@ class ExtSkinComposerNpmTest:
             ['composer', '--ansi', 'test'],
         ]
         for cmd in cmds:
-            subprocess.check_call(cmd, cwd=self.directory)
+            quibble.process.check_call(cmd, cwd=self.directory)
 
     def _run_extskin_npm(self):
         project_name = os.path.basename(self.directory)
@@ -308,8 +721,8 @@ class ExtSkinComposerNpmTest:
             return
 
         log.info('Running "npm test" for %s', project_name)
-        _npm_install(self.directory)
-        subprocess.check_call(['npm', 'test'], cwd=self.directory)
+        _npm_install(self.directory, self.npm_store)
+        quibble.process.check_call(['npm', 'test'], cwd=self.directory)
 
     def __str__(self):
         tests = []
@@ -321,6 +734,9 @@ class ExtSkinComposerNpmTest:
 
 
 class CoreNpmComposerTest:
+    needs = ('workspace', 'deps', 'npm')
+    produces = ()
+
     def __init__(self, mw_install_path, composer, npm):
         self.mw_install_path = mw_install_path
         self.composer = composer
@@ -359,13 +775,13 @@ class CoreNpmComposerTest:
 
             composer_test_cmd = ['composer', 'test']
             composer_test_cmd.extend(files)
-            subprocess.check_call(
+            quibble.process.check_call(
                 composer_test_cmd, cwd=self.mw_install_path, env=env
             )
 
     def _run_npm_test(self):
         log.info("Running npm test")
-        subprocess.check_call(['npm', 'test'], cwd=self.mw_install_path)
+        quibble.process.check_call(['npm', 'test'], cwd=self.mw_install_path)
 
     def __str__(self):
         tests = []
@@ -377,6 +793,9 @@ class CoreNpmComposerTest:
 
 
 class NativeComposerDependencies:
+    needs = ('workspace',)
+    produces = ('deps',)
+
     def __init__(self, mw_install_path):
         self.mw_install_path = mw_install_path
 
@@ -391,16 +810,24 @@ class NativeComposerDependencies:
             '--profile',
             '-v',
         ]
-        subprocess.check_call(cmd, cwd=self.mw_install_path)
+        quibble.process.check_call(cmd, cwd=self.mw_install_path)
 
     def __str__(self):
         return "Run composer update for mediawiki/core"
 
 
 class VendorComposerDependencies:
-    def __init__(self, mw_install_path, log_dir):
+    needs = ('workspace', 'logs')
+    produces = ('deps',)
+
+    def __init__(self, mw_install_path, log_dir, store=None):
+        """
+        store: a quibble.store.TreeStore holding the changes made to
+        vendor.git
+        """
         self.mw_install_path = mw_install_path
         self.log_dir = log_dir
+        self.store = store
 
     def execute(self):
         log.info('vendor.git used. ' 'Requiring composer dev dependencies')
@@ -409,6 +836,16 @@ class VendorComposerDependencies:
         with open(mw_composer_json, 'r') as f:
             composer = json.load(f)
 
+        key = None
+        if self.store is not None:
+            key = self._cache_key(composer['require-dev'], vendor_dir)
+            if self._restore(key, vendor_dir):
+                # The autoloader merges the autoload sections of core and
+                # classes found in its files, which the key does not cover
+                self._dump_autoload(vendor_dir)
+                self._copy_logs(mw_composer_json, vendor_dir)
+                return
+
         reqs = [
             '='.join([dependency, version])
             for dependency, version in composer['require-dev'].items()
@@ -426,13 +863,13 @@ class VendorComposerDependencies:
         ]
         composer_require.extend(reqs)
 
-        subprocess.check_call(composer_require, cwd=vendor_dir)
+        quibble.process.check_call(composer_require, cwd=vendor_dir)
 
         # Point composer-merge-plugin to mediawiki/core.
         # That let us easily merge autoload-dev section and thus complete
         # the autoloader.
         # T158674
-        subprocess.check_call(
+        quibble.process.check_call(
             [
                 'composer',
                 'config',
@@ -445,10 +882,19 @@ class VendorComposerDependencies:
         # FIXME integration/composer used to be outdated and broke the
         # autoloader. Since composer 1.0.0-alpha11 the following might not
         # be needed anymore.
-        subprocess.check_call(
+        self._dump_autoload(vendor_dir)
+
+        if key is not None:
+            self._save(key, vendor_dir)
+
+        self._copy_logs(mw_composer_json, vendor_dir)
+
+    def _dump_autoload(self, vendor_dir):
+        quibble.process.check_call(
             ['composer', 'dump-autoload', '--optimize'], cwd=vendor_dir
         )
 
+    def _copy_logs(self, mw_composer_json, vendor_dir):
         copylog(
             mw_composer_json,
             os.path.join(self.log_dir, 'composer.core.json.txt'),
@@ -462,16 +908,100 @@ class VendorComposerDependencies:
             os.path.join(self.log_dir, 'composer.autoload_files.php.txt'),
         )
 
+    def _cache_key(self, require_dev, vendor_dir):
+        key = hashlib.sha256()
+        key.update(json.dumps(require_dev, sort_keys=True).encode())
+        key.update(quibble.manifest.git_head(vendor_dir).encode())
+        key.update(quibble.process.check_output(['composer', '--version']))
+        # The merge-plugin include is an absolute path
+        key.update(self.mw_install_path.encode())
+        return key.hexdigest()
+
+    def _save(self, key, vendor_dir):
+        """Store the files composer changed in vendor.git"""
+        with tempfile.TemporaryDirectory() as delta:
+            deleted = []
+            for status, path in _git_status(vendor_dir):
+                if 'D' in status:
+                    deleted.append(path)
+                    continue
+                dest = os.path.join(delta, 'files', path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(
+                    os.path.join(vendor_dir, path), dest, follow_symlinks=False
+                )
+            with open(os.path.join(delta, 'deleted.json'), 'w') as f:
+                json.dump(deleted, f)
+            self.store.put(key, delta)
+
+    def _restore(self, key, vendor_dir):
+        with tempfile.TemporaryDirectory() as tmp:
+            delta = os.path.join(tmp, 'delta')
+            # composer dump-autoload rewrites files of the delta
+            if not self.store.get(key, delta, link=False):
+                return False
+
+            with open(os.path.join(delta, 'deleted.json')) as f:
+                for path in json.load(f):
+                    if os.path.lexists(os.path.join(vendor_dir, path)):
+                        os.unlink(os.path.join(vendor_dir, path))
+
+            files = os.path.join(delta, 'files')
+            for dirpath, dirnames, filenames in os.walk(files):
+                for name in filenames:
+                    src = os.path.join(dirpath, name)
+                    dest = os.path.join(
+                        vendor_dir, os.path.relpath(src, files)
+                    )
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    if os.path.lexists(dest):
+                        os.unlink(dest)
+                    shutil.move(src, dest)
+        log.info('Restored composer dev dependencies from cache')
+        return True
+
+    def inputs(self):
+        return {
+            'composer.json': quibble.manifest.file_digest(
+                os.path.join(self.mw_install_path, 'composer.json')
+            ),
+            'vendor': quibble.manifest.git_head(
+                os.path.join(self.mw_install_path, 'vendor')
+            ),
+        }
+
+    def outputs(self):
+        return [
+            os.path.join(
+                self.mw_install_path, 'vendor/composer/autoload_files.php'
+            )
+        ]
+
     def __str__(self):
         return "Install composer dev-requires for vendor.git"
 
 
 class NpmInstall:
-    def __init__(self, directory):
+    needs = ('workspace',)
+    produces = ('npm',)
+
+    def __init__(self, directory, npm_store=None):
         self.directory = directory
+        self.npm_store = npm_store
 
     def execute(self):
-        _npm_install(self.directory)
+        _npm_install(self.directory, self.npm_store)
+
+    def inputs(self):
+        return {
+            name: quibble.manifest.file_digest(
+                os.path.join(self.directory, name)
+            )
+            for name in ['package.json', 'package-lock.json']
+        }
+
+    def outputs(self):
+        return [os.path.join(self.directory, 'node_modules')]
 
     def __str__(self):
         return "npm install in {}".format(self.directory)
@@ -482,14 +1012,32 @@ class StartBackends:
     reverse order before application exit.
     """
 
+    # Backends might be started concurrently by different plan commands
+    _lock = threading.Lock()
+
     def __init__(self, context_stack, backends):
         self.context_stack = context_stack
         self.backends = backends
 
+    @property
+    def needs(self):
+        return self._backends_resources('needs')
+
+    @property
+    def produces(self):
+        return self._backends_resources('produces')
+
+    def _backends_resources(self, kind):
+        resources = []
+        for backend in self.backends:
+            resources.extend(getattr(backend, kind, ()))
+        return tuple(resources)
+
     def execute(self):
         """Atomically start each backend and add it to the shutdown stack."""
-        for context in self.backends + [self._exit()]:
-            self.context_stack.enter_context(context)
+        with self._lock:
+            for context in self.backends + [self._exit()]:
+                self.context_stack.enter_context(context)
 
     def _service_names(self):
         return " ".join([str(backend) for backend in self.backends])
@@ -507,17 +1055,53 @@ class StartBackends:
 
 
 class InstallMediaWiki:
+    needs = ('workspace', 'deps', 'db', 'logs')
+    produces = ('db',)
+
     def __init__(
-        self, mw_install_path, db, web_url, log_dir, tmp_dir, use_vendor
+        self,
+        mw_install_path,
+        db,
+        web_url,
+        log_dir,
+        tmp_dir,
+        use_vendor,
+        snapshot_store=None,
     ):
+        """
+        snapshot_store: a quibble.store.TreeStore of installed databases
+        """
         self.mw_install_path = mw_install_path
         self.db = db
         self.web_url = web_url
         self.log_dir = log_dir
         self.tmp_dir = tmp_dir
         self.use_vendor = use_vendor
+        self.snapshot_store = snapshot_store
 
     def execute(self):
+        snapshot_key = None
+        if self.snapshot_store is not None:
+            if self.db.can_snapshot:
+                snapshot_key = self._snapshot_key()
+            else:
+                log.warning('%s does not support snapshots', self.db.type)
+
+        restored = snapshot_key is not None and self._restore_snapshot(
+            snapshot_key
+        )
+        if restored:
+            log.info('Restored database snapshot, skipping installation')
+        else:
+            self._install()
+            # Before update.php, which applies schema changes made by the
+            # patches under test. The key does not cover those.
+            if snapshot_key is not None:
+                self._save_snapshot(snapshot_key)
+
+        self._configure()
+
+    def _install(self):
         # TODO: Better if we can calculate the install args before
         # instantiating the database.
         install_args = [
@@ -547,6 +1131,12 @@ class InstallMediaWiki:
             args=install_args, mwdir=self.mw_install_path
         )
 
+        os.rename(
+            os.path.join(self.mw_install_path, 'LocalSettings.php'),
+            os.path.join(self.mw_install_path, 'LocalSettings-installer.php'),
+        )
+
+    def _configure(self):
         localsettings = os.path.join(self.mw_install_path, 'LocalSettings.php')
         localsettings_installer = os.path.join(
             self.mw_install_path, 'LocalSettings-installer.php'
@@ -570,7 +1160,6 @@ class InstallMediaWiki:
                 '{{params-declaration}}', params_declaration
             )
 
-        os.rename(localsettings, localsettings_installer)
         with open(localsettings, "w") as f:
             f.write(customsettings)
 
@@ -579,7 +1168,7 @@ class InstallMediaWiki:
             localsettings_installer,
             os.path.join(self.log_dir, 'LocalSettings-installer.php'),
         )
-        subprocess.check_call(
+        quibble.process.check_call(
             ['php', '-l', localsettings, localsettings_installer]
         )
 
@@ -607,6 +1196,106 @@ class InstallMediaWiki:
             lang=['en'], mwdir=self.mw_install_path
         )
 
+    def _snapshot_key(self):
+        heads = quibble.manifest.mediawiki_heads(self.mw_install_path)
+        key = {
+            # Snapshots are taken before update.php
+            'stage': 'installed',
+            'core': heads['.'],
+            'extensions': sorted(path for path in heads if path != '.'),
+            'db': self.db.type,
+            'template': quibble.manifest.file_digest(
+                pkg_resources.resource_filename(
+                    __name__, 'mediawiki/local_settings.php.tpl'
+                )
+            ),
+            'web_url': self.web_url,
+            'mw_install_path': self.mw_install_path,
+        }
+        return hashlib.sha256(
+            json.dumps(key, sort_keys=True).encode()
+        ).hexdigest()
+
+    def _snapshot_variables(self):
+        # Longest first so a value containing another one is replaced first
+        return sorted(
+            self.db.snapshot_variables().items(),
+            key=lambda item: len(item[1]),
+            reverse=True,
+        )
+
+    def _save_snapshot(self, key):
+        installer_settings = os.path.join(
+            self.mw_install_path, 'LocalSettings-installer.php'
+        )
+        with tempfile.TemporaryDirectory() as snapshot:
+            self.db.snapshot(os.path.join(snapshot, 'db'))
+
+            with open(installer_settings) as f:
+                settings = f.read()
+            for name, value in self._snapshot_variables():
+                settings = settings.replace(value, '{{%s}}' % name)
+            with open(
+                os.path.join(snapshot, 'LocalSettings-installer.php'), 'w'
+            ) as f:
+                f.write(settings)
+
+            self.snapshot_store.put(key, snapshot)
+
+    def _restore_snapshot(self, key):
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = os.path.join(tmp, 'snapshot')
+            if not self.snapshot_store.get(key, snapshot):
+                return False
+
+            self.db.restore(os.path.join(snapshot, 'db'))
+
+            with open(
+                os.path.join(snapshot, 'LocalSettings-installer.php')
+            ) as f:
+                settings = f.read()
+            for name, value in self._snapshot_variables():
+                settings = settings.replace('{{%s}}' % name, value)
+            with open(
+                os.path.join(
+                    self.mw_install_path, 'LocalSettings-installer.php'
+                ),
+                'w',
+            ) as f:
+                f.write(settings)
+        return True
+
+    def inputs(self):
+        # Without persistent data, the database has to be installed again
+        if not self.db.persistent:
+            return None
+        return {
+            'db': self.db.type,
+            'rootdir': self.db.rootdir,
+            'web_url': self.web_url,
+            'log_dir': self.log_dir,
+            'tmp_dir': self.tmp_dir,
+            'use_vendor': self.use_vendor,
+            'template': quibble.manifest.file_digest(
+                pkg_resources.resource_filename(
+                    __name__, 'mediawiki/local_settings.php.tpl'
+                )
+            ),
+            'heads': quibble.manifest.mediawiki_heads(self.mw_install_path),
+        }
+
+    def outputs(self):
+        return [
+            os.path.join(self.mw_install_path, 'LocalSettings.php'),
+            os.path.join(self.mw_install_path, 'LocalSettings-installer.php'),
+        ]
+
+    def clear(self):
+        for path in self.outputs():
+            if os.path.exists(path):
+                os.unlink(path)
+        self.db.clear()
+
     def __str__(self):
         return "Install MediaWiki, db={} vendor={}".format(
             self.db, self.use_vendor
@@ -614,9 +1303,18 @@ class InstallMediaWiki:
 
 
 class AbstractPhpUnit:
-    def _run_phpunit(self, group=[], exclude_group=[], cmd=None):
-        log.info(self)
-
+    # A quibble.history.History recording the tests durations
+    history = None
+    # A quibble.impact.Impact to run the tests affected by the change first
+    impact = None
+    # A quibble.impact.ImpactIndex recording the coverage of the tests
+    coverage_index = None
+    # A quibble.history.TestOrder to run recently failed tests first
+    test_order = None
+    # Whether to stop at the first failure
+    stop_on_failure = False
+
+    def _phpunit_command(self, group, exclude_group, cmd):
         always_excluded = ['Broken', 'ParserFuzz', 'Stub']
         if not cmd:
             cmd = ['php', 'tests/phpunit/phpunit.php']
@@ -629,23 +1327,228 @@ class AbstractPhpUnit:
         cmd.extend(
             ['--exclude-group', ','.join(always_excluded + exclude_group)]
         )
+        if self.stop_on_failure:
+            cmd.append('--stop-on-failure')
+        return cmd
+
+    def _phpunit_env(self):
+        phpunit_env = {}
+        phpunit_env.update(os.environ)
+        phpunit_env.update({'LANG': 'C.UTF-8'})
+        return phpunit_env
+
+    def _run_phpunit(self, group=[], exclude_group=[], cmd=None):
+        if cmd is None and (
+            self.impact is not None or self.test_order is not None
+        ):
+            self._run_phpunit_shards(1, group, exclude_group)
+            return
 
+        log.info(self)
+
+        cmd = self._phpunit_command(group, exclude_group, cmd)
         if self.junit_file:
             cmd.extend(['--log-junit', self.junit_file])
         log.info(' '.join(cmd))
 
-        phpunit_env = {}
-        phpunit_env.update(os.environ)
-        phpunit_env.update({'LANG': 'C.UTF-8'})
+        try:
+            self._run_shard(cmd)
+        finally:
+            self._record_results()
 
-        subprocess.check_call(cmd, cwd=self.mw_install_path, env=phpunit_env)
+    def _record_results(self):
+        if not os.path.exists(self.junit_file):
+            return
+        if self.history is not None:
+            self.history.record(self.junit_file)
+        if self.test_order is not None:
+            self.test_order.record(self.junit_file)
+
+    def _list_classes(self, cmd):
+        def list_classes():
+            return quibble.phpunit.list_test_classes(
+                cmd, self.mw_install_path, self._phpunit_env()
+            )
+
+        if self.history is not None:
+            return self.history.test_classes(
+                quibble.history.test_list_key(cmd, self.mw_install_path),
+                list_classes,
+            )
+        return list_classes()
+
+    def _first_classes(self, classes):
+        """
+        Split classes in those to run first: recently failed, of the project
+        under test or affected by the change, and the remaining ones.
+        """
+        first = []
+        if self.test_order is not None:
+            first = self.test_order.first(classes)
+            if first:
+                log.info(
+                    'Running first %s test classes which recently failed '
+                    'or belong to the project',
+                    len(first),
+                )
+
+        skip_remaining = False
+        if self.impact is not None:
+            affected, complete = self.impact.affected(classes)
+            if affected:
+                log.info(
+                    'Running first %s test classes affected by the change',
+                    len(affected),
+                )
+            else:
+                log.info('No test class is known to be affected by the change')
+            first += [c for c in affected if c not in first]
+
+            if self.impact.only and complete:
+                skip_remaining = True
+            elif self.impact.only:
+                log.info(
+                    'Running all tests, some changed files are not covered '
+                    'by known tests'
+                )
+
+        selected = set(first)
+        remaining = [c for c in classes if c not in selected]
+        if skip_remaining:
+            log.info(
+                'Skipping %s test classes not affected by the change',
+                len(remaining),
+            )
+            remaining = []
+        return (first, remaining)
+
+    def _run_phpunit_shards(self, shards, group=[], exclude_group=[]):
+        """
+        Run test classes split in shards concurrently and merge their JUnit
+        results to junit_file.
+
+        Test classes selected by test_order and impact are run first, on
+        their own. The remaining ones are then run by excluding them.
+        """
+        log.info(self)
+
+        cmd = self._phpunit_command(group, exclude_group, None)
+        listed = self._list_classes(cmd)
+        first, classes = self._first_classes(listed)
+
+        with tempfile.TemporaryDirectory() as junit_dir:
+            junit_files = []
+            first_error = None
+            try:
+                if first:
+                    runs = self._class_runs(
+                        first, listed, os.path.join(junit_dir, 'first')
+                    )
+                    junit_files.extend(junit_file for (_, junit_file) in runs)
+                    try:
+                        self._run_classes(cmd, runs)
+                    except subprocess.CalledProcessError as e:
+                        if self.stop_on_failure:
+                            raise
+                        first_error = e
+
+                if self.history is not None:
+                    shard_classes = self.history.pack(classes, shards)
+                else:
+                    shard_classes = quibble.phpunit.split(classes, shards)
+                log.info(
+                    'Running %s test classes in %s shards',
+                    len(classes),
+                    len(shard_classes),
+                )
+
+                tasks = []
+                for index, test_classes in enumerate(shard_classes):
+                    runs = self._class_runs(
+                        test_classes,
+                        listed,
+                        os.path.join(junit_dir, 'shard-%s' % index),
+                    )
+                    junit_files.extend(junit_file for (_, junit_file) in runs)
+                    tasks.append((self._run_classes, cmd, runs))
+
+                parallel_run(tasks, fail_fast=self.stop_on_failure)
+            finally:
+                if self.junit_file:
+                    quibble.phpunit.merge_junit(
+                        [f for f in junit_files if os.path.exists(f)],
+                        self.junit_file,
+                    )
+                    self._record_results()
+
+        if first_error is not None:
+            raise first_error
+
+    def _class_runs(self, classes, listed, junit_prefix):
+        """
+        PHPUnit filters running the test classes among the listed ones,
+        paired with the JUnit file each run writes.
+        """
+        return [
+            (pattern, '%s-%s.xml' % (junit_prefix, index))
+            for index, pattern in enumerate(
+                quibble.phpunit.class_filters(classes, listed)
+            )
+        ]
+
+    def _run_classes(self, cmd, runs):
+        for pattern, junit_file in runs:
+            filter_args = []
+            if pattern is not None:
+                filter_args = ['--filter', pattern]
+            self._run_shard(cmd + filter_args + ['--log-junit', junit_file])
+
+    def _run_shard(self, cmd):
+        if self.coverage_index is None:
+            quibble.process.check_call(
+                cmd, cwd=self.mw_install_path, env=self._phpunit_env()
+            )
+            return
+
+        with tempfile.TemporaryDirectory() as coverage_dir:
+            try:
+                quibble.process.check_call(
+                    cmd + ['--coverage-xml', coverage_dir],
+                    cwd=self.mw_install_path,
+                    env=self._phpunit_env(),
+                )
+            finally:
+                if os.path.exists(os.path.join(coverage_dir, 'index.xml')):
+                    self.coverage_index.record(
+                        coverage_dir, self.mw_install_path
+                    )
 
 
 class PhpUnitDatabaseless(AbstractPhpUnit):
-    def __init__(self, mw_install_path, testsuite, log_dir):
+    needs = ('workspace', 'deps', 'db', 'logs')
+    produces = ()
+
+    def __init__(
+        self,
+        mw_install_path,
+        testsuite,
+        log_dir,
+        shards=1,
+        history=None,
+        impact=None,
+        coverage_index=None,
+        test_order=None,
+        stop_on_failure=False,
+    ):
         self.mw_install_path = mw_install_path
         self.testsuite = testsuite
         self.log_dir = log_dir
+        self.shards = shards
+        self.history = history
+        self.impact = impact
+        self.coverage_index = coverage_index
+        self.test_order = test_order
+        self.stop_on_failure = stop_on_failure
         self.junit_file = os.path.join(self.log_dir, 'junit-dbless.xml')
 
     def execute(self):
@@ -653,15 +1556,25 @@ class PhpUnitDatabaseless(AbstractPhpUnit):
         # other tests.
         # XXX some mediawiki/core smoke PHPunit tests should probably
         # be run as well.
-        self._run_phpunit(exclude_group=['Database', 'Standalone'])
+        exclude_group = ['Database', 'Standalone']
+        if self.shards > 1:
+            self._run_phpunit_shards(self.shards, exclude_group=exclude_group)
+        else:
+            self._run_phpunit(exclude_group=exclude_group)
 
     def __str__(self):
-        return "PHPUnit {} suite (without database or standalone)".format(
-            self.testsuite or 'default'
-        )
+        description = "PHPUnit {} suite (without database or standalone)"
+        if self.shards > 1:
+            description += " in {} shards".format(self.shards)
+        if self.impact is not None:
+            description += ", affected tests first"
+        return description.format(self.testsuite or 'default')
 
 
 class PhpUnitStandalone(AbstractPhpUnit):
+    needs = ('workspace', 'deps', 'db', 'logs')
+    produces = ()
+
     def __init__(self, mw_install_path, testsuite, log_dir, repo_path):
         self.mw_install_path = mw_install_path
         self.testsuite = testsuite
@@ -683,10 +1596,17 @@ class PhpUnitStandalone(AbstractPhpUnit):
 
 
 class PhpUnitUnit(AbstractPhpUnit):
-    def __init__(self, mw_install_path, log_dir):
+    needs = ('workspace', 'deps', 'logs')
+    produces = ()
+
+    def __init__(
+        self, mw_install_path, log_dir, history=None, stop_on_failure=False
+    ):
         self.mw_install_path = mw_install_path
         self.log_dir = log_dir
         self.testsuite = None
+        self.history = history
+        self.stop_on_failure = stop_on_failure
         self.junit_file = os.path.join(self.log_dir, 'junit-unit.xml')
 
     def execute(self):
@@ -701,22 +1621,44 @@ class PhpUnitUnit(AbstractPhpUnit):
 
 
 class PhpUnitDatabase(AbstractPhpUnit):
-    def __init__(self, mw_install_path, testsuite, log_dir):
+    needs = ('workspace', 'deps', 'db', 'logs')
+    produces = ('db',)
+
+    def __init__(
+        self,
+        mw_install_path,
+        testsuite,
+        log_dir,
+        history=None,
+        impact=None,
+        coverage_index=None,
+        test_order=None,
+        stop_on_failure=False,
+    ):
         self.mw_install_path = mw_install_path
         self.testsuite = testsuite
         self.log_dir = log_dir
+        self.history = history
+        self.impact = impact
+        self.coverage_index = coverage_index
+        self.test_order = test_order
+        self.stop_on_failure = stop_on_failure
         self.junit_file = os.path.join(self.log_dir, 'junit-db.xml')
 
     def execute(self):
         self._run_phpunit(group=['Database'], exclude_group=['Standalone'])
 
     def __str__(self):
-        return "PHPUnit {} suite (with database)".format(
-            self.testsuite or 'default'
-        )
+        description = "PHPUnit {} suite (with database)"
+        if self.impact is not None:
+            description += ", affected tests first"
+        return description.format(self.testsuite or 'default')
 
 
 class QunitTests:
+    needs = ('workspace', 'npm', 'db', 'web', 'display')
+    produces = ()
+
     def __init__(self, mw_install_path, web_url):
         self.mw_install_path = mw_install_path
         self.web_url = web_url
@@ -731,7 +1673,7 @@ class QunitTests:
         karma_env.update(os.environ)
         karma_env.update({'CHROMIUM_FLAGS': quibble.chromium_flags()})
 
-        subprocess.check_call(
+        quibble.process.check_call(
             ['./node_modules/.bin/grunt', 'qunit'],
             cwd=self.mw_install_path,
             env=karma_env,
@@ -742,10 +1684,14 @@ class QunitTests:
 
 
 class ApiTesting:
-    def __init__(self, mw_install_path, projects, url):
+    needs = ('workspace', 'db', 'web')
+    produces = ('npm', 'db')
+
+    def __init__(self, mw_install_path, projects, url, npm_store=None):
         self.mw_install_path = mw_install_path
         self.projects = projects
         self.url = url
+        self.npm_store = npm_store
 
     def execute(self):
         settings_in_path = (
@@ -773,8 +1719,8 @@ class ApiTesting:
                 )
             )
             if _repo_has_npm_script(project_dir, 'api-testing'):
-                _npm_install(project_dir)
-                subprocess.check_call(
+                _npm_install(project_dir, self.npm_store)
+                quibble.process.check_call(
                     ['npm', 'run', 'api-testing'],
                     cwd=project_dir,
                     env=quibble_testing_config,
@@ -785,21 +1731,50 @@ class ApiTesting:
 
 
 class BrowserTests:
-    def __init__(self, mw_install_path, projects, display, web_url):
+    needs = ('workspace', 'db', 'web', 'display')
+    produces = ('npm', 'db')
+
+    def __init__(
+        self,
+        mw_install_path,
+        projects,
+        display,
+        web_url,
+        npm_store=None,
+        test_order=None,
+    ):
+        """
+        test_order: quibble.history.TestOrder to start with the projects
+        whose browser tests recently failed
+        """
         self.mw_install_path = mw_install_path
         self.projects = projects
         self.display = display
         self.web_url = web_url
+        self.npm_store = npm_store
+        self.test_order = test_order
 
     def execute(self):
-        for project in self.projects:
-            with quibble.logginglevel('zuul.CloneMapper', logging.WARNING):
-                repo_dir = quibble.zuul.repo_dir(project)
+        projects = self.projects
+        if self.test_order is not None:
+            projects = self.test_order.projects(projects)
+
+        for project in projects:
             project_dir = os.path.normpath(
-                os.path.join(self.mw_install_path, repo_dir)
+                os.path.join(
+                    self.mw_install_path, quibble.zuul.repo_dir(project)
+                )
             )
-            if _repo_has_npm_script(project_dir, 'selenium-test'):
+            if not _repo_has_npm_script(project_dir, 'selenium-test'):
+                continue
+            try:
                 self._run_webdriver(project_dir)
+            except subprocess.CalledProcessError:
+                if self.test_order is not None:
+                    self.test_order.record_project(project, passed=False)
+                raise
+            if self.test_order is not None:
+                self.test_order.record_project(project, passed=True)
 
     def _run_webdriver(self, project_dir):
         log.info('Running webdriver test in %s', project_dir)
@@ -816,8 +1791,8 @@ class BrowserTests:
             }
         )
 
-        _npm_install(project_dir)
-        subprocess.check_call(
+        _npm_install(project_dir, self.npm_store)
+        quibble.process.check_call(
             ['npm', 'run', 'selenium-test'], cwd=project_dir, env=webdriver_env
         )
 
@@ -826,6 +1801,9 @@ class BrowserTests:
 
 
 class UserScripts:
+    # Arbitrary commands, they do not declare needs/produces and are thus run
+    # on their own.
+
     def __init__(self, mw_install_path, commands):
         self.mw_install_path = mw_install_path
         self.commands = commands
@@ -835,13 +1813,18 @@ class UserScripts:
 
         for cmd in self.commands:
             log.info(cmd)
-            subprocess.check_call(cmd, shell=True, cwd=self.mw_install_path)
+            quibble.process.check_call(
+                cmd, shell=True, cwd=self.mw_install_path
+            )
 
     def __str__(self):
         return "User commands: {}".format(", ".join(self.commands))
 
 
 class EnsureDirectory:
+    needs = ()
+    produces = ('logs',)
+
     def __init__(self, directory):
         self.directory = directory
 
@@ -853,11 +1836,16 @@ class EnsureDirectory:
 
 
 class GitClean:
+    needs = ('workspace',)
+    produces = ('workspace',)
+
     def __init__(self, directory):
         self.directory = directory
 
     def execute(self):
-        subprocess.check_call(['git', 'clean', '-xqdf'], cwd=self.directory)
+        quibble.process.check_call(
+            ['git', 'clean', '-xqdf'], cwd=self.directory
+        )
 
     def __str__(self):
         return "Revert to git clean -xqdf in {}".format(self.directory)
@@ -868,6 +1856,15 @@ def _repo_has_composer_script(project_dir, script_name):
     return _json_has_script(composer_path, script_name)
 
 
+def _git_status(directory):
+    """List (status, path) of changed and untracked files in a git work tree"""
+    out = quibble.process.check_output(
+        ['git', 'status', '--porcelain', '-z', '--untracked-files=all'],
+        cwd=directory,
+    ).decode()
+    return [(entry[:2], entry[3:]) for entry in out.split('\0') if entry]
+
+
 def _repo_has_npm(project_dir):
     lock_path = os.path.join(project_dir, 'package.json')
     return os.path.exists(lock_path)
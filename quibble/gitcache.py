@@ -0,0 +1,360 @@
+"""
+Maintain the cache of git repositories given to --git-cache
+
+Repositories in the cache are either bare (<project>.git) or have a working
+tree (<project>). Updating fetches branches and tags from upstream then runs
+pack maintenance so that clones from the cache are quick. A project whose
+maintenance fails is reported as failing to update.
+
+Submodules of the cached repositories can be mirrored as well. Those not
+hosted on GIT_URL are cached under their host and path, for example
+github.com/wikimedia/foo.
+
+Workspaces cloned with --git-cache-shared keep borrowing objects from the
+cache through git alternates once the clone is done. Updates thus never delete
+objects: fetches do not trigger garbage collection and maintenance only packs
+objects, repositories are never pruned.
+
+Jobs cloning from the cache hold a shared lock on the repository, updates
+only hold an exclusive lock while maintenance rewrites packs. Locking is
+skipped when the lock file can not be opened, for example when the cache is
+read-only and has never been updated by this command.
+"""
+
+import argparse
+import contextlib
+import fcntl
+import functools
+import logging
+import os
+import re
+import shutil
+import subprocess
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import quibble
+import quibble.process
+
+log = logging.getLogger(__name__)
+
+GIT_URL = 'https://gerrit.wikimedia.org/r'
+LOCK_FILE = 'quibble-cache.lock'
+# `git maintenance run` and its tasks, older versions repack instead
+MAINTENANCE_GIT_VERSION = (2, 29)
+
+
+def cache_path(cache_dir, project):
+    """Path of a project in the cache, None if it is not cached"""
+    for path in [
+        '%s/%s.git' % (cache_dir, project),
+        '%s/%s' % (cache_dir, project),
+    ]:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def url_project(url, git_url=GIT_URL):
+    """
+    Project under which the repository at url is cached, None for relative
+    and local urls.
+    """
+    url = url.rstrip('/')
+    if url.endswith('.git'):
+        url = url[: -len('.git')]
+    prefix = git_url.rstrip('/') + '/'
+    if url.startswith(prefix):
+        return url[len(prefix) :]
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme in ('http', 'https', 'git', 'ssh') and parsed.netloc:
+        return parsed.hostname + parsed.path
+    return None
+
+
+def submodule_urls(repo, blob=None):
+    """
+    URLs of the submodules of a repository
+
+    Read from the .gitmodules of its working tree, or from blob such as
+    'HEAD:.gitmodules' for bare repositories.
+    """
+    source = ['--blob', blob] if blob else ['--file', '.gitmodules']
+    try:
+        output = quibble.process.check_output(
+            ['git', 'config']
+            + source
+            + ['--get-regexp', r'^submodule\..*\.url$'],
+            cwd=repo,
+        )
+    except subprocess.CalledProcessError:
+        # No .gitmodules or no submodules in it
+        return []
+    return [line.split(' ', 1)[1] for line in output.decode().splitlines()]
+
+
+def _git_dir(repo):
+    dot_git = os.path.join(repo, '.git')
+    if os.path.isdir(dot_git):
+        return dot_git
+    return repo
+
+
+@contextlib.contextmanager
+def _lock(repo, operation, create=False):
+    path = os.path.join(_git_dir(repo), LOCK_FILE)
+    try:
+        lock = open(path, 'a' if create else 'r')
+    except OSError as e:
+        log.debug('Not locking %s: %s', repo, e)
+        yield
+        return
+
+    with lock:
+        fcntl.flock(lock, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def shared_lock(repo):
+    """Prevent maintenance of a cached repository while reading from it"""
+    return _lock(repo, fcntl.LOCK_SH)
+
+
+def find_projects(cache_dir):
+    """Projects having a repository in the cache"""
+    projects = []
+    for dirpath, dirnames, filenames in os.walk(cache_dir):
+        if dirpath == cache_dir:
+            continue
+        if os.path.isdir(os.path.join(dirpath, '.git')) or (
+            dirpath.endswith('.git') and 'HEAD' in filenames
+        ):
+            project = os.path.relpath(dirpath, cache_dir)
+            if project.endswith('.git'):
+                project = project[: -len('.git')]
+            projects.append(project)
+            # Do not look for repositories in a repository
+            dirnames.clear()
+    return sorted(projects)
+
+
+def _fetch(repo):
+    if _git_dir(repo) == repo:
+        # Bare repositories have no remote-tracking branches, mirror the
+        # upstream branches and tags.
+        refspecs = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+    else:
+        refspecs = []
+    # Automatic garbage collection would prune objects shared workspaces
+    # might be using
+    quibble.process.check_call(
+        [
+            'git',
+            '-c',
+            'gc.auto=0',
+            '-c',
+            'maintenance.auto=false',
+            'fetch',
+            '--quiet',
+            '--prune',
+            '--tags',
+            'origin',
+        ]
+        + refspecs,
+        cwd=repo,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def git_version():
+    """Version of git as a tuple of integers, eg: (2, 20, 1)"""
+    output = quibble.process.check_output(['git', '--version']).decode()
+    match = re.search(r'(\d+(?:\.\d+)+)', output)
+    if match is None:
+        raise Exception('Can not parse git version: %s' % output)
+    return tuple(int(v) for v in match.group(1).split('.'))
+
+
+def _maintenance(repo):
+    if git_version() >= MAINTENANCE_GIT_VERSION:
+        # Loose objects are packed first, incremental-repack fails when
+        # there is no pack yet
+        for tasks in [
+            ['--task=loose-objects'],
+            ['--task=incremental-repack', '--task=commit-graph'],
+        ]:
+            quibble.process.check_call(
+                ['git', 'maintenance', 'run', '--quiet'] + tasks, cwd=repo
+            )
+        return
+
+    # Pack loose objects without rewriting the existing packs nor dropping
+    # unreachable objects
+    quibble.process.check_call(['git', 'repack', '-d', '-q'], cwd=repo)
+    quibble.process.check_call(
+        ['git', 'commit-graph', 'write', '--reachable'], cwd=repo
+    )
+
+
+def update_project(cache_dir, project, git_url=GIT_URL, url=None):
+    """
+    Fetch a project in the cache, cloning it if needed, then repack it
+
+    url: where to clone the project from, default to its name on git_url
+    """
+    repo = cache_path(cache_dir, project)
+    if repo is None:
+        repo = '%s/%s.git' % (cache_dir, project)
+        log.info('Cloning %s to %s', project, repo)
+        # Clone aside so jobs never see a partial clone
+        tmp = repo + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        quibble.process.check_call(
+            [
+                'git',
+                'clone',
+                '--quiet',
+                '--bare',
+                url or '%s/%s' % (git_url, project),
+                tmp,
+            ]
+        )
+        os.rename(tmp, repo)
+
+    with _lock(repo, fcntl.LOCK_SH, create=True):
+        log.info('Fetching %s', project)
+        _fetch(repo)
+
+    with _lock(repo, fcntl.LOCK_EX, create=True):
+        log.info('Running maintenance of %s', project)
+        _maintenance(repo)
+
+
+def _update_all(cache_dir, urls, git_url, workers):
+    """Update projects in parallel, returns the ones that failed"""
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                update_project, cache_dir, project, git_url, url
+            ): project
+            for project, url in urls.items()
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.error('Failed to update %s: %s', futures[future], e)
+                failed.append(futures[future])
+    return failed
+
+
+def _submodules(cache_dir, projects, git_url):
+    """Cache projects and urls of the submodules of cached projects"""
+    urls = {}
+    for project in projects:
+        repo = cache_path(cache_dir, project)
+        if repo is None:
+            continue
+        for url in submodule_urls(repo, 'HEAD:.gitmodules'):
+            submodule = url_project(url, git_url)
+            if submodule is None:
+                log.warning('Not caching submodule %s of %s', url, project)
+                continue
+            urls[submodule] = url
+    return urls
+
+
+def update(
+    cache_dir, projects=None, git_url=GIT_URL, workers=4, submodules=False
+):
+    """
+    Update projects in the cache in parallel.
+
+    projects: projects to update or add, default to all the cached ones
+    submodules: also mirror the submodules of the projects, recursively
+    """
+    if not projects:
+        projects = find_projects(cache_dir)
+    log.info('Updating %s repositories in %s', len(projects), cache_dir)
+
+    failed = _update_all(
+        cache_dir, {project: None for project in projects}, git_url, workers
+    )
+
+    updated = set(projects)
+    to_inspect = set(projects) - set(failed)
+    while submodules and to_inspect:
+        urls = _submodules(cache_dir, sorted(to_inspect), git_url)
+        for project in updated.intersection(urls):
+            del urls[project]
+        if not urls:
+            break
+        log.info('Updating %s submodule repositories', len(urls))
+        new_failures = _update_all(cache_dir, urls, git_url, workers)
+        failed.extend(new_failures)
+        updated.update(urls)
+        to_inspect = set(urls) - set(new_failures)
+
+    if failed:
+        raise Exception('Failed to update: %s' % ', '.join(sorted(failed)))
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Maintain the cache of git repositories',
+        prog='quibble cache',
+    )
+    subparsers = parser.add_subparsers(dest='action', metavar='ACTION')
+    subparsers.required = True
+
+    update_parser = subparsers.add_parser(
+        'update',
+        help='Fetch repositories in the cache and run pack maintenance',
+    )
+    update_parser.add_argument(
+        '--git-cache',
+        default='/srv/git' if quibble.is_in_docker() else 'ref',
+        help='Path to the cache. In Docker: "/srv/git", else "ref"',
+    )
+    update_parser.add_argument(
+        '--git-url',
+        default=GIT_URL,
+        help='Base URL to clone new repositories from. Default: %s' % GIT_URL,
+    )
+    update_parser.add_argument(
+        '--git-parallel',
+        default=4,
+        type=int,
+        help='Number of repositories to update concurrently. Default: 4',
+    )
+    update_parser.add_argument(
+        '--submodules',
+        action='store_true',
+        help='Also mirror the repositories of the submodules of the projects',
+    )
+    update_parser.add_argument(
+        'projects',
+        default=[],
+        nargs='*',
+        help='Projects to update or add to the cache. '
+        'Default: every projects in the cache',
+    )
+    return parser
+
+
+def main(argv):
+    args = get_arg_parser().parse_args(argv)
+    if args.action == 'update':
+        update(
+            os.path.abspath(args.git_cache),
+            args.projects,
+            git_url=args.git_url,
+            workers=args.git_parallel,
+            submodules=args.submodules,
+        )
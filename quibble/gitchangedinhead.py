@@ -52,12 +52,13 @@ with this program; if not, write to the Free Software Foundation, Inc.,
 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """
 
-import subprocess
+import quibble.process
 
 
 class GitChangedInHead:
-    def __init__(self, args, cwd=None):
+    def __init__(self, args, cwd=None, diff_filter='ACM'):
         self.cwd = cwd
+        self.diff_filter = diff_filter
         self.path_args = []
         for arg in args:
             # Put a dot in front for file extensions
@@ -71,6 +72,7 @@ class GitChangedInHead:
         # HEAD^ will not exist for an initial commit, we thus need `git show`
         # --name-only: strip patch payload, only report the file being altered
         # --diff-filter=ACM: only care about files Added, Copied or Modified
+        #                   (the default)
         # --find-renames=100%: renamed files that had a slight change would be
         #                      considered modified and thus included.
         # -m: show differences for merge commits ...
@@ -81,13 +83,13 @@ class GitChangedInHead:
             'show',
             'HEAD',
             '--name-only',
-            '--diff-filter=ACM',
+            '--diff-filter=%s' % self.diff_filter,
             '--find-renames=100%',
             '-m',
             '--first-parent',
             '--format=format:',
         ]
-        out = subprocess.check_output(cmd, cwd=self.cwd).decode()
+        out = quibble.process.check_output(cmd, cwd=self.cwd).decode()
         for line in out.splitlines():
             # If matching on file extensions, filter that out
             if self.path_args and not line.endswith(tuple(self.path_args)):
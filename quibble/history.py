@@ -0,0 +1,269 @@
+"""
+History of PHPUnit runs used to balance shards
+
+Durations of each test class are collected from the JUnit files written by
+PHPUnit. Shards are then packed using the longest processing time first
+heuristic: the slowest classes are assigned first, each one to the shard
+having the least work so far. The classes of a shard are matched by the
+prefix filters of quibble.phpunit.class_filters.
+
+The list of test classes only depends on the code, it is cached under a key
+derived from the git trees of MediaWiki core, extensions and skins.
+
+Tests which failed are remembered per project so that the next runs start
+with them, see TestOrder.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import heapq
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+import quibble.manifest
+import quibble.phpunit
+import quibble.store
+
+log = logging.getLogger(__name__)
+
+# Assumed duration of a test class never seen before, in seconds
+DEFAULT_DURATION = 1.0
+
+# Failed tests remembered for each project and kind of tests
+MAX_FAILURES = 50
+
+
+def junit_durations(junit_file):
+    """Sum up the time spent in each test class of a JUnit file"""
+    durations = {}
+    for testcase in ET.parse(junit_file).getroot().iter('testcase'):
+        name = testcase.get('class')
+        if name is None:
+            continue
+        durations[name] = durations.get(name, 0.0) + float(
+            testcase.get('time', 0)
+        )
+    return durations
+
+
+def junit_failures(junit_file):
+    """
+    Test classes of a JUnit file which had a failure or an error, and those
+    which passed.
+    """
+    failed = set()
+    passed = set()
+    for testcase in ET.parse(junit_file).getroot().iter('testcase'):
+        name = testcase.get('class')
+        if name is None:
+            continue
+        if any(child.tag in ('failure', 'error') for child in testcase):
+            failed.add(name)
+        else:
+            passed.add(name)
+    return (failed, passed - failed)
+
+
+def pack(classes, durations, count):
+    """
+    Split classes in at most count shards with similar total durations.
+
+    Classes lacking a duration are assumed to take as long as the median of
+    known durations.
+    """
+    known = [durations[c] for c in classes if c in durations]
+    default = statistics.median(known) if known else DEFAULT_DURATION
+
+    # (total duration, index, classes) so ties are broken by shard index
+    shards = [(0.0, index, []) for index in range(count)]
+    heapq.heapify(shards)
+    for name in sorted(classes, key=lambda c: (-durations.get(c, default), c)):
+        total, index, shard = heapq.heappop(shards)
+        shard.append(name)
+        heapq.heappush(
+            shards, (total + durations.get(name, default), index, shard)
+        )
+
+    return [
+        shard for (_, _, shard) in sorted(shards, key=lambda s: s[1]) if shard
+    ]
+
+
+def test_list_key(cmd, mw_install_path):
+    """Key identifying the test classes a PHPUnit command would list"""
+    key = {
+        'cmd': cmd,
+        'trees': quibble.manifest.mediawiki_heads(
+            mw_install_path, 'HEAD^{tree}'
+        ),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class History:
+    def __init__(self, cache_dir, max_size, project=None):
+        """
+        project: project under test, failures are remembered per project
+        """
+        self.cache_dir = cache_dir
+        self.project = project
+        self.durations_file = os.path.join(cache_dir, 'phpunit-durations.json')
+        self.failures_file = os.path.join(cache_dir, 'test-failures.json')
+        self.test_lists = quibble.store.TreeStore(
+            os.path.join(cache_dir, 'phpunit-tests'), max_size
+        )
+
+    @contextlib.contextmanager
+    def _lock(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.durations_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self, path=None):
+        path = path or self.durations_file
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            log.warning('Ignoring corrupted %s: %s', path, e)
+            return {}
+
+    def _save(self, data, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=0, sort_keys=True)
+        os.replace(tmp, path)
+
+    def durations(self):
+        with self._lock():
+            return self._load()
+
+    def record(self, junit_file):
+        """Remember the durations of the test classes of a JUnit file"""
+        try:
+            durations = junit_durations(junit_file)
+        except (OSError, ET.ParseError) as e:
+            log.warning('Can not read durations from %s: %s', junit_file, e)
+            return
+
+        with self._lock():
+            history = self._load()
+            history.update(durations)
+            self._save(history, self.durations_file)
+        log.debug('Recorded durations of %s test classes', len(durations))
+
+    def record_failures(self, kind, failed, passed):
+        """
+        Remember the tests of a kind (eg: 'phpunit') which failed for the
+        project and forget those which passed.
+        """
+        now = time.time()
+        with self._lock():
+            history = self._load(self.failures_file)
+            project = history.setdefault(self.project or '', {})
+            tests = project.get(kind, {})
+            for name in passed:
+                tests.pop(name, None)
+            for name in failed:
+                tests[name] = now
+            # Only keep the most recent ones
+            recent = sorted(tests, key=lambda name: -tests[name])
+            project[kind] = {
+                name: tests[name] for name in recent[:MAX_FAILURES]
+            }
+            self._save(history, self.failures_file)
+        if failed:
+            log.debug('Recorded %s failed %s tests', len(failed), kind)
+
+    def recent_failures(self, kind):
+        """Tests of a kind which failed for the project, most recent first"""
+        with self._lock():
+            tests = (
+                self._load(self.failures_file)
+                .get(self.project or '', {})
+                .get(kind, {})
+            )
+        return sorted(tests, key=lambda name: (-tests[name], name))
+
+    def pack(self, classes, count):
+        return pack(classes, self.durations(), count)
+
+    def test_classes(self, key, list_classes):
+        """
+        Test classes cached under key, else listed by calling list_classes
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            cached = os.path.join(tmp, 'tests')
+            if self.test_lists.get(key, cached):
+                with open(os.path.join(cached, 'classes.json')) as f:
+                    return json.load(f)
+
+            classes = list_classes()
+            os.mkdir(cached)
+            with open(os.path.join(cached, 'classes.json'), 'w') as f:
+                json.dump(classes, f)
+            self.test_lists.put(key, cached)
+            return classes
+
+
+class TestOrder:
+    """
+    Run first the tests that recently failed, then those of the project
+    under test.
+    """
+
+    def __init__(self, history, project_dir=None):
+        """
+        history: History remembering the failures
+        project_dir: directory of the project under test, None to not run
+        its tests first (eg: for mediawiki/core)
+        """
+        self.history = history
+        self.project_dir = project_dir
+
+    def first(self, classes):
+        """PHPUnit test classes among classes to run first"""
+        listed = set(classes)
+        failed = [
+            c for c in self.history.recent_failures('phpunit') if c in listed
+        ]
+        project = []
+        if self.project_dir:
+            project = quibble.phpunit.project_test_classes(
+                classes, self.project_dir
+            )
+        return failed + [c for c in project if c not in failed]
+
+    def record(self, junit_file):
+        try:
+            failed, passed = junit_failures(junit_file)
+        except (OSError, ET.ParseError) as e:
+            log.warning('Can not read failures from %s: %s', junit_file, e)
+            return
+        self.history.record_failures('phpunit', failed, passed)
+
+    def projects(self, projects):
+        """Order projects whose browser tests recently failed first"""
+        failed = [
+            p for p in self.history.recent_failures('browser') if p in projects
+        ]
+        return failed + [p for p in projects if p not in failed]
+
+    def record_project(self, project, passed):
+        """Remember whether the browser tests of a project passed"""
+        if passed:
+            self.history.record_failures('browser', [], [project])
+        else:
+            self.history.record_failures('browser', [project], [])
@@ -0,0 +1,225 @@
+"""
+Test classes affected by a change
+
+An index of the PHPUnit test classes covering each source file is built from
+the XML coverage report written by `phpunit --coverage-xml`. It is kept per
+repository in the cache directory, paths being relative to the repository.
+
+The files changed by the commit under test are then looked up in the index
+to run the tests they affect first, or only them.
+"""
+
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+from quibble.gitchangedinhead import GitChangedInHead
+
+log = logging.getLogger(__name__)
+
+
+def _tag(element):
+    # Strip the XML namespace
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _test_class(test):
+    """Class of a test such as 'FooTest::testBar with data set #0'"""
+    return test.split('::', 1)[0]
+
+
+def coverage_tests(coverage_dir):
+    """
+    Read a PHPUnit XML coverage report.
+
+    Returns a tuple: a dict of absolute source paths to the set of test
+    classes covering them, and the set of test classes that have been run.
+    """
+    index = ET.parse(os.path.join(coverage_dir, 'index.xml')).getroot()
+    source = None
+    classes_run = set()
+    for element in index.iter():
+        if _tag(element) == 'project':
+            source = element.get('source')
+        elif _tag(element) == 'test':
+            classes_run.add(_test_class(element.get('name')))
+    if source is None:
+        raise Exception('No project source in %s/index.xml' % coverage_dir)
+
+    covering = {}
+    for report in glob.glob(
+        os.path.join(coverage_dir, '**', '*.xml'), recursive=True
+    ):
+        if os.path.basename(report) == 'index.xml':
+            continue
+        for element in ET.parse(report).getroot():
+            if _tag(element) != 'file':
+                continue
+            path = os.path.normpath(
+                '%s/%s/%s'
+                % (source, element.get('path', ''), element.get('name'))
+            )
+            tests = {
+                _test_class(covered.get('by'))
+                for covered in element.iter()
+                if _tag(covered) == 'covered'
+            }
+            if tests:
+                covering[path] = tests
+    return (covering, classes_run)
+
+
+def split_repo(path):
+    """
+    Split a path relative to MediaWiki in the directory of the repository
+    holding it and the path in that repository.
+    """
+    parts = path.split('/')
+    if parts[0] in ('extensions', 'skins') and len(parts) > 2:
+        return ('/'.join(parts[:2]), '/'.join(parts[2:]))
+    if parts[0] == 'vendor' and len(parts) > 1:
+        return ('vendor', '/'.join(parts[1:]))
+    return ('.', path)
+
+
+class ImpactIndex:
+    """Test classes covering each source file of repositories"""
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'phpunit-impact')
+
+    def _file(self, repo):
+        return os.path.join(
+            self.path, '%s.json' % urllib.parse.quote(repo, safe='')
+        )
+
+    @contextlib.contextmanager
+    def _lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self, repo):
+        try:
+            with open(self._file(repo)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            log.warning('Ignoring corrupted %s: %s', self._file(repo), e)
+            return {}
+
+    def get(self, repo):
+        """
+        repo: directory of the repository relatively to MediaWiki
+
+        Returns a dict of files of the repository to the list of test
+        classes covering them.
+        """
+        with self._lock():
+            return self._load(repo)
+
+    def record(self, coverage_dir, mw_install_path):
+        """
+        Update the index from a PHPUnit XML coverage report
+
+        What is known about the test classes that have been run is replaced,
+        other test classes are kept.
+        """
+        covering, classes_run = coverage_tests(coverage_dir)
+
+        repos = {}
+        for path, tests in covering.items():
+            relpath = os.path.relpath(path, mw_install_path)
+            if relpath.startswith('..'):
+                continue
+            repo, filename = split_repo(relpath)
+            repos.setdefault(repo, {})[filename] = tests
+
+        with self._lock():
+            # Tests that have been run may no longer cover repositories
+            for name in os.listdir(self.path):
+                if name.endswith('.json'):
+                    repos.setdefault(urllib.parse.unquote(name[:-5]), {})
+
+            for repo, files in repos.items():
+                index = {}
+                for filename, tests in self._load(repo).items():
+                    kept = set(tests) - classes_run
+                    if kept:
+                        index[filename] = kept
+                for filename, tests in files.items():
+                    index.setdefault(filename, set()).update(tests)
+
+                tmp = self._file(repo) + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(
+                        {k: sorted(v) for k, v in index.items()},
+                        f,
+                        indent=0,
+                        sort_keys=True,
+                    )
+                os.replace(tmp, self._file(repo))
+        log.info(
+            'Recorded coverage of %s test classes in %s repositories',
+            len(classes_run),
+            len(repos),
+        )
+
+
+class Impact:
+    def __init__(self, index, mw_install_path, repo, only=False):
+        """
+        index: ImpactIndex
+        mw_install_path: root dir of MediaWiki
+        repo: directory of the repository under test relatively to MediaWiki
+        only: whether tests not affected by the change can be skipped
+        """
+        self.index = index
+        self.mw_install_path = mw_install_path
+        self.repo = repo
+        self.only = only
+
+    def _changed_files(self):
+        # Deleted files affect the tests which covered them
+        return GitChangedInHead(
+            [],
+            cwd=os.path.join(self.mw_install_path, self.repo),
+            diff_filter='ACDMR',
+        ).changedFiles()
+
+    def affected(self, classes):
+        """
+        Test classes among classes affected by the change.
+
+        Returns a tuple: the affected classes and whether every changed
+        file is known to the index. When it is not, the change might affect
+        other tests.
+        """
+        changed = self._changed_files()
+        index = self.index.get(self.repo)
+        by_name = {c.rsplit('\\', 1)[-1]: c for c in classes}
+
+        affected = set()
+        complete = bool(changed)
+        for filename in changed:
+            # The test class defined by a changed test file
+            name = os.path.basename(filename)
+            if name.endswith('Test.php') and name[:-4] in by_name:
+                affected.add(by_name[name[:-4]])
+            elif filename in index:
+                affected.update(index[filename])
+            else:
+                log.debug('No test known to cover %s', filename)
+                complete = False
+
+        return ([c for c in classes if c in affected], complete)
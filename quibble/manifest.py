@@ -0,0 +1,118 @@
+"""
+Remember the inputs of the steps of a previous run
+
+Used by --incremental to skip steps which would produce the same result.
+The manifest is kept in the .git directory of mediawiki/core, which survives
+the cleanup of the working tree and goes away when it is cloned again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+
+import quibble.process
+
+log = logging.getLogger(__name__)
+
+
+class Manifest:
+    def __init__(self, mw_install_path):
+        self.path = os.path.join(
+            mw_install_path, '.git', 'quibble-manifest.json'
+        )
+        self._steps = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._steps is not None:
+            return
+        try:
+            with open(self.path) as f:
+                self._steps = json.load(f)
+            log.debug('Loaded manifest %s', self.path)
+        except FileNotFoundError:
+            self._steps = {}
+        except ValueError as e:
+            log.warning('Ignoring corrupted manifest %s: %s', self.path, e)
+            self._steps = {}
+
+    def _save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            log.warning('Can not save manifest to %s', self.path)
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._steps, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def unchanged(self, step, inputs):
+        with self._lock:
+            self._load()
+            return self._steps.get(step) == inputs
+
+    def record(self, step, inputs):
+        with self._lock:
+            self._load()
+            # Round trip through JSON so tuples compare equal to lists
+            self._steps[step] = json.loads(json.dumps(inputs))
+            self._save()
+
+    def forget(self, step=None):
+        """Forget a step, or every steps when none is given"""
+        with self._lock:
+            self._load()
+            if step is None:
+                self._steps.clear()
+            else:
+                self._steps.pop(step, None)
+            self._save()
+
+
+def file_digest(path):
+    """SHA-256 of a file content, None if it does not exist"""
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def git_head(path, rev='HEAD'):
+    """
+    Object a revision resolves to in a git repository, by default the commit
+    checked out. None if there is none.
+    """
+    if not os.path.exists(os.path.join(path, '.git')):
+        return None
+    try:
+        return (
+            quibble.process.check_output(
+                ['git', 'rev-parse', '--verify', '--quiet', rev],
+                cwd=path,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except subprocess.CalledProcessError:
+        return None
+
+
+def mediawiki_heads(mw_install_path, rev='HEAD'):
+    """Commits checked out for mediawiki/core, extensions and skins"""
+    heads = {'.': git_head(mw_install_path, rev)}
+    for top in ['extensions', 'skins']:
+        top_dir = os.path.join(mw_install_path, top)
+        if not os.path.isdir(top_dir):
+            continue
+        for name in sorted(os.listdir(top_dir)):
+            head = git_head(os.path.join(top_dir, name), rev)
+            if head is not None:
+                heads[os.path.join(top, name)] = head
+    return heads
@@ -15,7 +15,8 @@
 
 import logging
 import os
-import subprocess
+
+import quibble.process
 
 
 def update(args, mwdir=None):
@@ -30,10 +31,9 @@ def update(args, mwdir=None):
     if mwdir is not None:
         update_env['MW_INSTALL_PATH'] = mwdir
 
-    p = subprocess.Popen(cmd, cwd=mwdir, env=update_env)
-    p.communicate()
-    if p.returncode > 0:
-        raise Exception('Update failed with exit code: %s' % p.returncode)
+    returncode = quibble.process.call(cmd, cwd=mwdir, env=update_env)
+    if returncode > 0:
+        raise Exception('Update failed with exit code: %s' % returncode)
 
 
 def install(args, mwdir=None):
@@ -57,10 +57,9 @@ def install(args, mwdir=None):
     # LANG is passed to $wgShellLocale
     install_env.update({'LANG': 'C.UTF-8'})
 
-    p = subprocess.Popen(cmd, cwd=mwdir, env=install_env)
-    p.communicate()
-    if p.returncode > 0:
-        raise Exception('Install failed with exit code: %s' % p.returncode)
+    returncode = quibble.process.call(cmd, cwd=mwdir, env=install_env)
+    if returncode > 0:
+        raise Exception('Install failed with exit code: %s' % returncode)
 
 
 def rebuildLocalisationCache(lang=['en'], mwdir=None):
@@ -69,10 +68,8 @@ def rebuildLocalisationCache(lang=['en'], mwdir=None):
     cmd.extend(['--lang', ','.join(lang)])
     log.info(' '.join(cmd))
 
-    p = subprocess.Popen(cmd, cwd=mwdir)
-    p.communicate()
-    if p.returncode > 0:
+    returncode = quibble.process.call(cmd, cwd=mwdir)
+    if returncode > 0:
         raise Exception(
-            'rebuildLocalisationCache failed with exit code: %s'
-            % (p.returncode)
+            'rebuildLocalisationCache failed with exit code: %s' % (returncode)
         )
@@ -1,7 +1,15 @@
 # https://www.mediawiki.org/wiki/Manual:Extension_registration
 
+import contextlib
+import fcntl
 import json
+import logging
 import os.path
+import subprocess
+
+import quibble.process
+
+log = logging.getLogger(__name__)
 
 
 def from_path(path):
@@ -25,6 +33,126 @@ def from_path(path):
         return ExtensionRegistration(skin_json)
 
 
+def _parse_batch(output, contents=True):
+    """
+    Objects written by `git cat-file --batch`, or `--batch-check` when
+    contents is False: a tuple of their name and content, None for missing
+    ones. The content is None with `--batch-check`.
+    """
+    objects = []
+    pos = 0
+    while pos < len(output):
+        end = output.index(b'\n', pos)
+        header = output[pos:end].split(b' ')
+        pos = end + 1
+        if header[-1] == b'missing':
+            objects.append(None)
+            continue
+        if not contents:
+            objects.append((header[0].decode(), None))
+            continue
+        size = int(header[2])
+        objects.append((header[0].decode(), output[pos : pos + size]))
+        # Content is followed by a newline
+        pos += size + 1
+    return objects
+
+
+def _registration(repo, revs, contents=True):
+    """
+    Registration file at the first of revs found in repo, looked up with a
+    single `git cat-file --batch`. Registration files are small, reading
+    those of every revision is cheaper than spawning another process. When
+    contents is False, only their blob is resolved with `--batch-check`.
+
+    Returns a tuple (found, blob, content). blob and content are None when
+    there is no registration file, content is None when contents is False.
+    """
+    query = ''.join(
+        '%s^{commit}\n%s:extension.json\n%s:skin.json\n' % (rev, rev, rev)
+        for rev in revs
+    )
+    objects = _parse_batch(
+        quibble.process.run(
+            ['git', 'cat-file', '--batch' if contents else '--batch-check'],
+            input=query.encode(),
+            stdout=subprocess.PIPE,
+            cwd=repo,
+            check=True,
+        ).stdout,
+        contents,
+    )
+    for i, rev in enumerate(revs):
+        commit, ext_json, skin_json = objects[3 * i : 3 * i + 3]
+        if commit is None:
+            continue
+        if ext_json is not None and skin_json is not None:
+            raise Exception(
+                'Found both extension.json and skin.json in %s at %s'
+                % (repo, rev)
+            )
+        registration = ext_json or skin_json
+        if registration is None:
+            return (True, None, None)
+        return (True,) + registration
+    return (False, None, None)
+
+
+def requires_from_git(repos, cache=None):
+    """
+    Requirements of many projects read from git repositories.
+
+    repos: dict of project names to a tuple (repository, revisions), the
+    first revision found in the repository is used.
+    cache: RequiresCache. The registration files are then only resolved to
+    their blob, the content is read for the blobs it does not know about.
+
+    Returns a dict of project names to their set of requirements. Projects
+    having none of the revisions, or whose repository can not be read, are
+    omitted.
+    """
+    blobs = {}
+    contents = {}
+    for project, (repo, revs) in sorted(repos.items()):
+        try:
+            found, blob, content = _registration(
+                repo, revs, contents=cache is None
+            )
+        except subprocess.CalledProcessError as e:
+            log.debug('Can not read %s: %s', repo, e)
+            continue
+        if found:
+            blobs[project] = blob
+            contents[project] = content
+
+    cached = {}
+    if cache is not None:
+        cached = cache.get(
+            [(project, blob) for project, blob in blobs.items() if blob]
+        )
+
+    requires = {}
+    parsed = {}
+    for project, blob in sorted(blobs.items()):
+        if blob is None:
+            requires[project] = set()
+        elif (project, blob) in cached:
+            requires[project] = cached[(project, blob)]
+        else:
+            content = contents[project]
+            if content is None:
+                content = quibble.process.check_output(
+                    ['git', 'cat-file', 'blob', blob],
+                    cwd=repos[project][0],
+                )
+            requires[project] = _parse(json.loads(content.decode()))
+            parsed[(project, blob)] = requires[project]
+
+    if cache is not None and parsed:
+        cache.put(parsed)
+    return requires
+
+
 def _read(json_file):
     with open(json_file) as f:
         return json.load(f)
@@ -45,13 +173,80 @@ def _parse(reg_data):
 
 
 class ExtensionRegistration:
-    def __init__(self, json_file=''):
-        self._raw_json = None
+    def __init__(self, json_file='', raw_json=None):
+        self._raw_json = raw_json
         self._requires = set()
-        if not json_file:
-            return
-        self._raw_json = _read(json_file)
-        self._requires = _parse(self._raw_json)
+        if json_file:
+            self._raw_json = _read(json_file)
+        if self._raw_json is not None:
+            self._requires = _parse(self._raw_json)
 
     def getRequiredRepos(self):
         return self._requires
+
+
+class RequiresCache:
+    """
+    Requirements of extensions and skins keyed on the project and the blob
+    of its registration file.
+
+    Held in a single JSON file so that many projects are looked up at once.
+    It is shared by the runs on a host.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, 'registry-requires.json')
+
+    @contextlib.contextmanager
+    def _lock(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            log.warning('Ignoring corrupted %s: %s', self.path, e)
+            return {}
+
+    @staticmethod
+    def _key(project, blob):
+        return '%s %s' % (project, blob)
+
+    def get(self, keys):
+        """
+        keys: list of (project, blob) tuples
+
+        Returns a dict of the known keys to their set of requirements.
+        """
+        with self._lock():
+            entries = self._load()
+        found = {}
+        for key in keys:
+            requires = entries.get(self._key(*key))
+            if requires is not None:
+                found[key] = set(requires)
+        return found
+
+    def put(self, requires):
+        """
+        requires: dict of (project, blob) tuples to set of requirements
+        """
+        with self._lock():
+            entries = self._load()
+            for key, deps in requires.items():
+                entries[self._key(*key)] = sorted(deps)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(entries, f, indent=0, sort_keys=True)
+            os.replace(tmp, self.path)
+        log.debug('Cached requirements of %s projects', len(requires))
@@ -0,0 +1,182 @@
+"""
+Helpers to split a PHPUnit run in shards
+"""
+
+import itertools
+import logging
+import os
+import re
+import tempfile
+import xml.etree.ElementTree as ET
+
+import quibble.process
+
+log = logging.getLogger(__name__)
+
+# Filters are compiled by PCRE which limits patterns to 64 KiB, a command line
+# argument is limited to 128 KiB.
+MAX_FILTER_LENGTH = 32 * 1024
+
+# Attributes of a JUnit <testsuite> holding counters
+_JUNIT_COUNTERS = [
+    'tests',
+    'assertions',
+    'errors',
+    'warnings',
+    'failures',
+    'skipped',
+]
+
+
+def list_test_classes(cmd, cwd, env):
+    """
+    Names of the test classes PHPUnit would run.
+
+    cmd: PHPUnit command with its options
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        listing = os.path.join(tmp, 'tests.xml')
+        quibble.process.check_call(
+            cmd + ['--list-tests-xml', listing], cwd=cwd, env=env
+        )
+        tree = ET.parse(listing)
+
+    return sorted(
+        {node.get('name') for node in tree.getroot().iter('testCaseClass')}
+    )
+
+
+def project_test_classes(classes, project_dir):
+    """
+    Test classes among classes defined in the tests of a project. Test files
+    are expected to be named after the class they define.
+    """
+    names = set()
+    for dirpath, dirnames, filenames in os.walk(
+        os.path.join(project_dir, 'tests')
+    ):
+        names.update(f[:-4] for f in filenames if f.endswith('Test.php'))
+    return [c for c in classes if c.rsplit('\\', 1)[-1] in names]
+
+
+def split(classes, count, weights=None):
+    """
+    Split test classes in at most count shards of similar total weight.
+
+    Each shard holds consecutive classes of the sorted list, so that it can
+    be matched by a short filter (see class_filters).
+
+    weights: dict of test classes to their weight, 1 by default
+    """
+    classes = sorted(classes)
+    sizes = [1.0] * len(classes)
+    if weights:
+        sizes = [weights[c] for c in classes]
+    total = sum(sizes)
+    if total <= 0:
+        sizes = [1.0] * len(classes)
+        total = len(classes)
+
+    shards = [[] for _ in range(count)]
+    done = 0.0
+    for name, size in zip(classes, sizes):
+        # The shard holding the middle of the class
+        index = int((done + size / 2) * count / total)
+        shards[min(index, count - 1)].append(name)
+        done += size
+    return [shard for shard in shards if shard]
+
+
+def _prefixes(names, selected, depth=0):
+    """
+    Patterns matching the selected names and none of the other names.
+
+    names: sorted names sharing their first depth characters
+    """
+    chosen = sum(1 for name in names if name in selected)
+    if not chosen:
+        return []
+    if chosen == len(names):
+        return [re.escape(names[0][:depth])]
+
+    patterns = []
+    if len(names[0]) == depth:
+        # A name which is a prefix of the other ones
+        if names[0] in selected:
+            patterns.append(re.escape(names[0]) + '::')
+        names = names[1:]
+    for _, group in itertools.groupby(names, key=lambda name: name[depth]):
+        patterns.extend(_prefixes(list(group), selected, depth + 1))
+    return patterns
+
+
+def _alternatives(patterns, template):
+    """Fill template with alternations of patterns of a bounded length"""
+    filters = []
+    chunk = []
+    length = len(template)
+    for pattern in patterns:
+        if chunk and length + len(pattern) + 1 > MAX_FILTER_LENGTH:
+            filters.append(template % '|'.join(chunk))
+            chunk = []
+            length = len(template)
+        chunk.append(pattern)
+        length += len(pattern) + 1
+    if chunk:
+        filters.append(template % '|'.join(chunk))
+    return filters
+
+
+def class_filters(classes, listed):
+    """
+    Values for PHPUnit --filter to run the tests of classes.
+
+    listed: every test class PHPUnit runs without a filter
+
+    Classes are matched by the shortest prefixes telling them apart from the
+    other listed classes, or the other classes are excluded when that is
+    shorter. The patterns are split in several filters when they are too long,
+    each of them has to be run. None stands for running every test.
+    """
+    names = sorted(set(listed) | set(classes))
+    selected = set(classes)
+
+    excluded = _prefixes(names, set(names) - selected)
+    if not excluded:
+        return [None]
+    included = _prefixes(names, selected)
+    if not included:
+        return []
+
+    if sum(len(p) + 1 for p in excluded) < sum(len(p) + 1 for p in included):
+        exclusion = _alternatives(excluded, '/^(?!(?:%s))/')
+        if len(exclusion) == 1:
+            return exclusion
+    return _alternatives(included, '/^(?:%s)/')
+
+
+def merge_junit(sources, dest):
+    """
+    Merge JUnit files written by PHPUnit into a single one.
+
+    The test suites of each file are wrapped in a single suite which sums up
+    the counters.
+    """
+    merged = ET.Element('testsuite', {'name': ''})
+    totals = {counter: 0 for counter in _JUNIT_COUNTERS}
+    time = 0.0
+
+    for source in sources:
+        for suite in ET.parse(source).getroot():
+            for counter in _JUNIT_COUNTERS:
+                totals[counter] += int(suite.get(counter, 0))
+            time += float(suite.get('time', 0))
+            merged.extend(list(suite))
+
+    for counter, total in totals.items():
+        merged.set(counter, str(total))
+    merged.set('time', '%f' % time)
+
+    root = ET.Element('testsuites')
+    root.append(merged)
+    ET.ElementTree(root).write(dest, encoding='UTF-8', xml_declaration=True)
@@ -0,0 +1,396 @@
+"""
+Run subprocesses
+
+Wrappers around the subprocess module which record each child process in the
+trace (see quibble.trace) and account for the resources it consumed.
+
+Once a child has exited, and before it is reaped, we read its I/O counters
+from /proc/<pid>/io. It is then reaped with wait4() which gives the CPU times
+and peak RSS. Both include the descendants the child has waited for.
+
+Usage is attributed to the stage running in the current thread, see stage().
+
+Processes spawned by a supervised task (see Supervisor) are started in their
+own process group, so that the whole tree can be killed, and their output is
+logged prefixed by the task tag.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+
+from quibble import trace
+
+log = logging.getLogger(__name__)
+
+PIPE = subprocess.PIPE
+STDOUT = subprocess.STDOUT
+
+_local = threading.local()
+_stages = []
+_stages_lock = threading.Lock()
+
+
+class Usage:
+    fields = ['user', 'sys', 'maxrss_kb', 'read_bytes', 'write_bytes']
+
+    def __init__(
+        self, user=0.0, sys=0.0, maxrss_kb=0, read_bytes=0, write_bytes=0
+    ):
+        self.user = user
+        self.sys = sys
+        self.maxrss_kb = maxrss_kb
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    @classmethod
+    def from_child(cls, rusage, io):
+        return cls(
+            user=rusage.ru_utime,
+            sys=rusage.ru_stime,
+            # Kilobytes on Linux
+            maxrss_kb=rusage.ru_maxrss,
+            read_bytes=io.get('read_bytes', 0),
+            write_bytes=io.get('write_bytes', 0),
+        )
+
+    def add(self, other):
+        self.user += other.user
+        self.sys += other.sys
+        self.maxrss_kb = max(self.maxrss_kb, other.maxrss_kb)
+        self.read_bytes += other.read_bytes
+        self.write_bytes += other.write_bytes
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def __str__(self):
+        return (
+            'user {:.2f}s, sys {:.2f}s, max RSS {} MB, '
+            'read {} MB, written {} MB'
+        ).format(
+            self.user,
+            self.sys,
+            self.maxrss_kb // 1024,
+            self.read_bytes // (1024 * 1024),
+            self.write_bytes // (1024 * 1024),
+        )
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.usage = Usage()
+        self.processes = []
+        self._lock = threading.Lock()
+
+    def record(self, cmd, returncode, usage):
+        with self._lock:
+            self.usage.add(usage)
+            entry = {'cmd': _describe(cmd), 'returncode': returncode}
+            entry.update(usage.as_dict())
+            self.processes.append(entry)
+
+    def as_dict(self):
+        with self._lock:
+            summary = {'name': self.name, 'processes': list(self.processes)}
+            summary.update(self.usage.as_dict())
+            return summary
+
+
+@contextlib.contextmanager
+def stage(name_or_stage):
+    """
+    Attribute processes spawned by the current thread to a stage.
+
+    Accepts a stage name or an existing Stage, the latter letting worker
+    threads contribute to the stage of the thread that started them.
+    """
+    if isinstance(name_or_stage, Stage):
+        current = name_or_stage
+    else:
+        current = Stage(name_or_stage)
+        with _stages_lock:
+            _stages.append(current)
+
+    previous = getattr(_local, 'stage', None)
+    _local.stage = current
+    try:
+        yield current
+    finally:
+        _local.stage = previous
+
+
+def current_stage():
+    return getattr(_local, 'stage', None)
+
+
+def stages():
+    with _stages_lock:
+        return list(_stages)
+
+
+def reset_stages():
+    with _stages_lock:
+        del _stages[:]
+
+
+def write_usage(filename):
+    """Write the resources used by each stage as JSON"""
+    log.info('Writing resources usage to %s', filename)
+    with open(filename, 'w') as f:
+        json.dump(
+            {'stages': [s.as_dict() for s in stages()]},
+            f,
+            indent=2,
+        )
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Supervisor:
+    """
+    Keep track of the process groups spawned by supervised tasks.
+
+    cancel() terminates every group. Groups still alive after the grace
+    period are killed.
+    """
+
+    def __init__(self, grace=5):
+        self.grace = grace
+        self.cancelled = False
+        self._procs = set()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def register(self, proc):
+        with self._lock:
+            if not self.cancelled:
+                self._procs.add(proc)
+                return
+        # Spawned while we were cancelling
+        _signal_group(proc, signal.SIGKILL)
+
+    def unregister(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            for proc in self._procs:
+                _signal_group(proc, signal.SIGTERM)
+        self._timer = threading.Timer(self.grace, self._kill)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _kill(self):
+        with self._lock:
+            for proc in self._procs:
+                log.warning('Killing process group %s', proc.pid)
+                _signal_group(proc, signal.SIGKILL)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+def _signal_group(proc, signum):
+    try:
+        os.killpg(proc.pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+@contextlib.contextmanager
+def task(tag, supervisor):
+    """
+    Run processes spawned by the current thread under a supervisor, their
+    output being logged prefixed with tag.
+    """
+    previous = getattr(_local, 'task', None)
+    _local.task = (tag, supervisor)
+    try:
+        yield
+    finally:
+        _local.task = previous
+
+
+def _describe(cmd):
+    if isinstance(cmd, str):
+        return cmd
+    return ' '.join(cmd)
+
+
+@contextlib.contextmanager
+def span(cmd, cwd=None):
+    """Record a subprocess span for the wrapped block"""
+    description = _describe(cmd)
+    args = {'cmd': description}
+    if cwd is not None:
+        args['cwd'] = cwd
+    name = description
+    if len(name) > 80:
+        name = name[:77] + '...'
+    with trace.span(name, 'subprocess', **args) as span_args:
+        yield span_args
+
+
+def _read_io(pid):
+    counters = {}
+    try:
+        with open('/proc/%s/io' % pid) as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        # Not on Linux or not permitted
+        pass
+    return counters
+
+
+def _exitcode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait(proc):
+    """
+    Wait for a process started with subprocess.Popen, reap it and return
+    its exit code and resources Usage.
+    """
+    try:
+        io = {}
+        if hasattr(os, 'waitid'):
+            # Wait without reaping so /proc/<pid>/io is still readable
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+            io = _read_io(proc.pid)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except BaseException:
+        # Eg KeyboardInterrupt, do not leave the child behind
+        proc.kill()
+        proc.wait()
+        raise
+
+    proc.returncode = _exitcode(status)
+    return (proc.returncode, Usage.from_child(rusage, io))
+
+
+def _drain(stream, chunks):
+    chunks.append(stream.read())
+    stream.close()
+
+
+def _relay(stream, tag):
+    for line in stream:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        log.info('[%s] %s', tag, line.rstrip('\n'))
+    stream.close()
+
+
+def _feed(stream, data):
+    # The process may exit without reading all of its input, flushing on
+    # close then fails as well.
+    try:
+        stream.write(data)
+    except BrokenPipeError:
+        pass
+    try:
+        stream.close()
+    except BrokenPipeError:
+        pass
+
+
+def run(cmd, input=None, check=False, **kwargs):
+    """
+    Similar to subprocess.run().
+
+    Returns a subprocess.CompletedProcess, raises CalledProcessError when
+    check is set and the command failed.
+    """
+    if input is not None:
+        kwargs['stdin'] = PIPE
+
+    tag, supervisor = getattr(_local, 'task', (None, None))
+    relay = False
+    if supervisor is not None:
+        if supervisor.cancelled:
+            raise Cancelled('Not running %s: cancelled' % _describe(cmd))
+        kwargs['start_new_session'] = True
+        if 'stdout' not in kwargs:
+            relay = True
+            kwargs['stdout'] = PIPE
+            kwargs.setdefault('stderr', STDOUT)
+
+    with span(cmd, kwargs.get('cwd')) as span_args:
+        proc = subprocess.Popen(cmd, **kwargs)
+        if supervisor is not None:
+            supervisor.register(proc)
+
+        threads = []
+        outputs = {}
+        if relay:
+            threads.append(
+                threading.Thread(target=_relay, args=(proc.stdout, tag))
+            )
+        for name in ['stdout', 'stderr']:
+            stream = getattr(proc, name)
+            if stream is not None and not (relay and name == 'stdout'):
+                outputs[name] = []
+                threads.append(
+                    threading.Thread(
+                        target=_drain, args=(stream, outputs[name])
+                    )
+                )
+        if input is not None:
+            threads.append(
+                threading.Thread(target=_feed, args=(proc.stdin, input))
+            )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        try:
+            returncode, usage = wait(proc)
+        finally:
+            if supervisor is not None:
+                supervisor.unregister(proc)
+        span_args['returncode'] = returncode
+        span_args.update(usage.as_dict())
+
+    current = current_stage()
+    if current is not None:
+        current.record(cmd, returncode, usage)
+    log.debug('%s: %s', _describe(cmd), usage)
+
+    stdout = outputs.get('stdout', [None])[0]
+    stderr = outputs.get('stderr', [None])[0]
+    if check and returncode:
+        raise subprocess.CalledProcessError(
+            returncode, cmd, output=stdout, stderr=stderr
+        )
+    return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+
+
+def call(cmd, **kwargs):
+    return run(cmd, **kwargs).returncode
+
+
+def check_call(cmd, **kwargs):
+    run(cmd, check=True, **kwargs)
+    return 0
+
+
+def check_output(cmd, **kwargs):
+    return run(cmd, stdout=PIPE, check=True, **kwargs).stdout
@@ -0,0 +1,180 @@
+"""
+Local store of directory trees
+
+Trees are stored under a key, usually a hash of whatever determines their
+content. They are restored with hard links when the destination is on the
+same filesystem, else copied.
+
+Stored files are made read-only: a restored file shares its inode with the
+store and writing to it in place would alter the stored tree. Replacing or
+deleting restored files is fine. Trees that are changed in place once
+restored are copied instead, as writable files.
+
+The store is shared between concurrent runs. Restoring holds a shared lock,
+adding and evicting trees hold an exclusive one. The least recently used
+trees are evicted once the store exceeds its size budget.
+"""
+
+import contextlib
+import fcntl
+import logging
+import os
+import re
+import shutil
+import stat
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+def parse_size(size):
+    """
+    Convert a size such as '500M' or '5G' to bytes.
+    """
+    match = re.fullmatch(r'(\d+)([KMG]?)', size.strip().upper())
+    if not match:
+        raise ValueError('Invalid size: %s' % size)
+    number, unit = match.groups()
+    return int(number) * 1024 ** ' KMG'.index(unit or ' ')
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(
+        '~/.cache'
+    )
+    return os.path.join(cache_home, 'quibble')
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _copy_writable(src, dst):
+    shutil.copy2(src, dst, follow_symlinks=False)
+    mode = os.lstat(dst).st_mode
+    if stat.S_ISREG(mode):
+        os.chmod(dst, mode | stat.S_IWUSR)
+
+
+def _tree_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+def _make_read_only(path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            mode = os.lstat(filename).st_mode
+            if stat.S_ISREG(mode):
+                os.chmod(
+                    filename,
+                    mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH),
+                )
+
+
+class TreeStore:
+    def __init__(self, path, max_size):
+        """
+        path: directory holding the trees, created when first used
+        max_size: size budget in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+
+    @contextlib.contextmanager
+    def _lock(self, operation):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, dest, link=True):
+        """
+        Restore the tree stored under key to dest, replacing it.
+
+        link: whether files may be hard linked to the store, they are then
+        read-only. Else they are copied as writable files.
+
+        Returns whether the key was found.
+        """
+        entry = self._entry(key)
+        with self._lock(fcntl.LOCK_SH):
+            if not os.path.isdir(entry):
+                log.info('Cache miss for %s (%s)', dest, key)
+                return False
+
+            log.info('Cache hit for %s (%s)', dest, key)
+            if os.path.islink(dest):
+                os.unlink(dest)
+            elif os.path.exists(dest):
+                shutil.rmtree(dest)
+            shutil.copytree(
+                os.path.join(entry, 'tree'),
+                dest,
+                symlinks=True,
+                copy_function=_link_or_copy if link else _copy_writable,
+            )
+            # Mark as recently used
+            os.utime(entry)
+        return True
+
+    def put(self, key, src):
+        """
+        Copy the tree at src to the store under key.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+        try:
+            shutil.copytree(src, os.path.join(tmp, 'tree'), symlinks=True)
+            _make_read_only(os.path.join(tmp, 'tree'))
+            with open(os.path.join(tmp, 'size'), 'w') as f:
+                f.write(str(_tree_size(os.path.join(tmp, 'tree'))))
+
+            with self._lock(fcntl.LOCK_EX):
+                entry = self._entry(key)
+                if os.path.exists(entry):
+                    log.debug('Already stored: %s', key)
+                else:
+                    log.info('Storing %s as %s', src, key)
+                    os.rename(tmp, entry)
+                self._evict()
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            entry = self._entry(name)
+            try:
+                with open(os.path.join(entry, 'size')) as f:
+                    size = int(f.read())
+                entries.append((os.stat(entry).st_mtime, size, name))
+            except (OSError, ValueError):
+                log.warning('Ignoring invalid cache entry %s', entry)
+        return sorted(entries)
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for (_, size, _) in entries)
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+            log.info('Evicting %s from %s', name, self.path)
+            shutil.rmtree(self._entry(name))
+            total -= size
@@ -0,0 +1,111 @@
+"""
+Record spans of execution to a trace file
+
+The trace uses the Chrome trace event format and can be loaded in
+chrome://tracing or https://ui.perfetto.dev/ . Spans recorded by a thread are
+nested by the viewer based on their start time and duration.
+
+Format reference:
+https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_tracer = None
+
+
+class Tracer:
+    def __init__(self):
+        self.pid = os.getpid()
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category, args=None):
+        args = dict(args or {})
+        thread = threading.current_thread()
+        start = time.time()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = repr(e)
+            raise
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                self._threads[thread.ident] = thread.name
+                self._events.append(
+                    {
+                        'name': name,
+                        'cat': category,
+                        'ph': 'X',
+                        'ts': int(start * 1e6),
+                        'dur': int(duration * 1e6),
+                        'pid': self.pid,
+                        'tid': thread.ident,
+                        'args': args,
+                    }
+                )
+
+    def events(self):
+        with self._lock:
+            metadata = [
+                {
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': self.pid,
+                    'tid': tid,
+                    'args': {'name': name},
+                }
+                for (tid, name) in sorted(self._threads.items())
+            ]
+            return metadata + sorted(self._events, key=lambda e: e['ts'])
+
+    def write(self, filename):
+        log.info('Writing trace to %s', filename)
+        with open(filename, 'w') as f:
+            json.dump(
+                {'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f
+            )
+
+
+def start():
+    """Start recording spans"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop(filename=None):
+    """Stop recording spans and optionally write them to filename"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None and filename is not None:
+        tracer.write(filename)
+    return tracer
+
+
+@contextlib.contextmanager
+def span(name, category='quibble', **args):
+    """
+    Record a span for the wrapped block.
+
+    Yields a dict of arguments attached to the span, which can be used to
+    record details only known once the block is executing. Does nothing when
+    tracing has not been started.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield dict(args)
+        return
+
+    with tracer.span(name, category, args) as span_args:
+        yield span_args
@@ -14,10 +14,13 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 
+import contextlib
 import logging
-from multiprocessing import Pool
+import threading
 from shutil import copyfile
 
+import quibble.process
+
 log = logging.getLogger(__name__)
 
 
@@ -26,35 +29,80 @@ def copylog(src, dest):
     copyfile(src, dest)
 
 
-def _task_wrapper(args):
-    """
-    Helper for multiprocessing.Pool.imap_unordered.
-
-    The first argument is a function to call.  Rest of the arguments are passed
-    to the function.
-    """
+def _task_tags(tasks):
+    names = [task[0].__name__.lstrip('_') for task in tasks]
+    return [
+        '%s#%s' % (name, index) if names.count(name) > 1 else name
+        for (index, name) in enumerate(names)
+    ]
 
-    func = args[0]
-    func_args = args[1:]
-    ret = func(*func_args)
 
-    if ret is None:
-        return True
-    else:
-        return ret
+def parallel_run(tasks, fail_fast=True, workers=None, tags=None):
+    """
+    Tasks is an iterable of tuples: a function to call followed by its
+    arguments. Each task is run in its own thread. With workers, at most
+    that many tasks run at the same time. Tags name the tasks in logs and
+    traces, they default to the function names.
 
+    Processes spawned by a task are started in their own process group and
+    their output is logged prefixed by the task name. With fail_fast, the
+    first failure kills the processes of the other tasks.
 
-def parallel_run(tasks):
-    """
-    Tasks is an iterable of bound functions.  The wrapper makes it easy for us
-    to run a list of different functions, rather than one function over a list
-    of inputs.
+    Raises the first exception once all tasks have finished.
     """
-    workers = max(1, len(tasks))
-    with Pool(processes=workers) as pool:
-        # As soon as any one task fails, the `all()` drops us out of the Pool's
-        # context manager, and any remaining threads are terminated.
-        return all(pool.imap_unordered(_task_wrapper, tasks))
+    tasks = list(tasks)
+    if tags is None:
+        tags = _task_tags(tasks)
+    supervisor = quibble.process.Supervisor()
+    stage = quibble.process.current_stage()
+    errors = []
+    slots = threading.BoundedSemaphore(workers) if workers else None
+
+    def worker(tag, func, args):
+        try:
+            with contextlib.ExitStack() as stack:
+                if slots is not None:
+                    stack.enter_context(slots)
+                    if supervisor.cancelled:
+                        raise quibble.process.Cancelled(
+                            'Not running %s: cancelled' % tag
+                        )
+                if stage is not None:
+                    stack.enter_context(quibble.process.stage(stage))
+                stack.enter_context(quibble.process.task(tag, supervisor))
+                func(*args)
+        except BaseException as e:
+            if not isinstance(e, quibble.process.Cancelled):
+                log.error('[%s] failed: %s', tag, e)
+            errors.append(e)
+            if fail_fast:
+                supervisor.cancel()
+
+    threads = [
+        threading.Thread(
+            target=worker, name=tag, args=(tag, task[0], task[1:])
+        )
+        for (tag, task) in zip(tags, tasks)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except BaseException:
+        # Eg KeyboardInterrupt. The process groups do not receive signals
+        # sent to the terminal foreground group.
+        supervisor.cancel()
+        for thread in threads:
+            if thread.ident is not None:
+                thread.join()
+        raise
+    finally:
+        supervisor.close()
+
+    if errors:
+        raise errors[0]
+    return True
 
 
 def isCoreOrVendor(project):
@@ -16,12 +16,18 @@
 import copy
 import logging
 import os
+import shutil
+import tempfile
 import threading
+import time
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from quibble import gitcache
+from quibble import trace
 from zuul.lib.cloner import Cloner
-from zuul.lib.clonemapper import CloneMapper
+from zuul.lib.clonemapper import CloneMapper, get_index
+from zuul.merger.merger import git_processes
 
 CLONE_MAP = [
     {'name': 'mediawiki/core', 'dest': '.'},
@@ -44,6 +50,11 @@ def clone(
     zuul_project,
     zuul_ref,
     zuul_url,
+    minimal_fetch=False,
+    clone_depth=None,
+    clone_filter=None,
+    cache_shared=False,
+    checkout_workers=None,
 ):
     log = logging.getLogger('quibble.zuul.clone')
 
@@ -72,61 +83,175 @@ def clone(
         project_branches=project_branches,
         cache_dir=cache_dir,
         zuul_newrev=zuul_newrev,
-        zuul_project=zuul_project,
+        # Without Zuul, mediawiki/core is the project being tested and
+        # keeps its full history.
+        zuul_project=zuul_project or 'mediawiki/core',
         cache_no_hardlinks=False,  # False allows hardlink
+        cache_shared=cache_shared,
+        minimal_fetch=minimal_fetch,
+        clone_depth=clone_depth,
+        clone_filter=clone_filter,
+        # Fetched repositories wait for a checkout worker while keeping their
+        # git processes, do not let them pile up.
+        max_open_repos=workers + (checkout_workers or workers),
+        span=trace.span,
+        cache_lock=gitcache.shared_lock,
     )
     # The constructor expects a file, set the value directly
     zuul_cloner.clone_map = CLONE_MAP
 
-    # Reimplement Cloner.execute() to make sure mediawiki/core is cloned first
-    # and clone the rest in parallel.
+    # Reimplement Cloner.execute() to clone in parallel
     mapper = CloneMapper(CLONE_MAP, projects)
     dests = mapper.expand(workspace=workspace)
 
+    spawned = git_processes.count
     if workers == 1:
-        return zuul_cloner.execute()
+        zuul_cloner.execute()
+        log.info("Spawned %d git processes", git_processes.count - spawned)
+        return
 
     # Reimplement the cloner execute method with parallelism and logging
     # suitable for multiplexed output.
     log.info("Preparing %d repositories with %s workers", len(dests), workers)
 
-    if 'mediawiki/core' in projects:
-        mw_git_dir = os.path.join(dests['mediawiki/core'], '.git')
-        if not os.path.exists(mw_git_dir):
-            log.info("Cloning mediawiki/core first")
-            zuul_cloner.prepareRepo('mediawiki/core', dests['mediawiki/core'])
-            del dests['mediawiki/core']
+    # Repositories nested in mediawiki/core can not be cloned before it. When
+    # core has to be cloned, clone them aside concurrently then move them in
+    # place.
+    staging_dir = None
+    staged = {}
+    if 'mediawiki/core' in dests:
+        core_dest = os.path.abspath(dests['mediawiki/core'])
+        if not os.path.exists(os.path.join(core_dest, '.git')):
+            staging_dir = tempfile.mkdtemp(
+                prefix='quibble-staging-', dir=os.path.dirname(core_dest)
+            )
+            for project, dest in list(dests.items()):
+                dest = os.path.abspath(dest)
+                if dest.startswith(core_dest + os.sep):
+                    staged_dest = os.path.join(
+                        staging_dir, os.path.relpath(dest, core_dest)
+                    )
+                    staged[staged_dest] = dest
+                    dests[project] = staged_dest
+            log.info(
+                "Cloning %d repositories aside of mediawiki/core in %s",
+                len(staged),
+                staging_dir,
+            )
+            # Start with the largest repository
+            dests.move_to_end('mediawiki/core', last=False)
 
     can_run = threading.Event()
     can_run.set()
+    timings = {'fetch': [], 'checkout': []}
+
+    try:
+        # Fetching is bound by the network and checking out by the disk, run
+        # them in separate pools. A repository is checked out as soon as it
+        # has been fetched.
+        with ThreadPoolExecutor(
+            max_workers=checkout_workers or workers
+        ) as checkout_executor:
+            checkouts = []
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(
+                        _clone_worker,
+                        can_run,
+                        zuul_cloner,
+                        project,
+                        dest,
+                        checkout_executor,
+                        timings,
+                    )
+                    for project, dest in dests.items()
+                ]
+                # Consume results
+                for future in as_completed(futures):
+                    checkout = future.result()
+                    if checkout is not None:
+                        checkouts.append(checkout)
 
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = [
-            executor.submit(_clone_worker, can_run, zuul_cloner, project, dest)
-            for project, dest in dests.items()
-        ]
-        # Consume results
-        for future in as_completed(futures):
-            future.result()
+            for future in as_completed(checkouts):
+                future.result()
 
+        for staged_dest, dest in staged.items():
+            _move_staged(staged_dest, dest)
+    finally:
+        if staging_dir:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    for phase, durations in timings.items():
+        if durations:
+            log.info(
+                "Spent %.1fs in %s of %d repositories (longest: %.1fs)",
+                sum(durations),
+                phase,
+                len(durations),
+                max(durations),
+            )
+    log.info("Spawned %d git processes", git_processes.count - spawned)
     log.info("Prepared all repositories")
 
 
-def _clone_worker(can_run, cloner, project, dest):
+def _clone_worker(can_run, cloner, project, dest, checkout_executor, timings):
+    """
+    Fetch a repository then queue its checkout to checkout_executor.
+
+    Returns the future of the checkout, None if cloning has been aborted.
+    """
     if not can_run.is_set():
-        return
+        return None
 
     # Forge a new child logger, since repositories might be cloned concurrently
     project_cloner = copy.copy(cloner)
     project_cloner.log = project_cloner.log.getChild(project)
     try:
-        project_cloner.prepareRepo(project, dest)
+        start = time.monotonic()
+        with trace.span(project, 'fetch'):
+            fetched = project_cloner.fetchRepo(project, dest)
+        timings['fetch'].append(time.monotonic() - start)
     except Exception as e:
         # Prevent other workers from executing
         can_run.clear()
         raise e
 
+    return checkout_executor.submit(
+        _checkout_worker, can_run, project_cloner, project, fetched, timings
+    )
+
+
+def _checkout_worker(can_run, cloner, project, fetched, timings):
+    if not can_run.is_set():
+        cloner.releaseRepo(fetched[1])
+        return
+
+    try:
+        start = time.monotonic()
+        with trace.span(project, 'checkout'):
+            cloner.checkoutRepo(fetched)
+        timings['checkout'].append(time.monotonic() - start)
+    except Exception as e:
+        can_run.clear()
+        raise e
+
+
+def _move_staged(staged_dest, dest):
+    if (
+        os.path.isdir(dest)
+        and not os.path.islink(dest)
+        and not os.listdir(dest)
+    ):
+        # Eg: uninitialized submodule of a mediawiki/core wmf/* branch
+        os.rmdir(dest)
+    if os.path.lexists(dest):
+        raise Exception(
+            'Can not move %s to %s: destination exists' % (staged_dest, dest)
+        )
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.rename(staged_dest, dest)
+
 
 def repo_dir(repo):
-    mapper = CloneMapper(CLONE_MAP, [repo])
-    return mapper.expand(workspace='./')[repo]
+    """Directory of a repository relatively to the MediaWiki installation"""
+    return os.path.normpath(get_index(CLONE_MAP).destination(repo))
@@ -1,5 +1,6 @@
 import json
 import os
+import tempfile
 import unittest
 from unittest import mock
 import urllib.request
@@ -35,6 +36,12 @@ class TestBackendRegistry(unittest.TestCase):
     def test_getDatabase(self):
         getDatabase('mysql', '/tmp/db', '/tmp/dump')
 
+    def test_getDatabase_persistent(self):
+        self.assertTrue(getDatabase('sqlite', None, None, True).persistent)
+        with self.assertLogs('backend.Postgres', level='WARNING'):
+            db = getDatabase('postgres', None, None, True)
+        self.assertFalse(db.persistent)
+
 
 class TestDatabaseServer(unittest.TestCase):
     @mock.patch('quibble.backend.os.makedirs')
@@ -67,6 +74,49 @@ class TestDatabaseServer(unittest.TestCase):
         self.assertEqual(os.path.join(os.getcwd(), 'data'), kwargs.get('dir'))
 
 
+class TestSQLite(unittest.TestCase):
+    def test_persistent_data_are_kept(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            db = getDatabase('sqlite', base_dir, None, persistent=True)
+            db.start()
+            db.stop()
+            self.assertEqual(
+                os.path.join(base_dir, 'quibble-sqlite'), db.rootdir
+            )
+            self.assertTrue(os.path.isdir(db.rootdir))
+
+    def test_clear_removes_databases(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            db = getDatabase('sqlite', base_dir, None, persistent=True)
+            db.start()
+            for name in ['wikidb.sqlite', 'other.txt']:
+                open(os.path.join(db.rootdir, name), 'w').close()
+
+            db.clear()
+
+            self.assertEqual(['other.txt'], os.listdir(db.rootdir))
+
+    def test_snapshot_and_restore(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            db = getDatabase('sqlite', base_dir, None)
+            db.start()
+            with open(os.path.join(db.rootdir, 'wikidb.sqlite'), 'w') as f:
+                f.write('installed')
+            open(os.path.join(db.rootdir, 'other.txt'), 'w').close()
+
+            snapshot = os.path.join(base_dir, 'snapshot')
+            db.snapshot(snapshot)
+            self.assertEqual(['wikidb.sqlite'], os.listdir(snapshot))
+
+            with open(os.path.join(db.rootdir, 'wikidb.sqlite'), 'w') as f:
+                f.write('altered')
+            db.restore(snapshot)
+
+            with open(os.path.join(db.rootdir, 'wikidb.sqlite')) as f:
+                self.assertEqual('installed', f.read())
+            db.stop()
+
+
 class TestChromeWebDriver(unittest.TestCase):
     def setUp(self):
         patcher = mock.patch(
@@ -130,6 +180,18 @@ class TestChromeWebDriver(unittest.TestCase):
         ChromeWebDriver(display=':42').start()
         self.assertEqual(os.environ['DISPLAY'], ':30')
 
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('subprocess.Popen')
+    def test_display_is_not_set_process_wide(self, mock_popen):
+        # Commands run concurrently share os.environ
+        def popen(*args, **kwargs):
+            self.assertNotIn('DISPLAY', os.environ)
+            return mock.Mock()
+
+        mock_popen.side_effect = popen
+        ChromeWebDriver(display=':42').start()
+        mock_popen.assert_called_once()
+
 
 class TestExternalWebserverEngine(unittest.TestCase):
     @mock.patch('quibble.backend.subprocess.Popen')
@@ -324,6 +324,17 @@ class CmdTest(unittest.TestCase):
             cmd.main()
         execute_command.assert_not_called()
 
+    @mock.patch('quibble.gitcache.update')
+    def test_main_dispatches_cache_update(self, mock_update):
+        with mock.patch(
+            'sys.argv',
+            ['quibble', 'cache', 'update', '--git-cache=/srv/git', 'a/b'],
+        ):
+            cmd.main()
+        mock_update.assert_called_once_with(
+            '/srv/git', ['a/b'], git_url=mock.ANY, workers=4, submodules=False
+        )
+
     @mock.patch('quibble.is_in_docker', return_value=False)
     def test_build_execution_plan_adds_ZUUL_PROJECT(self, _):
         env = {'ZUUL_PROJECT': 'mediawiki/extensions/ZuulProjectEnvVar'}
@@ -371,3 +382,50 @@ class CmdTest(unittest.TestCase):
             q.execute([])
 
         self.assertRegex(log.output[0], "DEBUG:quibble.cmd:Execution plan:")
+
+    def test_parallel_steps_defaults_to_serial(self):
+        args = cmd._parse_arguments(args=[])
+        self.assertEqual(1, args.parallel_steps)
+
+    @mock.patch('quibble.commands.execute_plan')
+    def test_execute_passes_workers(self, execute_plan):
+        cmd.QuibbleCmd().execute([], workers=4)
+        execute_plan.assert_called_once_with([], workers=4)
+
+    def test_incremental_wraps_cacheable_commands(self):
+        args = cmd._parse_arguments(args=['--incremental'])
+        plan = cmd.QuibbleCmd().build_execution_plan(args)
+
+        wrapped = [
+            c.command.__class__.__name__
+            for c in plan
+            if isinstance(c, quibble.commands.Incremental)
+        ]
+        self.assertEqual(
+            [
+                'ZuulClone',
+                'VendorComposerDependencies',
+                'InstallMediaWiki',
+                'NpmInstall',
+            ],
+            wrapped,
+        )
+
+    def test_incremental_is_off_by_default(self):
+        args = cmd._parse_arguments(args=[])
+        plan = cmd.QuibbleCmd().build_execution_plan(args)
+        self.assertFalse(
+            any(isinstance(c, quibble.commands.Incremental) for c in plan)
+        )
+
+    def test_node_modules_cache(self):
+        args = cmd._parse_arguments(
+            args=['--node-modules-cache', '--cache-dir=/cache']
+        )
+        plan = cmd.QuibbleCmd().build_execution_plan(args)
+
+        (npm_install,) = [
+            c for c in plan if isinstance(c, quibble.commands.NpmInstall)
+        ]
+        self.assertEqual('/cache/node_modules', npm_install.npm_store.path)
+        self.assertEqual(5 * 1024**3, npm_install.npm_store.max_size)
@@ -2,12 +2,18 @@
 
 import contextlib
 import logging
+import os
 import subprocess
+import tempfile
+import threading
 import unittest
 from unittest import mock
 from .util import run_sequentially
 
+import quibble.backend
 import quibble.commands
+import quibble.phpunit
+import quibble.store
 
 
 class ExtSkinSubmoduleUpdateTest(unittest.TestCase):
@@ -16,7 +22,7 @@ class ExtSkinSubmoduleUpdateTest(unittest.TestCase):
 
         with mock.patch('os.walk') as mock_walk:
             mock_walk.side_effect = self.walk_extensions
-            with mock.patch('subprocess.check_call') as mock_check_call:
+            with mock.patch('quibble.process.check_call') as mock_check_call:
                 # A git command failing aborts.
                 mock_check_call.side_effect = subprocess.CalledProcessError(
                     1, 'git something'
@@ -42,7 +48,7 @@ class ExtSkinSubmoduleUpdateTest(unittest.TestCase):
 
         with mock.patch('os.walk') as mock_walk:
             mock_walk.side_effect = self.walk_extensions
-            with mock.patch('subprocess.check_call') as mock_check_call:
+            with mock.patch('quibble.process.check_call') as mock_check_call:
                 c.execute()
 
                 mock_check_call.assert_any_call(
@@ -66,6 +72,132 @@ class ExtSkinSubmoduleUpdateTest(unittest.TestCase):
                     "Stopped after the first level directory",
                 )
 
+    def test_submodule_update_in_parallel(self):
+        c = quibble.commands.ExtSkinSubmoduleUpdate('/tmp', workers=4)
+        tasks = {}
+
+        def record_task(cmd, cwd):
+            tasks[cwd] = threading.current_thread().name
+
+        with mock.patch('os.walk') as mock_walk:
+            mock_walk.side_effect = self.walk_extensions_and_skins
+            with mock.patch('quibble.process.check_call') as mock_check_call:
+                mock_check_call.side_effect = record_task
+                with self.assertLogs('quibble.commands') as log:
+                    c.execute()
+
+        self.assertEqual(
+            {
+                '/tmp/extensions/VisualEditor': 'extensions/VisualEditor',
+                '/tmp/skins/Vector': 'skins/Vector',
+            },
+            tasks,
+        )
+
+        mock_check_call.assert_any_call(
+            [
+                'git',
+                'submodule',
+                'update',
+                '--init',
+                '--recursive',
+                '--jobs',
+                '2',
+            ],
+            cwd='/tmp/extensions/VisualEditor',
+        )
+        mock_check_call.assert_any_call(
+            ['git', 'submodule', 'status'], cwd='/tmp/skins/Vector'
+        )
+        self.assertEqual(6, mock_check_call.call_count)
+        self.assertRegex(
+            '\n'.join(log.output),
+            'Updated git submodules of /tmp/skins/Vector in',
+        )
+
+    def test_submodule_update_jobs_of_a_single_repository(self):
+        c = quibble.commands.ExtSkinSubmoduleUpdate('/tmp', workers=4)
+
+        with mock.patch('os.walk') as mock_walk:
+            mock_walk.side_effect = self.walk_extensions
+            with mock.patch('quibble.process.check_call') as mock_check_call:
+                c.execute()
+
+        mock_check_call.assert_any_call(
+            [
+                'git',
+                'submodule',
+                'update',
+                '--init',
+                '--recursive',
+                '--jobs',
+                '4',
+            ],
+            cwd='/tmp/extensions/VisualEditor',
+        )
+
+    @mock.patch(
+        'quibble.gitcache.submodule_urls',
+        return_value=[
+            'https://gerrit.wikimedia.org/r/VisualEditor/VisualEditor.git',
+            'https://gerrit.wikimedia.org/r/not/cached',
+        ],
+    )
+    @mock.patch(
+        'quibble.gitcache.cache_path',
+        side_effect=lambda cache_dir, project: (
+            '/srv/git/%s.git' % project if project != 'not/cached' else None
+        ),
+    )
+    def test_submodule_update_from_git_cache(self, *_):
+        c = quibble.commands.ExtSkinSubmoduleUpdate(
+            '/tmp', cache_dir='/srv/git'
+        )
+        update = [
+            'submodule',
+            'update',
+            '--init',
+            '--recursive',
+            '--jobs',
+            '1',
+        ]
+        from_cache = [
+            'git',
+            '-c',
+            'url./srv/git/VisualEditor/VisualEditor.git.insteadOf='
+            'https://gerrit.wikimedia.org/r/VisualEditor/VisualEditor.git',
+            '-c',
+            'protocol.file.allow=always',
+        ] + update
+
+        with mock.patch('os.walk') as mock_walk:
+            mock_walk.side_effect = self.walk_extensions
+            with mock.patch('quibble.process.check_call') as mock_check_call:
+                c.execute()
+                mock_check_call.assert_any_call(
+                    from_cache, cwd='/tmp/extensions/VisualEditor'
+                )
+                self.assertNotIn(
+                    mock.call(
+                        ['git'] + update, cwd='/tmp/extensions/VisualEditor'
+                    ),
+                    mock_check_call.call_args_list,
+                )
+
+                # Falls back to upstream when the cache lacks commits
+                mock_check_call.reset_mock()
+
+                def cache_lacks_commits(cmd, cwd):
+                    if cmd == from_cache:
+                        raise subprocess.CalledProcessError(1, cmd)
+
+                mock_check_call.side_effect = cache_lacks_commits
+                with self.assertLogs('quibble.commands', 'WARNING'):
+                    c.execute()
+                mock_check_call.assert_any_call(
+                    ['git'] + update, cwd='/tmp/extensions/VisualEditor'
+                )
+
     @staticmethod
     def walk_extensions(path):
         if path.endswith('/extensions'):
@@ -80,6 +212,15 @@ class ExtSkinSubmoduleUpdateTest(unittest.TestCase):
         else:
             return []
 
+    @classmethod
+    def walk_extensions_and_skins(cls, path):
+        if path.endswith('/skins'):
+            return [
+                ('/tmp/skins', ['Vector'], []),
+                ('/tmp/skins/Vector', [], ['.gitmodules']),
+            ]
+        return cls.walk_extensions(path)
+
 
 class CreateComposerLocalTest(unittest.TestCase):
     @mock.patch('json.dump')
@@ -104,7 +245,7 @@ class CreateComposerLocalTest(unittest.TestCase):
 class ExtSkinComposerNpmTestTest(unittest.TestCase):
     @mock.patch('quibble.commands.parallel_run', side_effect=run_sequentially)
     @mock.patch('os.path.exists', return_value=True)
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute_all(self, mock_call, *_):
         quibble.commands.ExtSkinComposerNpmTest('/tmp', True, True).execute()
 
@@ -113,7 +254,7 @@ class ExtSkinComposerNpmTestTest(unittest.TestCase):
 
     @mock.patch('os.path.exists', return_value=False)
     @mock.patch('quibble.commands.parallel_run', side_effect=run_sequentially)
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute_none(self, mock_call, *_):
         quibble.commands.ExtSkinComposerNpmTest('/tmp', True, True).execute()
 
@@ -129,7 +270,7 @@ class CoreNpmComposerTestTest(unittest.TestCase):
         'quibble.gitchangedinhead.GitChangedInHead.changedFiles',
         return_value=['foo.php', 'bar.php'],
     )
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute(self, mock_check_call, *_):
         quibble.commands.CoreNpmComposerTest('/tmp', True, True).execute()
 
@@ -146,7 +287,7 @@ class VendorComposerDependenciesTest(unittest.TestCase):
     @mock.patch('quibble.util.copylog')
     @mock.patch('builtins.open', mock.mock_open())
     @mock.patch('json.load')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute(self, mock_check_call, mock_load, *_):
         mock_load.return_value = {
             'require-dev': {
@@ -170,6 +311,95 @@ class VendorComposerDependenciesTest(unittest.TestCase):
             cwd='/tmp/vendor',
         )
 
+    @mock.patch('quibble.util.copylog')
+    @mock.patch('builtins.open', mock.mock_open())
+    @mock.patch('json.load', return_value={'require-dev': {}})
+    @mock.patch('quibble.process.check_call')
+    def test_execute_restores_from_store(self, mock_check_call, *_):
+        cmd = quibble.commands.VendorComposerDependencies(
+            '/tmp', '/log', mock.Mock()
+        )
+        with mock.patch.object(cmd, '_cache_key', return_value='key'):
+            with mock.patch.object(cmd, '_restore', return_value=True):
+                cmd.execute()
+
+        # Only the autoloader is regenerated
+        mock_check_call.assert_called_once_with(
+            ['composer', 'dump-autoload', '--optimize'], cwd='/tmp/vendor'
+        )
+
+    def test_vendor_changes_are_stored_and_restored(self):
+        def git(*args):
+            subprocess.check_call(
+                ['git', '-c', 'user.name=Q', '-c', 'user.email=q@example.org']
+                + list(args),
+                cwd=vendor_dir,
+                stdout=subprocess.DEVNULL,
+            )
+
+        def write(path, content):
+            os.makedirs(
+                os.path.dirname(os.path.join(vendor_dir, path)), exist_ok=True
+            )
+            with open(os.path.join(vendor_dir, path), 'w') as f:
+                f.write(content)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            vendor_dir = os.path.join(tmp, 'vendor')
+            os.mkdir(vendor_dir)
+            git('init', '-q')
+            write('modified', 'old')
+            write('deleted', 'content')
+            git('add', '.')
+            git('commit', '-q', '-m', 'Initial')
+
+            write('modified', 'new')
+            os.unlink(os.path.join(vendor_dir, 'deleted'))
+            write('added/file', 'added')
+
+            store = quibble.store.TreeStore(os.path.join(tmp, 'cache'), 1024)
+            cmd = quibble.commands.VendorComposerDependencies(
+                tmp, '/log', store
+            )
+            cmd._save('key', vendor_dir)
+
+            git('reset', '-q', '--hard')
+            git('clean', '-q', '-xdf')
+
+            self.assertTrue(cmd._restore('key', vendor_dir))
+
+            self.assertEqual(
+                [(' D', 'deleted'), (' M', 'modified'), ('??', 'added/file')],
+                sorted(quibble.commands._git_status(vendor_dir)),
+            )
+            with open(os.path.join(vendor_dir, 'modified')) as f:
+                self.assertEqual('new', f.read())
+
+    def test_restored_autoloader_can_be_rewritten(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            vendor_dir = os.path.join(tmp, 'vendor')
+            autoload = os.path.join(vendor_dir, 'composer/autoload_files.php')
+            os.makedirs(os.path.dirname(autoload))
+            subprocess.check_call(['git', 'init', '-q'], cwd=vendor_dir)
+            with open(autoload, 'w') as f:
+                f.write('stored')
+
+            store = quibble.store.TreeStore(os.path.join(tmp, 'cache'), 1024)
+            cmd = quibble.commands.VendorComposerDependencies(
+                tmp, '/log', store
+            )
+            cmd._save('key', vendor_dir)
+            self.assertTrue(cmd._restore('key', vendor_dir))
+
+            # As composer dump-autoload does
+            with open(autoload, 'w') as f:
+                f.write('dumped')
+
+            self.assertEqual(1, os.stat(autoload).st_nlink)
+            self.assertTrue(cmd._restore('key', vendor_dir))
+            with open(autoload) as f:
+                self.assertEqual('stored', f.read())
+
 
 class StartBackendsTest(unittest.TestCase):
     def test_execute(self):
@@ -197,7 +427,7 @@ class InstallMediaWikiTest(unittest.TestCase):
     @mock.patch('os.rename')
     @mock.patch('quibble.mediawiki.maintenance.rebuildLocalisationCache')
     @mock.patch('quibble.util.copylog')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     @mock.patch('quibble.backend.get_backend')
     @mock.patch('quibble.mediawiki.maintenance.install')
     @mock.patch('quibble.mediawiki.maintenance.update')
@@ -238,9 +468,88 @@ class InstallMediaWikiTest(unittest.TestCase):
         )
 
 
+class InstallMediaWikiSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.mw_install_path = os.path.join(tmp.name, 'src')
+        self.log_dir = os.path.join(tmp.name, 'log')
+        os.mkdir(self.mw_install_path)
+        os.mkdir(self.log_dir)
+
+        self.db = mock.MagicMock(type='sqlite', rootdir='/db/root')
+        self.db.snapshot_variables.return_value = {'rootdir': '/db/root'}
+        self.store = quibble.store.TreeStore(
+            os.path.join(tmp.name, 'cache'), 1024**2
+        )
+
+        for target in [
+            'quibble.process.check_call',
+            'quibble.mediawiki.maintenance.update',
+            'quibble.mediawiki.maintenance.rebuildLocalisationCache',
+        ]:
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def install(self, mock_install):
+        def install_php(args, mwdir):
+            with open(os.path.join(mwdir, 'LocalSettings.php'), 'w') as f:
+                f.write('$wgSQLiteDataDir = "/db/root";')
+
+        mock_install.side_effect = install_php
+        quibble.commands.InstallMediaWiki(
+            self.mw_install_path,
+            self.db,
+            'http://example.org',
+            self.log_dir,
+            '/tmp',
+            False,
+            snapshot_store=self.store,
+        ).execute()
+
+    @mock.patch('quibble.mediawiki.maintenance.install')
+    def test_snapshot_is_saved_then_restored(self, mock_install):
+        self.install(mock_install)
+        mock_install.assert_called_once()
+        self.db.snapshot.assert_called_once()
+
+        self.db.rootdir = '/other/root'
+        self.db.snapshot_variables.return_value = {'rootdir': '/other/root'}
+        mock_install.reset_mock()
+        self.install(mock_install)
+
+        mock_install.assert_not_called()
+        self.db.restore.assert_called_once()
+        quibble.mediawiki.maintenance.update.assert_called()
+        with open(
+            os.path.join(self.mw_install_path, 'LocalSettings-installer.php')
+        ) as f:
+            self.assertEqual('$wgSQLiteDataDir = "/other/root";', f.read())
+
+    @mock.patch('quibble.mediawiki.maintenance.install')
+    def test_snapshot_is_saved_before_update(self, mock_install):
+        events = []
+        self.db.snapshot.side_effect = lambda path: events.append('snapshot')
+        quibble.mediawiki.maintenance.update.side_effect = (
+            lambda args, mwdir: events.append('update')
+        )
+
+        self.install(mock_install)
+
+        self.assertEqual(['snapshot', 'update'], events)
+
+    @mock.patch('quibble.mediawiki.maintenance.install')
+    def test_backend_without_snapshot_support(self, mock_install):
+        self.db.can_snapshot = False
+        with self.assertLogs('quibble.commands', level='WARNING'):
+            self.install(mock_install)
+        self.db.snapshot.assert_not_called()
+
+
 class PhpUnitDatabaseTest(unittest.TestCase):
     @mock.patch.dict('os.environ', {'somevar': '42'}, clear=True)
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute(self, mock_check_call):
         quibble.commands.PhpUnitDatabase(
             mw_install_path='/tmp', testsuite='extensions', log_dir='/log'
@@ -265,7 +574,7 @@ class PhpUnitDatabaseTest(unittest.TestCase):
 
 
 class PhpUnitDatabaselessTest(unittest.TestCase):
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute(self, mock_check_call):
         quibble.commands.PhpUnitDatabaseless(
             mw_install_path='/tmp', testsuite='extensions', log_dir='/log'
@@ -286,10 +595,154 @@ class PhpUnitDatabaselessTest(unittest.TestCase):
             env=mock.ANY,
         )
 
+    @mock.patch('quibble.phpunit.merge_junit')
+    @mock.patch('quibble.commands.parallel_run', side_effect=run_sequentially)
+    @mock.patch(
+        'quibble.phpunit.list_test_classes',
+        return_value=['ATest', 'BTest', 'CTest'],
+    )
+    @mock.patch('quibble.process.check_call')
+    def test_execute_in_shards(self, mock_check_call, _, __, mock_merge):
+        quibble.commands.PhpUnitDatabaseless(
+            mw_install_path='/tmp',
+            testsuite='extensions',
+            log_dir='/log',
+            shards=2,
+        ).execute()
+
+        self.assertEqual(2, mock_check_call.call_count)
+        filters = [
+            c[0][0][c[0][0].index('--filter') + 1]
+            for c in mock_check_call.call_args_list
+        ]
+        self.assertEqual(['/^(?:A)/', '/^(?!(?:A))/'], filters)
+        args, kwargs = mock_merge.call_args
+        self.assertEqual('/log/junit-dbless.xml', args[1])
+
+    def run_affected(self, affected, complete, only=False):
+        impact = mock.Mock(only=only)
+        impact.affected.return_value = (affected, complete)
+        with mock.patch('quibble.phpunit.merge_junit'), mock.patch(
+            'quibble.commands.parallel_run', side_effect=run_sequentially
+        ), mock.patch(
+            'quibble.phpunit.list_test_classes',
+            return_value=['ATest', 'BTest', 'CTest'],
+        ), mock.patch(
+            'quibble.process.check_call'
+        ) as mock_check_call:
+            quibble.commands.PhpUnitDatabaseless(
+                mw_install_path='/tmp',
+                testsuite='extensions',
+                log_dir='/log',
+                impact=impact,
+            ).execute()
+
+        impact.affected.assert_called_once_with(['ATest', 'BTest', 'CTest'])
+        return [
+            c[0][0][c[0][0].index('--filter') + 1]
+            for c in mock_check_call.call_args_list
+        ]
+
+    def test_execute_affected_first(self):
+        self.assertEqual(
+            ['/^(?:B)/', '/^(?!(?:B))/'],
+            self.run_affected(['BTest'], complete=True),
+        )
+
+    def test_execute_affected_only(self):
+        self.assertEqual(
+            ['/^(?:B)/'],
+            self.run_affected(['BTest'], complete=True, only=True),
+        )
+
+    def test_execute_affected_only_runs_all_when_impact_is_unknown(self):
+        self.assertEqual(
+            ['/^(?:B)/', '/^(?!(?:B))/'],
+            self.run_affected(['BTest'], complete=False, only=True),
+        )
+
+    def test_execute_affected_first_of_many_classes(self):
+        listed = [
+            'MediaWiki\\Tests\\Component%d\\Feature%dHandler%dTest'
+            % (i % 40, i % 13, i)
+            for i in range(5000)
+        ]
+        impact = mock.Mock(only=False)
+        impact.affected.return_value = (listed[::3], True)
+        with mock.patch('quibble.phpunit.merge_junit'), mock.patch(
+            'quibble.commands.parallel_run', side_effect=run_sequentially
+        ), mock.patch(
+            'quibble.phpunit.list_test_classes', return_value=listed
+        ), mock.patch(
+            'quibble.process.check_call'
+        ) as mock_check_call:
+            quibble.commands.PhpUnitDatabaseless(
+                mw_install_path='/tmp',
+                testsuite='extensions',
+                log_dir='/log',
+                impact=impact,
+            ).execute()
+
+        for args, kwargs in mock_check_call.call_args_list:
+            for arg in args[0]:
+                self.assertLessEqual(
+                    len(arg), quibble.phpunit.MAX_FILTER_LENGTH
+                )
+        # A few runs for the affected classes, then the other ones
+        self.assertLess(mock_check_call.call_count, 10)
+
+    def run_failed_first(self, check_call_effect=None, **kwargs):
+        test_order = mock.Mock()
+        test_order.first.return_value = ['CTest']
+        with mock.patch('quibble.phpunit.merge_junit'), mock.patch(
+            'quibble.commands.parallel_run', side_effect=run_sequentially
+        ), mock.patch(
+            'quibble.phpunit.list_test_classes',
+            return_value=['ATest', 'BTest', 'CTest'],
+        ), mock.patch(
+            'quibble.process.check_call', side_effect=check_call_effect
+        ) as mock_check_call:
+            try:
+                quibble.commands.PhpUnitDatabaseless(
+                    mw_install_path='/tmp',
+                    testsuite='extensions',
+                    log_dir='/log',
+                    test_order=test_order,
+                    **kwargs
+                ).execute()
+            finally:
+                self.cmds = [c[0][0] for c in mock_check_call.call_args_list]
+
+        test_order.first.assert_called_once_with(['ATest', 'BTest', 'CTest'])
+
+    def test_execute_failed_first(self):
+        self.run_failed_first()
+
+        self.assertEqual(
+            ['/^(?:C)/', '/^(?!(?:C))/'],
+            [cmd[cmd.index('--filter') + 1] for cmd in self.cmds],
+        )
+
+    def test_execute_failed_first_runs_remaining_tests_on_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_failed_first(
+                [subprocess.CalledProcessError(1, 'phpunit'), None]
+            )
+        self.assertEqual(2, len(self.cmds))
+
+    def test_execute_stop_on_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_failed_first(
+                [subprocess.CalledProcessError(1, 'phpunit'), None],
+                stop_on_failure=True,
+            )
+        self.assertEqual(1, len(self.cmds))
+        self.assertIn('--stop-on-failure', self.cmds[0])
+
 
 class PhpUnitStandaloneTest(unittest.TestCase):
     @mock.patch.dict('os.environ', {'somevar': '42'}, clear=True)
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute(self, mock_check_call):
         quibble.commands.PhpUnitStandalone(
             mw_install_path='/tmp',
@@ -318,7 +771,7 @@ class PhpUnitStandaloneTest(unittest.TestCase):
 class PhpUnitUnitTest(unittest.TestCase):
     @mock.patch('builtins.open', mock.mock_open())
     @mock.patch('json.load')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute_no_scripts(self, mock_check_call, mock_load, *_):
         mock_load.return_value = {"requires": {}}
 
@@ -331,7 +784,7 @@ class PhpUnitUnitTest(unittest.TestCase):
     @mock.patch('os.path.exists', return_value=True)
     @mock.patch('builtins.open', mock.mock_open())
     @mock.patch('json.load')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute_has_units(self, mock_check_call, mock_load, *_):
         mock_load.return_value = {"scripts": {"phpunit:unit": {}}}
 
@@ -358,7 +811,7 @@ class QunitTestsTest(unittest.TestCase):
     @mock.patch.dict('os.environ', {'somevar': '42'}, clear=True)
     @mock.patch('quibble.backend.PhpWebserver')
     @mock.patch('quibble.is_in_docker', return_value=True)
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_execute(self, mock_check_call, *_):
         def check_env_for_no_sandbox(cmd, env={}, **_):
             assert 'CHROMIUM_FLAGS' in env
@@ -376,7 +829,7 @@ class ApiTestingTest(unittest.TestCase):
     @mock.patch('os.path.exists', return_value=True)
     @mock.patch('json.load')
     @mock.patch('json.dump')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     @mock.patch('quibble.backend.PhpWebserver')
     @mock.patch('quibble.backend.ChromeWebDriver')
     def test_project_api_testing(
@@ -405,7 +858,7 @@ class ApiTestingTest(unittest.TestCase):
     @mock.patch('builtins.open', mock.mock_open())
     @mock.patch('json.load')
     @mock.patch('json.dump')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     @mock.patch('quibble.backend.PhpWebserver')
     @mock.patch('quibble.backend.ChromeWebDriver')
     def test_project_missing_api_testing(
@@ -431,7 +884,7 @@ class ApiTestingTest(unittest.TestCase):
     @mock.patch('builtins.open', mock.mock_open())
     @mock.patch('json.load')
     @mock.patch('json.dump')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     @mock.patch('quibble.backend.PhpWebserver')
     @mock.patch('quibble.backend.ChromeWebDriver')
     def test_project_not_having_package_json(
@@ -446,11 +899,72 @@ class ApiTestingTest(unittest.TestCase):
         mock_check_call.assert_not_called()
 
 
+class ResolveRequiresTest(unittest.TestCase):
+    def registration(self, requires):
+        def from_path(path):
+            return mock.Mock(
+                **{
+                    'getRequiredRepos.return_value': set(
+                        requires.get(os.path.basename(path), [])
+                    )
+                }
+            )
+
+        return from_path
+
+    def resolve(self, on_disk, in_cache):
+        with mock.patch('quibble.commands.execute_command'), mock.patch(
+            'quibble.commands.ZuulClone'
+        ) as mock_clone, mock.patch(
+            'quibble.mediawiki.registry.from_path',
+            side_effect=self.registration(on_disk),
+        ), mock.patch(
+            'quibble.mediawiki.registry.requires_from_git',
+            side_effect=lambda repos, cache: {
+                project: set(in_cache[os.path.basename(project)])
+                for project in repos
+                if os.path.basename(project) in in_cache
+            },
+        ), mock.patch(
+            'quibble.gitcache.cache_path',
+            side_effect=lambda cache_dir, project: '/cache/%s' % project,
+        ):
+            quibble.commands.ResolveRequires(
+                mw_install_path='/tmp',
+                projects=['mediawiki/extensions/A'],
+                zuul_params={'cache_dir': '/cache'},
+            ).execute()
+        return [c[1]['projects'] for c in mock_clone.call_args_list]
+
+    def test_clones_requirements_found_in_cache_at_once(self):
+        requires = {
+            'A': ['mediawiki/extensions/B'],
+            'B': ['mediawiki/extensions/C'],
+            'C': ['mediawiki/extensions/A'],
+        }
+        self.assertEqual(
+            [{'mediawiki/extensions/B', 'mediawiki/extensions/C'}],
+            self.resolve(on_disk=requires, in_cache=requires),
+        )
+
+    def test_clones_requirements_missing_from_cache(self):
+        self.assertEqual(
+            [{'mediawiki/extensions/B'}, {'mediawiki/extensions/C'}],
+            self.resolve(
+                on_disk={
+                    'A': ['mediawiki/extensions/B'],
+                    'B': ['mediawiki/extensions/C'],
+                },
+                in_cache={},
+            ),
+        )
+
+
 class BrowserTestsTest(unittest.TestCase):
     @mock.patch('os.path.exists', return_value=True)
     @mock.patch('builtins.open', mock.mock_open())
     @mock.patch('json.load')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     @mock.patch('quibble.backend.PhpWebserver')
     @mock.patch('quibble.backend.ChromeWebDriver')
     def test_project_selenium(
@@ -485,7 +999,7 @@ class BrowserTestsTest(unittest.TestCase):
     @mock.patch('os.path.exists', return_value=True)
     @mock.patch('builtins.open', mock.mock_open())
     @mock.patch('json.load')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     @mock.patch('quibble.backend.PhpWebserver')
     @mock.patch('quibble.backend.ChromeWebDriver')
     def test_project_missing_selenium(
@@ -508,7 +1022,37 @@ class BrowserTestsTest(unittest.TestCase):
 
         mock_check_call.assert_not_called()
 
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.commands._repo_has_npm_script', return_value=True)
+    @mock.patch('quibble.commands._npm_install')
+    @mock.patch('quibble.process.check_call')
+    def test_recently_failed_project_first(self, mock_check_call, *_):
+        mock_check_call.side_effect = subprocess.CalledProcessError(1, 'npm')
+        test_order = mock.Mock()
+        test_order.projects.return_value = [
+            'mediawiki/skins/Vector',
+            'mediawiki/core',
+        ]
+
+        c = quibble.commands.BrowserTests(
+            '/tmp',
+            ['mediawiki/core', 'mediawiki/skins/Vector'],
+            ':0',
+            'http://192.0.2.1:4321',
+            test_order=test_order,
+        )
+        with self.assertRaises(subprocess.CalledProcessError):
+            c.execute()
+
+        mock_check_call.assert_called_once_with(
+            ['npm', 'run', 'selenium-test'],
+            cwd='/tmp/skins/Vector',
+            env=mock.ANY,
+        )
+        test_order.record_project.assert_called_once_with(
+            'mediawiki/skins/Vector', passed=False
+        )
+
+    @mock.patch('quibble.process.check_call')
     @mock.patch('quibble.backend.PhpWebserver')
     @mock.patch('quibble.backend.ChromeWebDriver')
     def test_project_not_having_package_json(
@@ -523,7 +1067,7 @@ class BrowserTestsTest(unittest.TestCase):
 
 class UserScriptsTest(unittest.TestCase):
     @mock.patch('quibble.backend.PhpWebserver')
-    @mock.patch('subprocess.check_call')
+    @mock.patch('quibble.process.check_call')
     def test_commands(self, mock_check_call, *_):
         quibble.commands.UserScripts('/tmp', ['true', 'false']).execute()
 
@@ -541,3 +1085,218 @@ class UserScriptsTest(unittest.TestCase):
 
         with self.assertRaises(subprocess.CalledProcessError, msg=''):
             quibble.commands.UserScripts('/tmp', ['true', 'false']).execute()
+
+
+class FakeCommand:
+    def __init__(self, name, needs=(), produces=(), fail=False):
+        self.name = name
+        self.needs = needs
+        self.produces = produces
+        self.fail = fail
+        self.executed = False
+
+    def execute(self):
+        if self.fail:
+            raise Exception('%s failed' % self.name)
+        self.executed = True
+
+    def __str__(self):
+        return self.name
+
+
+class PlanDependenciesTest(unittest.TestCase):
+    def test_independent_commands(self):
+        plan = [
+            FakeCommand('versions'),
+            FakeCommand('clone', produces=('workspace',)),
+        ]
+        self.assertEqual(
+            [set(), set()], quibble.commands.plan_dependencies(plan)
+        )
+
+    def test_needs_waits_for_producer(self):
+        plan = [
+            FakeCommand('clone', produces=('workspace',)),
+            FakeCommand('npm', needs=('workspace',), produces=('npm',)),
+            FakeCommand('unit', needs=('workspace',)),
+        ]
+        self.assertEqual(
+            [set(), {0}, {0}], quibble.commands.plan_dependencies(plan)
+        )
+
+    def test_producer_waits_for_earlier_consumers_and_producers(self):
+        plan = [
+            FakeCommand('start db', produces=('db',)),
+            FakeCommand('dbless', needs=('db',)),
+            FakeCommand('browser', needs=('db',), produces=('db',)),
+        ]
+        self.assertEqual(
+            [set(), {0}, {0, 1}], quibble.commands.plan_dependencies(plan)
+        )
+
+    def test_undeclared_command_is_a_barrier(self):
+        plan = [
+            FakeCommand('versions'),
+            quibble.commands.UserScripts('/tmp', ['true']),
+            FakeCommand('other'),
+        ]
+        self.assertEqual(
+            [set(), {0}, {1}], quibble.commands.plan_dependencies(plan)
+        )
+
+    def test_phpunit_unit_does_not_wait_for_install(self):
+        db = mock.MagicMock(spec=quibble.backend.MySQL)
+        db.needs = ()
+        db.produces = ('db',)
+        plan = [
+            quibble.commands.ZuulClone(
+                None, None, [], [], 1, '/src', None, None, None, None, None
+            ),
+            quibble.commands.VendorComposerDependencies('/src', '/log'),
+            quibble.commands.PhpUnitUnit('/src', '/log'),
+            quibble.commands.StartBackends(contextlib.ExitStack(), [db]),
+            quibble.commands.InstallMediaWiki(
+                '/src', db, 'http://example.org', '/log', '/tmp', True
+            ),
+            quibble.commands.NpmInstall('/src'),
+        ]
+        deps = quibble.commands.plan_dependencies(plan)
+        self.assertEqual({0, 1}, deps[2], 'phpunit-unit')
+        self.assertEqual(set(), deps[3], 'start backends')
+        self.assertEqual({0, 1, 3}, deps[4], 'install')
+        self.assertEqual({0}, deps[5], 'npm install')
+
+
+class ExecutePlanTest(unittest.TestCase):
+    def test_serial_execution_follows_plan_order(self):
+        order = []
+        plan = [FakeCommand('a'), FakeCommand('b')]
+        for command in plan:
+            command.execute = mock.Mock(
+                side_effect=lambda c=command: order.append(c.name)
+            )
+
+        quibble.commands.execute_plan(plan)
+
+        self.assertEqual(['a', 'b'], order)
+
+    def test_parallel_execution_runs_all_commands(self):
+        plan = [
+            FakeCommand('clone', produces=('workspace',)),
+            FakeCommand('npm', needs=('workspace',), produces=('npm',)),
+            FakeCommand('unit', needs=('workspace',)),
+            FakeCommand('qunit', needs=('npm',)),
+        ]
+        quibble.commands.execute_plan(plan, workers=3)
+
+        self.assertTrue(all(c.executed for c in plan))
+
+    def test_parallel_execution_stops_on_failure(self):
+        plan = [
+            FakeCommand('clone', produces=('workspace',), fail=True),
+            FakeCommand('unit', needs=('workspace',)),
+        ]
+        with self.assertLogs('quibble.commands', level='WARNING'):
+            with self.assertRaisesRegex(Exception, 'clone failed'):
+                quibble.commands.execute_plan(plan, workers=2)
+
+        self.assertFalse(plan[1].executed)
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.command = FakeCommand('npm', needs=('workspace',))
+        self.command.inputs = mock.Mock(return_value={'lock': 'abc'})
+        self.command.outputs = mock.Mock(return_value=[])
+        self.manifest = mock.Mock()
+
+    def test_runs_and_records_inputs_when_changed(self):
+        self.manifest.unchanged.return_value = False
+        quibble.commands.Incremental(self.command, self.manifest).execute()
+
+        self.assertTrue(self.command.executed)
+        self.manifest.forget.assert_called_once_with('FakeCommand')
+        self.manifest.record.assert_called_once_with(
+            'FakeCommand', {'lock': 'abc'}
+        )
+
+    def test_skips_when_unchanged(self):
+        self.manifest.unchanged.return_value = True
+        quibble.commands.Incremental(self.command, self.manifest).execute()
+
+        self.assertFalse(self.command.executed)
+        self.manifest.record.assert_not_called()
+
+    def test_runs_when_an_output_is_missing(self):
+        self.manifest.unchanged.return_value = True
+        self.command.outputs.return_value = ['/non/existent']
+        quibble.commands.Incremental(self.command, self.manifest).execute()
+
+        self.assertTrue(self.command.executed)
+
+    def test_runs_when_inputs_are_unknown(self):
+        self.command.inputs.return_value = None
+        quibble.commands.Incremental(self.command, self.manifest).execute()
+
+        self.assertTrue(self.command.executed)
+        self.manifest.record.assert_not_called()
+
+    def test_clears_stale_outputs_before_running(self):
+        self.manifest.unchanged.return_value = False
+        self.command.clear = mock.Mock()
+        quibble.commands.Incremental(self.command, self.manifest).execute()
+
+        self.command.clear.assert_called_once_with()
+
+    def test_reset_forgets_all_steps(self):
+        self.manifest.unchanged.return_value = False
+        quibble.commands.Incremental(
+            self.command, self.manifest, resets_workspace=True
+        ).execute()
+
+        self.manifest.forget.assert_called_once_with()
+
+    def test_forwards_resources_and_description(self):
+        incremental = quibble.commands.Incremental(self.command, self.manifest)
+        self.assertEqual(('workspace',), incremental.needs)
+        self.assertEqual((), incremental.produces)
+        self.assertEqual('npm', str(incremental))
+
+
+class NpmInstallTest(unittest.TestCase):
+    @mock.patch('quibble.commands._repo_has_npm_lock', return_value=True)
+    @mock.patch('quibble.commands._node_modules_key', return_value='key')
+    @mock.patch('quibble.process.check_call')
+    def test_restores_node_modules_from_store(self, mock_check_call, *_):
+        store = mock.Mock()
+        store.get.return_value = True
+
+        quibble.commands.NpmInstall('/src', store).execute()
+
+        store.get.assert_called_once_with(
+            'key', '/src/node_modules', link=False
+        )
+        mock_check_call.assert_not_called()
+        store.put.assert_not_called()
+
+    @mock.patch('quibble.commands._repo_has_npm_lock', return_value=True)
+    @mock.patch('quibble.commands._node_modules_key', return_value='key')
+    @mock.patch('quibble.process.check_call')
+    def test_stores_node_modules_on_miss(self, mock_check_call, *_):
+        store = mock.Mock()
+        store.get.return_value = False
+
+        quibble.commands.NpmInstall('/src', store).execute()
+
+        mock_check_call.assert_called_once_with(['npm', 'ci'], cwd='/src')
+        store.put.assert_called_once_with('key', '/src/node_modules')
+
+    @mock.patch('quibble.commands._repo_has_npm_lock', return_value=False)
+    @mock.patch('quibble.process.check_call')
+    def test_store_is_not_used_without_lock_file(self, mock_check_call, _):
+        store = mock.Mock()
+
+        quibble.commands.NpmInstall('/src', store).execute()
+
+        store.get.assert_not_called()
+        mock_check_call.assert_any_call(['npm', 'prune'], cwd='/src')
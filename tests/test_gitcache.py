@@ -0,0 +1,219 @@
+import fcntl
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import quibble.gitcache
+
+
+class GitCacheTest(unittest.TestCase):
+    def git(self, *args, cwd=None):
+        return (
+            subprocess.check_output(
+                ['git', '-c', 'user.name=Quibble', '-c', 'user.email=q@x']
+                + list(args),
+                cwd=cwd or self.upstream,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.git_url = os.path.join(tmp.name, 'upstream')
+        self.cache_dir = os.path.join(tmp.name, 'cache')
+        self.upstream = os.path.join(self.git_url, 'mediawiki/core')
+        os.makedirs(self.upstream)
+        self.git('init', '-q', '-b', 'master')
+        self.git('commit', '--allow-empty', '-q', '-m', 'initial')
+
+    def update(self, projects=None):
+        quibble.gitcache.update(
+            self.cache_dir, projects, git_url=self.git_url, workers=2
+        )
+
+    def test_clones_new_projects(self):
+        self.update(['mediawiki/core'])
+
+        cached = os.path.join(self.cache_dir, 'mediawiki/core.git')
+        self.assertEqual(
+            self.git('rev-parse', 'master'),
+            self.git('rev-parse', 'master', cwd=cached),
+        )
+        self.assertFalse(os.path.exists(cached + '.tmp'))
+
+    def test_updates_cached_projects(self):
+        self.update(['mediawiki/core'])
+        self.git('commit', '--allow-empty', '-q', '-m', 'second')
+        self.git('tag', '1.42.0')
+        self.git('branch', 'REL1_42')
+
+        self.update()
+
+        cached = os.path.join(self.cache_dir, 'mediawiki/core.git')
+        for ref in ['master', 'REL1_42', '1.42.0']:
+            self.assertEqual(
+                self.git('rev-parse', ref),
+                self.git('rev-parse', ref, cwd=cached),
+            )
+        self.assertTrue(
+            os.path.exists(os.path.join(cached, quibble.gitcache.LOCK_FILE))
+        )
+
+    def test_reports_failed_projects(self):
+        with self.assertRaisesRegex(Exception, 'Failed to update: missing'):
+            with self.assertLogs('quibble.gitcache', level='ERROR'):
+                self.update(['mediawiki/core', 'missing'])
+        self.assertIsNotNone(
+            quibble.gitcache.cache_path(self.cache_dir, 'mediawiki/core')
+        )
+
+    def test_maintenance_with_old_git(self):
+        self.update(['mediawiki/core'])
+        self.git('commit', '--allow-empty', '-q', '-m', 'second')
+
+        with mock.patch(
+            'quibble.gitcache.git_version', return_value=(2, 20, 1)
+        ):
+            self.update()
+
+        cached = quibble.gitcache.cache_path(self.cache_dir, 'mediawiki/core')
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(cached, 'objects', 'info', 'commit-graph')
+            )
+        )
+        self.assertEqual(
+            '0', self.git('count-objects', cwd=cached).split(' ')[0]
+        )
+
+    def test_fetch_does_not_collect_garbage(self):
+        self.update(['mediawiki/core'])
+        with mock.patch(
+            'quibble.process.check_call', wraps=quibble.process.check_call
+        ) as check_call:
+            self.update()
+
+        (fetch,) = [
+            c[0][0] for c in check_call.call_args_list if 'fetch' in c[0][0]
+        ]
+        self.assertIn('gc.auto=0', fetch[: fetch.index('fetch')])
+
+    def test_reports_failed_maintenance(self):
+        with mock.patch(
+            'quibble.gitcache._maintenance',
+            side_effect=subprocess.CalledProcessError(1, 'git'),
+        ):
+            with self.assertRaisesRegex(
+                Exception, 'Failed to update: mediawiki/core'
+            ):
+                with self.assertLogs('quibble.gitcache', level='ERROR'):
+                    self.update(['mediawiki/core'])
+
+    def test_git_version(self):
+        quibble.gitcache.git_version.cache_clear()
+        self.addCleanup(quibble.gitcache.git_version.cache_clear)
+        with mock.patch(
+            'quibble.process.check_output',
+            return_value=b'git version 2.20.1\n',
+        ):
+            self.assertEqual((2, 20, 1), quibble.gitcache.git_version())
+
+    def test_mirrors_submodules(self):
+        lib = os.path.join(self.git_url, 'VisualEditor/VisualEditor')
+        os.makedirs(lib)
+        self.git('init', '-q', '-b', 'master', cwd=lib)
+        self.git('commit', '--allow-empty', '-q', '-m', 'lib', cwd=lib)
+        self.git(
+            '-c',
+            'protocol.file.allow=always',
+            'submodule',
+            'add',
+            '-q',
+            lib,
+            'lib/ve',
+        )
+        self.git('commit', '-q', '-m', 'Add submodule')
+
+        quibble.gitcache.update(
+            self.cache_dir,
+            ['mediawiki/core'],
+            git_url=self.git_url,
+            submodules=True,
+        )
+
+        self.assertEqual(
+            self.git('rev-parse', 'master', cwd=lib),
+            self.git(
+                'rev-parse',
+                'master',
+                cwd=os.path.join(
+                    self.cache_dir, 'VisualEditor/VisualEditor.git'
+                ),
+            ),
+        )
+
+    def test_url_project(self):
+        for url, project in [
+            (
+                'https://gerrit.wikimedia.org/r/VisualEditor/VisualEditor.git',
+                'VisualEditor/VisualEditor',
+            ),
+            (
+                'https://github.com/wikimedia/foo.git',
+                'github.com/wikimedia/foo',
+            ),
+            ('../relative', None),
+            ('/srv/local', None),
+        ]:
+            self.assertEqual(project, quibble.gitcache.url_project(url))
+
+    def test_find_projects(self):
+        os.makedirs(os.path.join(self.cache_dir, 'mediawiki/skins/Vector'))
+        self.git(
+            'init',
+            '-q',
+            cwd=os.path.join(self.cache_dir, 'mediawiki/skins/Vector'),
+        )
+        self.update(['mediawiki/core'])
+
+        self.assertEqual(
+            ['mediawiki/core', 'mediawiki/skins/Vector'],
+            quibble.gitcache.find_projects(self.cache_dir),
+        )
+
+    def test_shared_lock_without_lock_file(self):
+        self.update(['mediawiki/core'])
+        cached = quibble.gitcache.cache_path(self.cache_dir, 'mediawiki/core')
+        os.unlink(os.path.join(cached, quibble.gitcache.LOCK_FILE))
+
+        with quibble.gitcache.shared_lock(cached):
+            self.assertFalse(
+                os.path.exists(
+                    os.path.join(cached, quibble.gitcache.LOCK_FILE)
+                )
+            )
+
+    def test_shared_lock_waits_for_maintenance(self):
+        self.update(['mediawiki/core'])
+        cached = quibble.gitcache.cache_path(self.cache_dir, 'mediawiki/core')
+        locked = threading.Event()
+
+        def read():
+            with quibble.gitcache.shared_lock(cached):
+                locked.set()
+
+        with open(os.path.join(cached, quibble.gitcache.LOCK_FILE)) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            reader = threading.Thread(target=read)
+            reader.start()
+            self.assertFalse(locked.wait(0.1))
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+        reader.join()
+        self.assertTrue(locked.is_set())
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+import quibble.process
+from quibble.gitchangedinhead import GitChangedInHead
+
+
+class GitChangedInHeadTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(quibble.process.reset_stages)
+        self.repo = tmp.name
+        for name in ['README', 'Foo.php']:
+            with open(os.path.join(self.repo, name), 'w') as f:
+                f.write(name)
+        for cmd in [
+            ['init', '-q'],
+            ['add', '.'],
+            ['commit', '-q', '-m', 'Initial'],
+        ]:
+            subprocess.check_call(
+                ['git', '-c', 'user.name=Q', '-c', 'user.email=q@x'] + cmd,
+                cwd=self.repo,
+            )
+
+    def test_changed_files(self):
+        self.assertEqual(
+            ['Foo.php'],
+            GitChangedInHead(['php'], cwd=self.repo).changedFiles(),
+        )
+
+    def test_git_is_accounted_to_the_stage(self):
+        with quibble.process.stage('lint') as stage:
+            GitChangedInHead([], cwd=self.repo).changedFiles()
+
+        (process,) = stage.processes
+        self.assertTrue(process['cmd'].startswith('git show HEAD'))
@@ -0,0 +1,214 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import quibble.history
+from quibble.history import History, junit_durations, junit_failures, pack
+
+JUNIT = '''<?xml version="1.0" encoding="UTF-8"?>
+<testsuites>
+  <testsuite name="" tests="3" time="3.5">
+    <testsuite name="FooTest" file="/src/FooTest.php" tests="2" time="3">
+      <testcase name="testOne" class="FooTest" time="1.0"/>
+      <testcase name="testTwo" class="FooTest" time="2.0"/>
+    </testsuite>
+    <testsuite name="BarTest" file="/src/BarTest.php" tests="1" time="0.5">
+      <testcase name="testBar" class="BarTest" time="0.5"/>
+    </testsuite>
+  </testsuite>
+</testsuites>
+'''
+
+JUNIT_FAILURES = '''<?xml version="1.0" encoding="UTF-8"?>
+<testsuites>
+  <testsuite name="" tests="3">
+    <testcase name="testOne" class="FooTest"><failure/></testcase>
+    <testcase name="testTwo" class="FooTest"/>
+    <testcase name="testBar" class="BarTest"/>
+    <testcase name="testBaz" class="BazTest"><error/></testcase>
+  </testsuite>
+</testsuites>
+'''
+
+
+class PackTest(unittest.TestCase):
+    def test_longest_first(self):
+        durations = {'a': 10, 'b': 6, 'c': 5, 'd': 4, 'e': 3}
+        shards = pack(sorted(durations), durations, 2)
+
+        self.assertEqual([['a', 'd'], ['b', 'c', 'e']], shards)
+        self.assertEqual(
+            [14, 14], [sum(durations[c] for c in s) for s in shards]
+        )
+
+    def test_balances_classes_regardless_of_their_order(self):
+        durations = {'a': 1, 'b': 5, 'c': 1}
+        shards = pack(sorted(durations), durations, 2)
+
+        self.assertEqual([['b'], ['a', 'c']], shards)
+
+    def test_unknown_classes_take_the_median_duration(self):
+        durations = {'a': 1, 'b': 2, 'c': 30}
+        shards = pack(['a', 'b', 'c', 'new'], durations, 2)
+
+        self.assertEqual([['c'], ['b', 'new', 'a']], shards)
+
+    def test_no_empty_shard(self):
+        self.assertEqual([['a']], pack(['a'], {}, 3))
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.junit_file = os.path.join(self.tmp, 'junit.xml')
+        with open(self.junit_file, 'w') as f:
+            f.write(JUNIT)
+
+    def test_junit_durations(self):
+        self.assertEqual(
+            {'FooTest': 3.0, 'BarTest': 0.5}, junit_durations(self.junit_file)
+        )
+
+    def test_record(self):
+        history = History(os.path.join(self.tmp, 'cache'), 1024**2)
+        self.assertEqual({}, history.durations())
+
+        history.record(self.junit_file)
+
+        self.assertEqual(
+            {'FooTest': 3.0, 'BarTest': 0.5},
+            History(os.path.join(self.tmp, 'cache'), 0).durations(),
+        )
+
+    def test_record_ignores_missing_file(self):
+        history = History(os.path.join(self.tmp, 'cache'), 1024**2)
+        with self.assertLogs('quibble.history', level='WARNING'):
+            history.record(os.path.join(self.tmp, 'missing.xml'))
+
+    def test_test_classes_are_cached(self):
+        history = History(os.path.join(self.tmp, 'cache'), 1024**2)
+        list_classes = mock.Mock(return_value=['ATest', 'BTest'])
+
+        self.assertEqual(
+            ['ATest', 'BTest'], history.test_classes('key', list_classes)
+        )
+        self.assertEqual(
+            ['ATest', 'BTest'], history.test_classes('key', list_classes)
+        )
+        list_classes.assert_called_once_with()
+
+    @mock.patch('quibble.manifest.git_head')
+    def test_test_list_key_depends_on_trees(self, mock_git_head):
+        mock_git_head.return_value = 'tree1'
+        key = quibble.history.test_list_key(['phpunit'], self.tmp)
+        mock_git_head.assert_called_with(self.tmp, 'HEAD^{tree}')
+
+        mock_git_head.return_value = 'tree2'
+        self.assertNotEqual(
+            key, quibble.history.test_list_key(['phpunit'], self.tmp)
+        )
+
+    def test_junit_failures(self):
+        junit_file = os.path.join(self.tmp, 'failures.xml')
+        with open(junit_file, 'w') as f:
+            f.write(JUNIT_FAILURES)
+
+        self.assertEqual(
+            ({'FooTest', 'BazTest'}, {'BarTest'}), junit_failures(junit_file)
+        )
+
+    @mock.patch('time.time')
+    def test_record_failures(self, mock_time):
+        cache_dir = os.path.join(self.tmp, 'cache')
+        history = History(cache_dir, 0, project='mediawiki/extensions/Foo')
+
+        mock_time.return_value = 1
+        history.record_failures('phpunit', ['ATest', 'BTest'], [])
+        mock_time.return_value = 2
+        history.record_failures('phpunit', ['CTest'], ['ATest'])
+
+        self.assertEqual(
+            ['CTest', 'BTest'], history.recent_failures('phpunit')
+        )
+        self.assertEqual([], history.recent_failures('browser'))
+        self.assertEqual(
+            [],
+            History(cache_dir, 0, project='mediawiki/core').recent_failures(
+                'phpunit'
+            ),
+        )
+
+    @mock.patch('time.time', return_value=1)
+    def test_record_failures_keeps_the_most_recent(self, mock_time):
+        history = History(os.path.join(self.tmp, 'cache'), 0)
+        history.record_failures(
+            'phpunit', ['Test%d' % i for i in range(60)], []
+        )
+        mock_time.return_value = 2
+        history.record_failures('phpunit', ['NewTest'], [])
+
+        failures = history.recent_failures('phpunit')
+        self.assertEqual(quibble.history.MAX_FAILURES, len(failures))
+        self.assertEqual('NewTest', failures[0])
+
+
+class TestOrderTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.history = History(os.path.join(self.tmp, 'cache'), 0)
+
+    def test_first(self):
+        project_dir = os.path.join(self.tmp, 'Foo')
+        os.makedirs(os.path.join(project_dir, 'tests', 'phpunit'))
+        open(
+            os.path.join(project_dir, 'tests', 'phpunit', 'FooTest.php'), 'w'
+        ).close()
+        self.history.record_failures('phpunit', ['CoreTest', 'GoneTest'], [])
+
+        order = quibble.history.TestOrder(self.history, project_dir)
+
+        self.assertEqual(
+            ['CoreTest', 'MediaWiki\\Extension\\Foo\\FooTest'],
+            order.first(
+                [
+                    'BarTest',
+                    'CoreTest',
+                    'MediaWiki\\Extension\\Foo\\FooTest',
+                ]
+            ),
+        )
+
+    def test_first_without_project(self):
+        order = quibble.history.TestOrder(self.history)
+        self.assertEqual([], order.first(['BarTest', 'CoreTest']))
+
+    def test_record(self):
+        junit_file = os.path.join(self.tmp, 'junit.xml')
+        with open(junit_file, 'w') as f:
+            f.write(JUNIT_FAILURES)
+
+        quibble.history.TestOrder(self.history).record(junit_file)
+
+        self.assertEqual(
+            {'BazTest', 'FooTest'},
+            set(self.history.recent_failures('phpunit')),
+        )
+
+    def test_projects(self):
+        order = quibble.history.TestOrder(self.history)
+        projects = ['mediawiki/core', 'mediawiki/skins/Vector']
+        self.assertEqual(projects, order.projects(projects))
+
+        order.record_project('mediawiki/skins/Vector', passed=False)
+        self.assertEqual(
+            ['mediawiki/skins/Vector', 'mediawiki/core'],
+            order.projects(projects),
+        )
+
+        order.record_project('mediawiki/skins/Vector', passed=True)
+        self.assertEqual(projects, order.projects(projects))
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from quibble.impact import Impact, ImpactIndex, coverage_tests, split_repo
+
+INDEX = '''<?xml version="1.0"?>
+<phpunit xmlns="https://schema.phpunit.de/coverage/1.0">
+  <project source="/src">
+    <tests>
+      <test name="FooTest::testFoo" size="unknown" result="0" status="PASSED"/>
+      <test name="BarTest::testBar with data set #0" size="unknown"
+            result="0" status="PASSED"/>
+    </tests>
+  </project>
+</phpunit>
+'''
+
+REPORT = '''<?xml version="1.0"?>
+<phpunit xmlns="https://schema.phpunit.de/coverage/1.0">
+  <file name="%s" path="%s">
+    <coverage>
+      <line nr="10">%s</line>
+    </coverage>
+  </file>
+</phpunit>
+'''
+
+
+def covered_by(*tests):
+    return ''.join('<covered by="%s"/>' % t for t in tests)
+
+
+class ImpactTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.coverage_dir = os.path.join(self.tmp, 'coverage')
+        os.makedirs(os.path.join(self.coverage_dir, 'extensions/Foo'))
+        with open(os.path.join(self.coverage_dir, 'index.xml'), 'w') as f:
+            f.write(INDEX)
+        self.report('Setup.php', '/includes', covered_by('FooTest::testFoo'))
+        self.report(
+            'extensions/Foo/Hooks.php',
+            '/extensions/Foo',
+            covered_by(
+                'FooTest::testFoo', 'BarTest::testBar with data set #0'
+            ),
+        )
+        self.report('Unused.php', '/includes', '')
+
+    def report(self, name, path, covered):
+        with open(os.path.join(self.coverage_dir, '%s.xml' % name), 'w') as f:
+            f.write(REPORT % (os.path.basename(name), path, covered))
+
+
+class CoverageTest(ImpactTestCase):
+    def test_coverage_tests(self):
+        self.assertEqual(
+            (
+                {
+                    '/src/includes/Setup.php': {'FooTest'},
+                    '/src/extensions/Foo/Hooks.php': {'FooTest', 'BarTest'},
+                },
+                {'FooTest', 'BarTest'},
+            ),
+            coverage_tests(self.coverage_dir),
+        )
+
+    def test_split_repo(self):
+        self.assertEqual(
+            ('.', 'includes/Setup.php'), split_repo('includes/Setup.php')
+        )
+        self.assertEqual(
+            ('extensions/Foo', 'Hooks.php'),
+            split_repo('extensions/Foo/Hooks.php'),
+        )
+        self.assertEqual(
+            ('vendor', 'composer/a.php'), split_repo('vendor/composer/a.php')
+        )
+
+
+class ImpactIndexTest(ImpactTestCase):
+    def test_record(self):
+        index = ImpactIndex(os.path.join(self.tmp, 'cache'))
+        index.record(self.coverage_dir, '/src')
+
+        self.assertEqual({'includes/Setup.php': ['FooTest']}, index.get('.'))
+        self.assertEqual(
+            {'Hooks.php': ['BarTest', 'FooTest']}, index.get('extensions/Foo')
+        )
+        self.assertEqual({}, index.get('extensions/Bar'))
+
+    def test_record_replaces_tests_that_have_been_run(self):
+        index = ImpactIndex(os.path.join(self.tmp, 'cache'))
+        index.record(self.coverage_dir, '/src')
+
+        # FooTest no more covers Setup.php, BazTest has not been run again
+        self.report('Setup.php', '/includes', '')
+        self.report('Old.php', '/includes', covered_by('BazTest::testBaz'))
+        with open(os.path.join(self.coverage_dir, 'index.xml'), 'w') as f:
+            f.write(INDEX.replace('FooTest::testFoo', 'BazTest::testBaz'))
+        index.record(self.coverage_dir, '/src')
+        self.report('Old.php', '/includes', '')
+        with open(os.path.join(self.coverage_dir, 'index.xml'), 'w') as f:
+            f.write(INDEX)
+        index.record(self.coverage_dir, '/src')
+
+        self.assertEqual({'includes/Old.php': ['BazTest']}, index.get('.'))
+
+
+class ImpactTest(ImpactTestCase):
+    def affected(self, changed, classes):
+        index = ImpactIndex(os.path.join(self.tmp, 'cache'))
+        index.record(self.coverage_dir, '/src')
+        impact = Impact(index, '/src', 'extensions/Foo')
+        with mock.patch('quibble.impact.GitChangedInHead') as mock_changed:
+            mock_changed().changedFiles.return_value = changed
+            return impact.affected(classes)
+
+    def test_covered_files(self):
+        self.assertEqual(
+            (['BarTest', 'FooTest'], True),
+            self.affected(['Hooks.php'], ['BarTest', 'BazTest', 'FooTest']),
+        )
+
+    def test_changed_test_files(self):
+        self.assertEqual(
+            (['MediaWiki\\Extension\\Foo\\BazTest'], True),
+            self.affected(
+                ['tests/phpunit/BazTest.php'],
+                ['FooTest', 'MediaWiki\\Extension\\Foo\\BazTest'],
+            ),
+        )
+
+    def test_unknown_files(self):
+        self.assertEqual(
+            (['FooTest'], False),
+            self.affected(['Hooks.php', 'extension.json'], ['FooTest']),
+        )
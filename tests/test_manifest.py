@@ -0,0 +1,75 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+from quibble.manifest import Manifest, file_digest, git_head
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        os.mkdir(os.path.join(self.tmp.name, '.git'))
+
+    def test_unknown_step_is_changed(self):
+        self.assertFalse(Manifest(self.tmp.name).unchanged('step', {}))
+
+    def test_recorded_inputs_are_persisted(self):
+        Manifest(self.tmp.name).record('step', {'heads': ('abc',)})
+
+        manifest = Manifest(self.tmp.name)
+        self.assertTrue(manifest.unchanged('step', {'heads': ['abc']}))
+        self.assertFalse(manifest.unchanged('step', {'heads': ['def']}))
+
+    def test_forget(self):
+        manifest = Manifest(self.tmp.name)
+        manifest.record('one', 1)
+        manifest.record('two', 2)
+
+        manifest.forget('one')
+        self.assertFalse(Manifest(self.tmp.name).unchanged('one', 1))
+        self.assertTrue(Manifest(self.tmp.name).unchanged('two', 2))
+
+        manifest.forget()
+        self.assertFalse(Manifest(self.tmp.name).unchanged('two', 2))
+
+    def test_corrupted_manifest_is_ignored(self):
+        manifest = Manifest(self.tmp.name)
+        with open(manifest.path, 'w') as f:
+            f.write('{')
+        with self.assertLogs('quibble.manifest', level='WARNING'):
+            self.assertFalse(manifest.unchanged('step', 1))
+
+    def test_file_digest(self):
+        path = os.path.join(self.tmp.name, 'file')
+        self.assertIsNone(file_digest(path))
+        with open(path, 'w') as f:
+            f.write('content')
+        self.assertEqual(
+            'ed7002b439e9ac845f22357d822bac14'
+            '44730fbdb6016d3ec9432297b9ec9f73',
+            file_digest(path),
+        )
+
+    def test_git_head(self):
+        with tempfile.TemporaryDirectory() as repo:
+            self.assertIsNone(git_head(repo))
+            subprocess.check_call(['git', 'init', '-q', repo])
+            self.assertIsNone(git_head(repo), 'Repository without commit')
+            subprocess.check_call(
+                [
+                    'git',
+                    '-c',
+                    'user.name=Quibble',
+                    '-c',
+                    'user.email=quibble@example.org',
+                    'commit',
+                    '-q',
+                    '--allow-empty',
+                    '-m',
+                    'Empty',
+                ],
+                cwd=repo,
+            )
+            self.assertRegex(git_head(repo), '^[0-9a-f]{40}$')
@@ -1,4 +1,6 @@
 import os.path
+import subprocess
+import tempfile
 import unittest
 from unittest import mock
 
@@ -96,3 +98,148 @@ class TestMediaWikiExtensionRegistration(unittest.TestCase):
             'mediawiki/skins/FakeSkin',
         }
         self.assertSetEqual(expected, reg.getRequiredRepos())
+
+
+class TestRequiresFromGit(unittest.TestCase):
+    def git(self, repo, *args):
+        subprocess.check_call(
+            ['git', '-c', 'user.name=Quibble', '-c', 'user.email=q@x']
+            + list(args),
+            cwd=repo,
+            stdout=subprocess.DEVNULL,
+        )
+
+    def make_repo(self, name, files):
+        repo = os.path.join(self.tmp, name)
+        os.makedirs(repo)
+        self.git(repo, 'init', '-q', '-b', 'master')
+        for filename, content in files.items():
+            with open(os.path.join(repo, filename), 'w') as f:
+                f.write(content)
+            self.git(repo, 'add', filename)
+        self.git(repo, 'commit', '-q', '--allow-empty', '-m', 'files')
+        return repo
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.repos = {
+            'mediawiki/extensions/Foo': (
+                self.make_repo(
+                    'Foo',
+                    {
+                        'extension.json': '{"requires": '
+                        '{"skins": {"Vector": "*"}}}'
+                    },
+                ),
+                ['REL1_42', 'master'],
+            ),
+            'mediawiki/skins/Vector': (
+                self.make_repo('Vector', {'skin.json': '{}'}),
+                ['master'],
+            ),
+            'mediawiki/extensions/Empty': (
+                self.make_repo('Empty', {}),
+                ['master'],
+            ),
+            'mediawiki/extensions/Missing': (
+                self.make_repo('Missing', {}),
+                ['REL1_42'],
+            ),
+        }
+
+    def test_reads_first_revision_found(self):
+        self.assertDictEqual(
+            {
+                'mediawiki/extensions/Foo': {'mediawiki/skins/Vector'},
+                'mediawiki/skins/Vector': set(),
+                'mediawiki/extensions/Empty': set(),
+            },
+            quibble.mediawiki.registry.requires_from_git(self.repos),
+        )
+
+    def test_reads_a_repository_with_a_single_process(self):
+        with mock.patch(
+            'quibble.process.run', wraps=quibble.process.run
+        ) as run:
+            quibble.mediawiki.registry.requires_from_git(self.repos)
+        self.assertEqual(len(self.repos), run.call_count)
+
+    def test_bails_out_on_both_ext_and_skin_files(self):
+        repo = self.make_repo(
+            'Both', {'extension.json': '{}', 'skin.json': '{}'}
+        )
+        with self.assertRaisesRegex(Exception, 'Found both'):
+            quibble.mediawiki.registry.requires_from_git(
+                {'mediawiki/extensions/Both': (repo, ['master'])}
+            )
+
+    def test_omits_unreadable_repositories(self):
+        self.assertDictEqual(
+            {},
+            quibble.mediawiki.registry.requires_from_git(
+                {'mediawiki/extensions/Foo': (self.tmp, ['master'])}
+            ),
+        )
+
+    def test_cache(self):
+        cache = quibble.mediawiki.registry.RequiresCache(
+            os.path.join(self.tmp, 'cache')
+        )
+        expected = quibble.mediawiki.registry.requires_from_git(
+            self.repos, cache
+        )
+        self.assertDictEqual(
+            quibble.mediawiki.registry.requires_from_git(self.repos),
+            expected,
+        )
+
+        with mock.patch('quibble.mediawiki.registry._parse') as parse:
+            with mock.patch(
+                'quibble.process.run', wraps=quibble.process.run
+            ) as run:
+                self.assertDictEqual(
+                    expected,
+                    quibble.mediawiki.registry.requires_from_git(
+                        self.repos, cache
+                    ),
+                )
+            parse.assert_not_called()
+        # Registration files known to the cache are not read
+        self.assertEqual(len(self.repos), run.call_count)
+        for args, kwargs in run.call_args_list:
+            self.assertEqual(['git', 'cat-file', '--batch-check'], args[0])
+
+        # A different registration file is read again
+        foo = self.repos['mediawiki/extensions/Foo'][0]
+        with open(os.path.join(foo, 'extension.json'), 'w') as f:
+            f.write('{}')
+        self.git(foo, 'commit', '-q', '-a', '-m', 'No more requirements')
+        self.assertSetEqual(
+            set(),
+            quibble.mediawiki.registry.requires_from_git(self.repos, cache)[
+                'mediawiki/extensions/Foo'
+            ],
+        )
+
+
+class TestRequiresCache(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = quibble.mediawiki.registry.RequiresCache(tmp.name)
+
+    def test_get_and_put(self):
+        self.assertDictEqual({}, self.cache.get([('Foo', 'abc')]))
+        self.cache.put({('Foo', 'abc'): {'Bar', 'Baz'}, ('Bar', 'def'): set()})
+        self.assertDictEqual(
+            {('Foo', 'abc'): {'Bar', 'Baz'}, ('Bar', 'def'): set()},
+            self.cache.get([('Foo', 'abc'), ('Foo', 'def'), ('Bar', 'def')]),
+        )
+
+    def test_ignores_corrupted_file(self):
+        with open(self.cache.path, 'w') as f:
+            f.write('{')
+        with self.assertLogs('quibble.mediawiki.registry', 'WARNING'):
+            self.assertDictEqual({}, self.cache.get([('Foo', 'abc')]))
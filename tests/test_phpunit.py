@@ -0,0 +1,156 @@
+import os
+import re
+import tempfile
+import unittest
+from unittest import mock
+import xml.etree.ElementTree as ET
+
+import quibble.phpunit
+
+LISTING = '''<?xml version="1.0"?>
+<tests>
+ <testCaseClass name="FooTest">
+  <testCaseMethod name="testOne" groups="default"/>
+  <testCaseMethod name="testTwo" groups="default"/>
+ </testCaseClass>
+ <testCaseClass name="Wikibase\\Repo\\BarTest">
+  <testCaseMethod name="testBar" groups="Wikibase"/>
+ </testCaseClass>
+</tests>
+'''
+
+JUNIT = '''<?xml version="1.0" encoding="UTF-8"?>
+<testsuites>
+  <testsuite name="" tests="{tests}" assertions="3" errors="0" warnings="0"
+    failures="{failures}" skipped="0" time="{time}">
+    <testsuite name="{name}" tests="{tests}" time="{time}">
+      <testcase name="testOne" class="{name}" time="{time}"/>
+    </testsuite>
+  </testsuite>
+</testsuites>
+'''
+
+
+class PhpUnitTest(unittest.TestCase):
+    @mock.patch('quibble.process.check_call')
+    def test_list_test_classes(self, mock_check_call):
+        def list_tests(cmd, **kwargs):
+            with open(cmd[-1], 'w') as f:
+                f.write(LISTING)
+
+        mock_check_call.side_effect = list_tests
+
+        classes = quibble.phpunit.list_test_classes(
+            ['phpunit', '--testsuite', 'extensions'], '/src', {}
+        )
+
+        self.assertEqual(['FooTest', 'Wikibase\\Repo\\BarTest'], classes)
+        args, kwargs = mock_check_call.call_args
+        self.assertEqual(
+            ['phpunit', '--testsuite', 'extensions', '--list-tests-xml'],
+            args[0][:-1],
+        )
+
+    def test_split(self):
+        self.assertEqual(
+            [['a', 'b'], ['c', 'd', 'e']],
+            quibble.phpunit.split(['e', 'd', 'c', 'b', 'a'], 2),
+        )
+
+    def test_split_by_weights(self):
+        self.assertEqual(
+            [['a'], ['b', 'c', 'd']],
+            quibble.phpunit.split(
+                ['a', 'b', 'c', 'd'], 2, {'a': 3, 'b': 1, 'c': 1, 'd': 1}
+            ),
+        )
+
+    def test_split_drops_empty_shards(self):
+        self.assertEqual([['a']], quibble.phpunit.split(['a'], 4))
+
+    def assertFiltersMatch(self, classes, listed, filters):
+        matched = set()
+        for pcre in filters:
+            if pcre is None:
+                matched.update(listed)
+                continue
+            self.assertLessEqual(
+                len(pcre), quibble.phpunit.MAX_FILTER_LENGTH, pcre[:100]
+            )
+            regex = re.compile(pcre[1:-1])
+            matched.update(c for c in listed if regex.match(c + '::testOne'))
+        self.assertEqual(set(classes), matched)
+
+    def test_class_filters(self):
+        listed = [
+            'FooTest',
+            'FooTestCase',
+            'FooBarTest',
+            'Wikibase\\BarTest',
+            'Wikibase\\BazTest',
+        ]
+        for classes in [
+            ['FooTest'],
+            ['FooTestCase'],
+            ['FooTest', 'Wikibase\\BazTest'],
+            ['FooBarTest', 'Wikibase\\BarTest', 'Wikibase\\BazTest'],
+        ]:
+            filters = quibble.phpunit.class_filters(classes, listed)
+            self.assertEqual(1, len(filters))
+            self.assertFiltersMatch(classes, listed, filters)
+
+        self.assertEqual(
+            ['/^(?:W)/'],
+            quibble.phpunit.class_filters(
+                ['Wikibase\\BarTest', 'Wikibase\\BazTest'], listed
+            ),
+        )
+        self.assertEqual([None], quibble.phpunit.class_filters(listed, listed))
+        self.assertEqual([], quibble.phpunit.class_filters([], listed))
+
+    def test_class_filters_of_many_classes(self):
+        listed = sorted(
+            'MediaWiki\\Tests\\Component%d\\Feature%dHandler%dTest'
+            % (i % 40, i % 13, i)
+            for i in range(5000)
+        )
+
+        for count in [1, 2, 4, 8]:
+            for shard in quibble.phpunit.split(listed, count):
+                filters = quibble.phpunit.class_filters(shard, listed)
+                self.assertEqual(1, len(filters))
+                self.assertFiltersMatch(shard, listed, filters)
+
+        # Classes which do not share prefixes
+        every_other = listed[::2]
+        self.assertFiltersMatch(
+            every_other,
+            listed,
+            quibble.phpunit.class_filters(every_other, listed),
+        )
+
+    def test_merge_junit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sources = []
+            for index, name in enumerate(['FooTest', 'BarTest']):
+                source = os.path.join(tmp, '%s.xml' % index)
+                with open(source, 'w') as f:
+                    f.write(
+                        JUNIT.format(
+                            name=name, tests=2, failures=index, time=1.5
+                        )
+                    )
+                sources.append(source)
+
+            dest = os.path.join(tmp, 'junit.xml')
+            quibble.phpunit.merge_junit(sources, dest)
+            root = ET.parse(dest).getroot()
+
+        (merged,) = list(root)
+        self.assertEqual('4', merged.get('tests'))
+        self.assertEqual('6', merged.get('assertions'))
+        self.assertEqual('1', merged.get('failures'))
+        self.assertEqual(3.0, float(merged.get('time')))
+        self.assertEqual(
+            ['FooTest', 'BarTest'], [s.get('name') for s in merged]
+        )
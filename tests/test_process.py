@@ -0,0 +1,88 @@
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import quibble.process
+
+
+class ProcessTest(unittest.TestCase):
+    def tearDown(self):
+        quibble.process.reset_stages()
+
+    def test_usage_is_recorded_to_current_stage(self):
+        with quibble.process.stage('some stage') as stage:
+            quibble.process.check_call(
+                ['dd', 'if=/dev/zero', 'of=/dev/null', 'count=1'],
+                stderr=subprocess.DEVNULL,
+            )
+
+        self.assertEqual([stage], quibble.process.stages())
+        (process,) = stage.processes
+        self.assertEqual(
+            'dd if=/dev/zero of=/dev/null count=1', process['cmd']
+        )
+        self.assertEqual(0, process['returncode'])
+        self.assertGreater(process['maxrss_kb'], 0)
+        self.assertEqual(process['maxrss_kb'], stage.usage.maxrss_kb)
+
+    def test_processes_outside_a_stage_are_not_recorded(self):
+        quibble.process.check_call(['true'])
+        self.assertEqual([], quibble.process.stages())
+
+    def test_stage_can_be_shared_with_another_thread(self):
+        with quibble.process.stage('parent') as parent:
+            with quibble.process.stage(parent):
+                quibble.process.call(['true'])
+            self.assertIs(parent, quibble.process.current_stage())
+        self.assertEqual(1, len(parent.processes))
+        self.assertEqual([parent], quibble.process.stages())
+
+    def test_check_output(self):
+        self.assertEqual(
+            b'hello\n', quibble.process.check_output(['echo', 'hello'])
+        )
+
+    def test_input_is_fed_to_the_process(self):
+        p = quibble.process.run(
+            ['cat'],
+            input='some input',
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        self.assertEqual('some input', p.stdout)
+
+    def test_input_not_read_by_the_process_is_dropped(self):
+        stream = mock.Mock()
+        stream.write.side_effect = BrokenPipeError
+        stream.close.side_effect = BrokenPipeError
+
+        quibble.process._feed(stream, 'some input')
+
+        stream.close.assert_called_once_with()
+
+    def test_check_call_raises_on_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            quibble.process.check_call(['false'])
+        self.assertEqual(1, cm.exception.returncode)
+
+    def test_call_returns_exit_code(self):
+        self.assertEqual(1, quibble.process.call(['false']))
+
+    def test_write_usage(self):
+        with quibble.process.stage('some stage'):
+            quibble.process.call(['true'])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'resources.json')
+            quibble.process.write_usage(filename)
+            with open(filename) as f:
+                usage = json.load(f)
+
+        (stage,) = usage['stages']
+        self.assertEqual('some stage', stage['name'])
+        self.assertEqual(['true'], [p['cmd'] for p in stage['processes']])
+        for field in quibble.process.Usage.fields:
+            self.assertIn(field, stage)
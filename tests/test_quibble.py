@@ -51,6 +51,10 @@ class QuibbleTest(unittest.TestCase):
             'Use headless mode when DISPLAY is not set',
         )
 
+    @mock.patch.dict(os.environ, clear=True)
+    def test_use_headless__given_env(self):
+        self.assertEqual(False, quibble.use_headless({'DISPLAY': ':42'}))
+
     @mock.patch('quibble.is_in_docker', return_value=True)
     def test_chrome_in_docker_does_not_use_sandbox(self, mock):
         self.assertIn('--no-sandbox', quibble.chromium_flags())
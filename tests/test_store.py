@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from quibble.store import TreeStore, default_cache_dir, parse_size
+
+
+class TreeStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = TreeStore(os.path.join(self.tmp.name, 'store'), 1024)
+
+    def make_tree(self, name, content='content'):
+        tree = os.path.join(self.tmp.name, name)
+        os.makedirs(os.path.join(tree, 'sub'))
+        with open(os.path.join(tree, 'sub', 'file'), 'w') as f:
+            f.write(content)
+        os.symlink('sub/file', os.path.join(tree, 'link'))
+        return tree
+
+    def test_get_unknown_key(self):
+        dest = os.path.join(self.tmp.name, 'dest')
+        self.assertFalse(self.store.get('unknown', dest))
+        self.assertFalse(os.path.exists(dest))
+
+    def test_put_then_get(self):
+        self.store.put('key', self.make_tree('src'))
+
+        dest = self.make_tree('dest', content='stale')
+        self.assertTrue(self.store.get('key', dest))
+
+        with open(os.path.join(dest, 'sub', 'file')) as f:
+            self.assertEqual('content', f.read())
+        self.assertEqual('sub/file', os.readlink(os.path.join(dest, 'link')))
+
+    def test_stored_files_are_read_only(self):
+        self.store.put('key', self.make_tree('src'))
+        dest = os.path.join(self.tmp.name, 'dest')
+        self.store.get('key', dest)
+
+        self.assertFalse(
+            os.stat(os.path.join(dest, 'sub', 'file')).st_mode & 0o222
+        )
+
+    def test_get_copies_writable_files_without_link(self):
+        self.store.put('key', self.make_tree('src'))
+        dest = os.path.join(self.tmp.name, 'dest')
+        self.store.get('key', dest, link=False)
+
+        with open(os.path.join(dest, 'sub', 'file'), 'w') as f:
+            f.write('changed')
+        self.assertEqual('sub/file', os.readlink(os.path.join(dest, 'link')))
+
+        self.store.get('key', dest)
+        with open(os.path.join(dest, 'sub', 'file')) as f:
+            self.assertEqual('content', f.read())
+
+    def test_least_recently_used_are_evicted(self):
+        for key in ['old', 'recent']:
+            self.store.put(key, self.make_tree(key, content='x' * 400))
+            os.utime(os.path.join(self.store.path, key), (0, 0))
+        self.store.get('old', os.path.join(self.tmp.name, 'dest'))
+
+        self.store.put('new', self.make_tree('new', content='x' * 400))
+
+        self.assertEqual(
+            ['new', 'old'],
+            sorted(n for n in os.listdir(self.store.path) if n[0] != '.'),
+        )
+
+
+class ParseSizeTest(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(42, parse_size('42'))
+        self.assertEqual(2048, parse_size('2K'))
+        self.assertEqual(500 * 1024**2, parse_size('500m'))
+        self.assertEqual(5 * 1024**3, parse_size('5G'))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_size('5T')
+
+
+class DefaultCacheDirTest(unittest.TestCase):
+    def test_honors_xdg_cache_home(self):
+        with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': '/c'}):
+            self.assertEqual('/c/quibble', default_cache_dir())
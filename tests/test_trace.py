@@ -0,0 +1,97 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import quibble.commands
+import quibble.process
+import quibble.trace
+from quibble import cmd
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(quibble.trace.stop)
+
+    def test_span_is_a_noop_when_not_started(self):
+        with quibble.trace.span('nothing', foo='bar') as args:
+            self.assertEqual({'foo': 'bar'}, args)
+        self.assertIsNone(quibble.trace.stop())
+
+    def test_records_nested_spans(self):
+        tracer = quibble.trace.start()
+        with quibble.trace.span('outer', 'command'):
+            with quibble.trace.span('inner', 'subprocess', cmd='true'):
+                pass
+
+        events = [e for e in tracer.events() if e['ph'] == 'X']
+        self.assertEqual(['outer', 'inner'], [e['name'] for e in events])
+        outer, inner = events
+        self.assertEqual({'cmd': 'true'}, inner['args'])
+        self.assertGreaterEqual(inner['ts'], outer['ts'])
+        self.assertLessEqual(
+            inner['ts'] + inner['dur'], outer['ts'] + outer['dur']
+        )
+
+    def test_records_thread_names(self):
+        tracer = quibble.trace.start()
+        with quibble.trace.span('something'):
+            pass
+
+        metadata = [e for e in tracer.events() if e['ph'] == 'M']
+        self.assertEqual('thread_name', metadata[0]['name'])
+        self.assertEqual('MainThread', metadata[0]['args']['name'])
+
+    def test_records_errors(self):
+        tracer = quibble.trace.start()
+        with self.assertRaises(ValueError):
+            with quibble.trace.span('failing'):
+                raise ValueError('boom')
+
+        (event,) = [e for e in tracer.events() if e['ph'] == 'X']
+        self.assertIn('boom', event['args']['error'])
+
+    def test_stop_writes_chrome_trace(self):
+        quibble.trace.start()
+        with quibble.trace.span('something'):
+            pass
+
+        with tempfile.TemporaryDirectory() as tmp:
+            trace_file = os.path.join(tmp, 'trace.json')
+            quibble.trace.stop(trace_file)
+            with open(trace_file) as f:
+                trace = json.load(f)
+
+        self.assertIn('traceEvents', trace)
+        self.assertIn('something', [e['name'] for e in trace['traceEvents']])
+
+    def test_subprocesses_are_traced(self):
+        tracer = quibble.trace.start()
+        quibble.process.check_call(['true'], cwd='/')
+
+        (event,) = [e for e in tracer.events() if e['ph'] == 'X']
+        self.assertEqual('subprocess', event['cat'])
+        self.assertEqual('true', event['args']['cmd'])
+        self.assertEqual('/', event['args']['cwd'])
+        self.assertEqual(0, event['args']['returncode'])
+
+    def test_commands_are_traced(self):
+        tracer = quibble.trace.start()
+        quibble.commands.execute_command(
+            quibble.commands.EnsureDirectory(tempfile.gettempdir())
+        )
+
+        (event,) = [e for e in tracer.events() if e['ph'] == 'X']
+        self.assertEqual('command', event['cat'])
+        self.assertRegex(event['name'], '^Ensure we have the directory')
+
+    @mock.patch('quibble.commands.execute_plan')
+    def test_quibble_writes_trace_to_log_dir(self, _):
+        q = cmd.QuibbleCmd()
+        with tempfile.TemporaryDirectory() as log_dir:
+            q.log_dir = log_dir
+            q.execute([])
+            self.assertTrue(
+                os.path.exists(os.path.join(log_dir, 'trace.json'))
+            )
@@ -1,4 +1,9 @@
+import logging
+import threading
+import time
+
 import pytest
+import quibble.process
 import quibble.util
 from quibble.util import isCoreOrVendor, isExtOrSkin, move_item_to_head
 
@@ -8,6 +13,83 @@ def test_parallel_run_accepts_an_empty_list_of_tasks():
     assert True
 
 
+def test_parallel_run_passes_arguments():
+    results = []
+    assert quibble.util.parallel_run(
+        [(results.append, 'a'), (results.append, 'b')]
+    )
+    assert ['a', 'b'] == sorted(results)
+
+
+def _fail(message):
+    time.sleep(0.2)
+    raise Exception(message)
+
+
+def test_parallel_run_kills_siblings_on_failure():
+    start = time.monotonic()
+    with pytest.raises(Exception, match='^some failure$'):
+        quibble.util.parallel_run(
+            [
+                (quibble.process.check_call, ['sh', '-c', 'sleep 30 & wait']),
+                (_fail, 'some failure'),
+            ]
+        )
+    assert time.monotonic() - start < 10
+
+
+def test_parallel_run_without_fail_fast_runs_all_tasks():
+    results = []
+    with pytest.raises(Exception, match='^some failure$'):
+        quibble.util.parallel_run(
+            [(_fail, 'some failure'), (results.append, 'done')],
+            fail_fast=False,
+        )
+    assert ['done'] == results
+
+
+def test_parallel_run_bounds_workers():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def task():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+
+    quibble.util.parallel_run([(task,) for _ in range(6)], workers=2)
+    assert 2 == max(peak)
+
+
+def test_parallel_run_tags_output(caplog):
+    caplog.set_level(logging.INFO, logger='quibble.process')
+    quibble.util.parallel_run(
+        [
+            (quibble.process.check_call, ['echo', 'first']),
+            (quibble.process.check_call, ['echo', 'second']),
+        ]
+    )
+    assert '[check_call#0] first' in caplog.messages
+    assert '[check_call#1] second' in caplog.messages
+
+
+def test_parallel_run_uses_given_tags(caplog):
+    caplog.set_level(logging.INFO, logger='quibble.process')
+    quibble.util.parallel_run(
+        [
+            (quibble.process.check_call, ['echo', 'first']),
+            (quibble.process.check_call, ['echo', 'second']),
+        ],
+        tags=['extensions/Foo', 'skins/Bar'],
+    )
+    assert '[extensions/Foo] first' in caplog.messages
+    assert '[skins/Bar] second' in caplog.messages
+
+
 # quibble.util.isCoreOrVendor
 
 
@@ -1,7 +1,15 @@
+import contextlib
+import os
+import re
+import subprocess
+import tempfile
 import unittest
 from unittest import mock
 
 import quibble.zuul
+from zuul.lib.clonemapper import CloneMapIndex, CloneMapper, get_index
+from zuul.lib.cloner import Cloner
+from zuul.merger.merger import Repo, git_processes
 
 
 class TestClone(unittest.TestCase):
@@ -174,6 +182,8 @@ class TestClone(unittest.TestCase):
                     mock.ANY,  # zuul_cloner
                     expected_repo,
                     mock.ANY,  # we don't care about the destination
+                    mock.ANY,  # checkout_executor
+                    mock.ANY,  # timings
                 )
             )
 
@@ -184,9 +194,19 @@ class TestClone(unittest.TestCase):
         mock_executor.assert_has_calls(expected_calls)
 
     @mock.patch('quibble.zuul.Cloner')
-    def test_mediawiki_core_cloned_first_when_running_in_parallel(
+    def test_nested_repositories_cloned_aside_of_mediawiki_core(
         self, mock_cloner
     ):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        workspace = os.path.join(tmp.name, 'src')
+
+        def fetch(project, dest):
+            os.makedirs(os.path.join(dest, '.git'))
+            return dest
+
+        mock_cloner().fetchRepo.side_effect = fetch
+
         repos_to_clone = [
             'mediawiki/extensions/Bar',
             'mediawiki/skins/Vector',
@@ -196,29 +216,147 @@ class TestClone(unittest.TestCase):
             branch='master',
             cache_dir='/tmp/cache',
             project_branch=[],
-            # Clone without mediawiki/core
             projects=repos_to_clone,
             workers=2,
+            workspace=workspace,
+            zuul_branch=None,
+            zuul_newrev=None,
+            zuul_project=None,
+            zuul_ref=None,
+            zuul_url=None,
+        )
+
+        fetched = {
+            c[0][0]: c[0][1] for c in mock_cloner().fetchRepo.call_args_list
+        }
+        self.assertEqual(workspace, fetched['mediawiki/core'])
+        for project in ['mediawiki/extensions/Bar', 'mediawiki/skins/Vector']:
+            self.assertFalse(fetched[project].startswith(workspace + '/'))
+            self.assertTrue(
+                os.path.isdir(
+                    os.path.join(
+                        workspace, quibble.zuul.repo_dir(project), '.git'
+                    )
+                )
+            )
+        # Staging directory is removed
+        self.assertEqual(['src'], os.listdir(tmp.name))
+
+    @mock.patch('quibble.zuul.Cloner')
+    def test_nested_repositories_replace_empty_directories(self, mock_cloner):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        workspace = os.path.join(tmp.name, 'src')
+
+        def fetch(project, dest):
+            os.makedirs(os.path.join(dest, '.git'))
+            if project == 'mediawiki/core':
+                # Uninitialized submodules of a wmf/* branch
+                os.makedirs(os.path.join(dest, 'extensions/Bar'))
+                os.makedirs(os.path.join(dest, 'skins/Vector/resources'))
+            return dest
+
+        mock_cloner().fetchRepo.side_effect = fetch
+
+        with self.assertRaisesRegex(Exception, 'destination exists'):
+            quibble.zuul.clone(
+                branch='master',
+                cache_dir='/tmp/cache',
+                project_branch=[],
+                projects=[
+                    'mediawiki/extensions/Bar',
+                    'mediawiki/skins/Vector',
+                    'mediawiki/core',
+                ],
+                workers=2,
+                workspace=workspace,
+                zuul_branch=None,
+                zuul_newrev=None,
+                zuul_project=None,
+                zuul_ref=None,
+                zuul_url=None,
+            )
+
+        self.assertTrue(
+            os.path.isdir(os.path.join(workspace, 'extensions/Bar/.git'))
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(workspace, 'skins/Vector/.git'))
+        )
+
+    @mock.patch('quibble.zuul.Cloner')
+    def test_nested_repositories_cloned_in_place_if_core_exists(
+        self, mock_cloner
+    ):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        os.makedirs(os.path.join(tmp.name, '.git'))
+
+        quibble.zuul.clone(
+            branch='master',
+            cache_dir='/tmp/cache',
+            project_branch=[],
+            projects=['mediawiki/core', 'mediawiki/skins/Vector'],
+            workers=2,
+            workspace=tmp.name,
+            zuul_branch=None,
+            zuul_newrev=None,
+            zuul_project=None,
+            zuul_ref=None,
+            zuul_url=None,
+        )
+
+        mock_cloner().fetchRepo.assert_any_call(
+            'mediawiki/skins/Vector', os.path.join(tmp.name, 'skins/Vector')
+        )
+
+    @mock.patch('quibble.zuul.Cloner')
+    def test_checks_out_what_has_been_fetched(self, mock_cloner):
+        mock_cloner().fetchRepo.side_effect = lambda project, dest: (
+            'fetched ' + project
+        )
+        quibble.zuul.clone(
+            branch='master',
+            cache_dir='/tmp/cache',
+            project_branch=[],
+            projects=['mediawiki/skins/Foo', 'mediawiki/skins/Bar'],
+            workers=2,
             workspace='/tmp/src',
             zuul_branch=None,
             zuul_newrev=None,
             zuul_project=None,
             zuul_ref=None,
             zuul_url=None,
+            checkout_workers=1,
         )
-        self.maxDiff = None
 
-        mock_cloner.assert_has_calls(
+        mock_cloner().checkoutRepo.assert_has_calls(
             [
-                # MediaWiki core first
-                mock.call().prepareRepo('mediawiki/core', mock.ANY),
-                mock.call().log.getChild('mediawiki/extensions/Bar'),
-                mock.call().prepareRepo('mediawiki/extensions/Bar', mock.ANY),
-                mock.call().log.getChild('mediawiki/skins/Vector'),
-                mock.call().prepareRepo('mediawiki/skins/Vector', mock.ANY),
-            ]
+                mock.call('fetched mediawiki/skins/Foo'),
+                mock.call('fetched mediawiki/skins/Bar'),
+            ],
+            any_order=True,
         )
 
+    @mock.patch('quibble.zuul.Cloner')
+    def test_fetch_failure_is_raised(self, mock_cloner):
+        mock_cloner().fetchRepo.side_effect = Exception('network is down')
+        with self.assertRaisesRegex(Exception, 'network is down'):
+            quibble.zuul.clone(
+                branch='master',
+                cache_dir='/tmp/cache',
+                project_branch=[],
+                projects=['mediawiki/skins/Foo', 'mediawiki/skins/Bar'],
+                workers=2,
+                workspace='/tmp/src',
+                zuul_branch=None,
+                zuul_newrev=None,
+                zuul_project=None,
+                zuul_ref=None,
+                zuul_url=None,
+            )
+        mock_cloner().checkoutRepo.assert_not_called()
+
 
 class TestRepoDir(unittest.TestCase):
     def test_maps_mediawiki_core_to_current_directory(self):
@@ -243,3 +381,358 @@ class TestRepoDir(unittest.TestCase):
             'services/parsoid',
             quibble.zuul.repo_dir('mediawiki/services/parsoid'),
         )
+
+    @mock.patch('zuul.lib.clonemapper.CloneMapper.log')
+    def test_does_not_log(self, mock_log):
+        quibble.zuul.repo_dir('mediawiki/extensions/Quiet')
+        self.assertEqual([], mock_log.mock_calls)
+
+
+class TestCloneMapIndex(unittest.TestCase):
+    def test_destination(self):
+        index = CloneMapIndex(
+            [
+                {'name': 'mediawiki/core', 'dest': '.'},
+                {'name': 'mediawiki/extensions/(.*)', 'dest': 'ext/\\1'},
+            ]
+        )
+        self.assertEqual('.', index.destination('mediawiki/core'))
+        self.assertEqual(
+            'ext/Foo', index.destination('mediawiki/extensions/Foo')
+        )
+        self.assertEqual('unmapped', index.destination('unmapped'))
+
+    def test_matches_like_re_match(self):
+        names = [
+            'mediawiki/extensionsX?/(.*)',
+            'mediawiki/extensionsX*/(.*)',
+            'mediawiki/extensionsX{0,1}/(.*)',
+            'mediawiki/extensions/(.*)|mediawiki/skins/(.*)',
+            'mediawiki/ext|mediawiki/extensions/Foo',
+        ]
+        projects = [
+            'mediawiki/extensions/Foo',
+            'mediawiki/extensionsX/Foo',
+            'mediawiki/skins/Vector',
+            'mediawiki/ext',
+        ]
+        for name in names:
+            index = CloneMapIndex([{'name': name, 'dest': 'dest'}])
+            for project in projects:
+                self.assertEqual(
+                    bool(re.match(r'^%s$' % name, project)),
+                    bool(index.destinations(project)),
+                    '%s matching %s' % (name, project),
+                )
+
+    def test_duplicate_destinations(self):
+        index = CloneMapIndex(
+            [
+                {'name': 'mediawiki/(.*)', 'dest': 'a/\\1'},
+                {'name': 'mediawiki/skins/(.*)', 'dest': 'b/\\1'},
+            ]
+        )
+        self.assertEqual(
+            ['a/skins/Vector', 'b/Vector'],
+            index.destinations('mediawiki/skins/Vector'),
+        )
+        with self.assertRaisesRegex(Exception, 'Duplicate destinations'):
+            index.destination('mediawiki/skins/Vector')
+        self.assertEqual('a/core', index.destination('mediawiki/core'))
+
+    def test_get_index_is_memoized(self):
+        self.assertIs(
+            get_index(quibble.zuul.CLONE_MAP),
+            get_index(list(quibble.zuul.CLONE_MAP)),
+        )
+
+    def test_clone_mapper_uses_index(self):
+        dests = CloneMapper(
+            quibble.zuul.CLONE_MAP,
+            ['mediawiki/core', 'mediawiki/skins/Vector'],
+        ).expand(workspace='/src')
+        self.assertEqual(
+            {
+                'mediawiki/core': '/src',
+                'mediawiki/skins/Vector': '/src/skins/Vector',
+            },
+            dict(dests),
+        )
+
+
+class UpstreamTestCase(unittest.TestCase):
+    """Provides an upstream git repository with a commit on master"""
+
+    def git(self, *args, cwd=None):
+        return (
+            subprocess.check_output(
+                ['git', '-c', 'user.name=Quibble', '-c', 'user.email=q@x']
+                + list(args),
+                cwd=cwd or self.upstream,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+
+    def commit(self, message):
+        self.git('commit', '--allow-empty', '-q', '-m', message)
+        return self.git('rev-parse', 'HEAD')
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.git_url = tmp.name
+        self.upstream = os.path.join(tmp.name, 'project')
+        self.workspace = os.path.join(tmp.name, 'src')
+        os.mkdir(self.upstream)
+        self.git('init', '-q', '-b', 'master')
+        self.commit('initial')
+
+
+class TestMinimalFetch(UpstreamTestCase):
+    def cloner(self, **kwargs):
+        params = {
+            'git_base_url': self.git_url,
+            'projects': ['project'],
+            'workspace': self.workspace,
+            'zuul_branch': 'master',
+            'zuul_ref': 'refs/zuul/master/Z1',
+            'zuul_url': self.git_url,
+            'minimal_fetch': True,
+        }
+        params.update(kwargs)
+        return Cloner(**params)
+
+    def test_checks_out_zuul_ref_without_fetching_other_refs(self):
+        dest = os.path.join(self.workspace, 'project')
+        self.cloner().prepareRepo('project', dest)
+
+        self.git('branch', 'wmf/1')
+        self.git('tag', 'v1')
+        zuul_commit = self.commit('change')
+        self.git('update-ref', 'refs/zuul/master/Z1', zuul_commit)
+        self.git('reset', '-q', '--hard', 'HEAD^')
+
+        self.cloner().prepareRepo('project', dest)
+
+        self.assertEqual(zuul_commit, self.git('rev-parse', 'HEAD', cwd=dest))
+        refs = self.git('for-each-ref', '--format=%(refname)', cwd=dest)
+        self.assertNotIn('refs/tags/v1', refs)
+        self.assertNotIn('refs/remotes/origin/wmf/1', refs)
+
+    def test_bounds_open_repositories(self):
+        cloner = self.cloner(max_open_repos=1)
+        fetched = cloner.fetchRepo(
+            'project', os.path.join(self.workspace, 'project')
+        )
+        self.assertFalse(cloner.open_repos.acquire(blocking=False))
+
+        cloner.checkoutRepo(fetched)
+        self.assertIsNone(fetched[1]._repo)
+        self.assertTrue(cloner.open_repos.acquire(blocking=False))
+
+    def test_records_git_operations_with_the_given_span(self):
+        spans = []
+
+        @contextlib.contextmanager
+        def span(name, category, **args):
+            spans.append((name, category, args))
+            yield {}
+
+        self.cloner(span=span).prepareRepo(
+            'project', os.path.join(self.workspace, 'project')
+        )
+
+        self.assertIn(('clone', 'git', {'project': 'project'}), spans)
+
+    def test_falls_back_to_the_indicated_branch(self):
+        self.git('branch', 'REL1_42')
+        dest = os.path.join(self.workspace, 'project')
+        self.cloner().prepareRepo('project', dest)
+
+        self.git('checkout', '-q', 'REL1_42')
+        branch_commit = self.commit('backport')
+
+        self.cloner(branch='REL1_42').prepareRepo('project', dest)
+
+        self.assertEqual(
+            branch_commit, self.git('rev-parse', 'HEAD', cwd=dest)
+        )
+
+    def test_prunes_deleted_branches(self):
+        self.git('branch', 'REL1_42')
+        dest = os.path.join(self.workspace, 'project')
+        self.cloner().prepareRepo('project', dest)
+
+        self.git('branch', '-D', 'REL1_42')
+        self.cloner(branch='REL1_42').prepareRepo('project', dest)
+
+        self.assertEqual(
+            self.git('rev-parse', 'master'),
+            self.git('rev-parse', 'HEAD', cwd=dest),
+        )
+        self.assertNotIn(
+            'refs/remotes/origin/REL1_42',
+            self.git('for-each-ref', '--format=%(refname)', cwd=dest),
+        )
+
+
+class TestRepo(UpstreamTestCase):
+    def setUp(self):
+        super().setUp()
+        self.git('branch', 'REL1_42')
+        self.git('tag', '-a', '-m', 'release', '1.42.0')
+        self.dest = os.path.join(self.workspace, 'project')
+        self.repo = Repo(self.upstream, self.dest, None, None)
+
+    def test_reset_creates_local_branches(self):
+        self.git('checkout', '-q', 'REL1_42')
+        rel_commit = self.commit('backport')
+
+        self.repo.reset()
+
+        self.assertEqual(
+            rel_commit, self.git('rev-parse', 'REL1_42', cwd=self.dest)
+        )
+        self.assertEqual(
+            self.git('rev-parse', 'master'),
+            self.git('rev-parse', 'HEAD', cwd=self.dest),
+        )
+
+    def test_ref_lookups_see_fetched_refs(self):
+        self.repo.reset()
+        self.assertTrue(self.repo.hasBranch('REL1_42'))
+        self.assertFalse(self.repo.hasBranch('wmf/1'))
+
+        self.git('branch', 'wmf/1')
+        self.repo.reset()
+
+        self.assertTrue(self.repo.hasBranch('wmf/1'))
+        self.assertEqual(
+            self.git('rev-parse', 'master'),
+            self.repo.getCommitFromRef('origin/wmf/1').hexsha,
+        )
+        self.assertIsNone(self.repo.getCommitFromRef('origin/wmf/2'))
+
+    def test_resolve_ref_peels_annotated_tags(self):
+        self.assertEqual(
+            self.git('rev-parse', 'master'),
+            self.repo.resolveRef('refs/tags/1.42.0'),
+        )
+        self.assertIsNone(self.repo.resolveRef('refs/tags/missing'))
+
+    def test_reuses_repo_object_until_closed(self):
+        handle = self.repo.createRepoObject()
+        self.assertIs(handle, self.repo.createRepoObject())
+
+        self.repo.close()
+        self.assertIsNot(handle, self.repo.createRepoObject())
+
+    def test_counts_git_processes(self):
+        spawned = git_processes.count
+        self.repo.reset()
+        self.assertGreater(git_processes.count, spawned)
+
+
+class TestPartialClone(UpstreamTestCase):
+    def setUp(self):
+        super().setUp()
+        self.commit('second')
+        self.git('branch', 'REL1_42')
+        self.commit('third')
+        self.dest = os.path.join(self.workspace, 'project')
+
+    def prepare(self, **kwargs):
+        params = {
+            'git_base_url': 'file://' + self.git_url,
+            'projects': ['project'],
+            'workspace': self.workspace,
+            'zuul_branch': None,
+            'zuul_ref': None,
+            'zuul_url': None,
+            'zuul_project': 'mediawiki/core',
+        }
+        params.update(kwargs)
+        Cloner(**params).prepareRepo('project', self.dest)
+
+    def test_shallow_clone_of_dependencies(self):
+        self.prepare(clone_depth=1)
+
+        self.assertEqual(
+            'true',
+            self.git('rev-parse', '--is-shallow-repository', cwd=self.dest),
+        )
+        self.assertEqual(
+            '1', self.git('rev-list', '--count', 'HEAD', cwd=self.dest)
+        )
+        self.assertIn(
+            'refs/remotes/origin/REL1_42',
+            self.git('for-each-ref', '--format=%(refname)', cwd=self.dest),
+        )
+
+    def test_partial_clone_of_dependencies_from_cache(self):
+        cache_dir = os.path.join(self.git_url, 'cache')
+        self.git(
+            'clone', '-q', '--bare', self.upstream, cache_dir + '/project.git'
+        )
+
+        self.prepare(clone_filter='blob:none', cache_dir=cache_dir)
+
+        self.assertEqual(
+            'blob:none',
+            self.git(
+                'config', 'remote.origin.partialclonefilter', cwd=self.dest
+            ),
+        )
+        self.assertEqual(
+            'file://' + self.upstream,
+            self.git('config', 'remote.origin.url', cwd=self.dest),
+        )
+
+    def test_project_under_test_keeps_full_history(self):
+        self.prepare(
+            clone_depth=1, clone_filter='blob:none', zuul_project='project'
+        )
+
+        self.assertEqual(
+            'false',
+            self.git('rev-parse', '--is-shallow-repository', cwd=self.dest),
+        )
+        self.assertEqual(
+            '3', self.git('rev-list', '--count', 'HEAD', cwd=self.dest)
+        )
+
+
+class TestSharedClone(UpstreamTestCase):
+    def test_borrows_objects_from_cache(self):
+        cache_dir = os.path.join(self.git_url, 'cache')
+        cache = os.path.join(cache_dir, 'project.git')
+        self.git('clone', '-q', '--bare', self.upstream, cache)
+        dest = os.path.join(self.workspace, 'project')
+        cache_lock = mock.MagicMock()
+
+        Cloner(
+            git_base_url=self.git_url,
+            projects=['project'],
+            workspace=self.workspace,
+            zuul_branch=None,
+            zuul_ref=None,
+            zuul_url=None,
+            cache_dir=cache_dir,
+            cache_shared=True,
+            clone_depth=1,
+            cache_lock=cache_lock,
+        ).prepareRepo('project', dest)
+
+        cache_lock.assert_called_once_with(cache)
+        with open(os.path.join(dest, '.git/objects/info/alternates')) as f:
+            self.assertEqual(os.path.join(cache, 'objects'), f.read().strip())
+        self.assertEqual(
+            'false',
+            self.git('rev-parse', '--is-shallow-repository', cwd=dest),
+        )
+        self.assertEqual(
+            self.git('rev-parse', 'HEAD'),
+            self.git('rev-parse', 'HEAD', cwd=dest),
+        )
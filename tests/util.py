@@ -1,5 +1,5 @@
-def run_sequentially(tasks):
-    '''Replace imap_unordered with sequential execution'''
+def run_sequentially(tasks, fail_fast=True):
+    '''Replace parallel_run with sequential execution'''
     for func_spec in tasks:
         func = func_spec[0]
         args = func_spec[1:]
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Benchmark mapping projects to their directories
+
+Compares quibble.zuul.repo_dir() with expanding a CloneMapper for each
+project, which is what repo_dir() used to do.
+
+Usage: utils/benchmark-clonemap.py [number of projects]
+"""
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import quibble  # noqa: E402
+import quibble.zuul  # noqa: E402
+from zuul.lib.clonemapper import CloneMapper  # noqa: E402
+
+
+def projects(count):
+    kinds = ['extensions', 'skins', 'services']
+    return ['mediawiki/core', 'mediawiki/vendor'] + [
+        'mediawiki/%s/Project%d' % (kinds[i % len(kinds)], i)
+        for i in range(count)
+    ]
+
+
+def per_project_mapper(projects):
+    with quibble.logginglevel('zuul.CloneMapper', logging.WARNING):
+        for project in projects:
+            CloneMapper(quibble.zuul.CLONE_MAP, [project]).expand('./')
+
+
+def repo_dir(projects):
+    for project in projects:
+        quibble.zuul.repo_dir(project)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    names = projects(count)
+
+    for func in [per_project_mapper, repo_dir]:
+        runs = 5
+        duration = timeit.timeit(lambda: func(names), number=runs) / runs
+        print(
+            '%-20s %d projects: %8.2f ms'
+            % (func.__name__, len(names), duration * 1000)
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,83 @@ OrderedDict = extras.try_imports(['collections.OrderedDict',
                                   'ordereddict.OrderedDict'])
 
 
+# Characters starting the regular expression part of a mapping name
+_REGEX_CHARS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+def _literal_prefix(name):
+    """Leading part of a mapping name that any matching project starts with
+
+    Returns None when the name has no regular expression characters.
+    """
+    match = _REGEX_CHARS.search(name)
+    if match is None:
+        return None
+    if '|' in name:
+        # An alternative may start anywhere
+        return ''
+    prefix = name[:match.start()]
+    if match.group() in '?*{':
+        # The quantifier makes the preceding character optional
+        prefix = prefix[:-1]
+    return prefix
+
+
+class CloneMapIndex(object):
+    """Compiled clone map resolving projects to their destinations
+
+    Mappings without regular expression are looked up in a dict. The other
+    mappings are only tried when the project starts with the literal part of
+    their name. Results are memoized.
+    """
+
+    def __init__(self, clonemap):
+        self.exact = defaultdict(list)
+        self.patterns = []
+        for mapping in clonemap:
+            name = mapping['name']
+            prefix = _literal_prefix(name)
+            if prefix is None:
+                self.exact[name].append((None, mapping['dest']))
+            else:
+                self.patterns.append((prefix,
+                                      re.compile(r'^%s$' % name),
+                                      re.compile(name),
+                                      mapping['dest']))
+        self._cache = {}
+
+    def destinations(self, project):
+        """Destinations of all the mappings matching project"""
+        if project not in self._cache:
+            dests = [dest for (_, dest) in self.exact.get(project, [])]
+            for (prefix, full_match, regex, dest) in self.patterns:
+                if project.startswith(prefix) and full_match.match(project):
+                    dests.append(regex.sub(dest, project))
+            self._cache[project] = dests
+        return list(self._cache[project])
+
+    def destination(self, project):
+        """Destination of project, relatively to the workspace"""
+        dests = self.destinations(project)
+        if len(dests) > 1:
+            raise Exception("Duplicate destinations for %s: %s." % (
+                project, dests))
+        elif len(dests) == 0:
+            return project
+        return dests[0]
+
+
+_indexes = {}
+
+
+def get_index(clonemap):
+    """Memoized CloneMapIndex of a clone map"""
+    key = tuple((m['name'], m['dest']) for m in clonemap)
+    if key not in _indexes:
+        _indexes[key] = CloneMapIndex(clonemap)
+    return _indexes[key]
+
+
 class CloneMapper(object):
     log = logging.getLogger("zuul.CloneMapper")
 
@@ -36,16 +113,12 @@ class CloneMapper(object):
     def expand(self, workspace):
         self.log.info("Workspace path set to: %s", workspace)
 
+        index = get_index(self.clonemap)
         is_valid = True
         ret = OrderedDict()
         for project in self.projects:
-            dests = []
-            for mapping in self.clonemap:
-                if re.match(r'^%s$' % mapping['name'],
-                            project):
-                    # Might be matched more than one time
-                    dests.append(
-                        re.sub(mapping['name'], mapping['dest'], project))
+            # Might be matched more than one time
+            dests = index.destinations(project)
 
             if len(dests) > 1:
                 self.log.error("Duplicate destinations for %s: %s.",
@@ -13,10 +13,11 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import git
+import contextlib
 import logging
 import os
 import re
+import threading
 import yaml
 
 import six
@@ -24,7 +25,12 @@ import six
 from git import GitCommandError
 from zuul import exceptions
 from zuul.lib.clonemapper import CloneMapper
-from zuul.merger.merger import Repo
+from zuul.merger.merger import GitRepo, Repo, clone_options, null_span
+
+
+@contextlib.contextmanager
+def _no_lock(repo):
+    yield
 
 
 class Cloner(object):
@@ -33,7 +39,14 @@ class Cloner(object):
     def __init__(self, git_base_url, projects, workspace, zuul_branch,
                  zuul_ref, zuul_url, branch=None, clone_map_file=None,
                  project_branches=None, cache_dir=None, zuul_newrev=None,
-                 zuul_project=None, cache_no_hardlinks=None):
+                 zuul_project=None, cache_no_hardlinks=None,
+                 minimal_fetch=False, clone_depth=None, clone_filter=None,
+                 cache_shared=False, max_open_repos=None, span=None,
+                 cache_lock=None):
+        """span: called as span(name, category, **args) to get a context
+        manager recording git operations, does nothing by default.
+        cache_lock: called with the path of a cache repository to get a
+        context manager held while cloning from it."""
 
         self.clone_map = []
         self.dests = None
@@ -42,6 +55,13 @@ class Cloner(object):
         self.git_url = git_base_url
         self.cache_dir = cache_dir
         self.cache_no_hardlinks = cache_no_hardlinks
+        self.cache_shared = cache_shared
+        self.span = span or null_span
+        self.cache_lock = cache_lock or _no_lock
+        self.minimal_fetch = minimal_fetch
+        self.clone_depth = clone_depth
+        self.clone_filter = clone_filter
+        self.zuul_project = zuul_project
         self.projects = projects
         self.workspace = workspace
         self.zuul_branch = zuul_branch or ''
@@ -49,6 +69,11 @@ class Cloner(object):
         self.zuul_url = zuul_url
         self.project_branches = project_branches or {}
         self.project_revisions = {}
+        # Each opened repository may keep git processes around, bound how
+        # many repositories are between fetchRepo() and checkoutRepo().
+        self.open_repos = None
+        if max_open_repos:
+            self.open_repos = threading.BoundedSemaphore(max_open_repos)
 
         if zuul_newrev and zuul_project:
             self.project_revisions[zuul_project] = zuul_newrev
@@ -83,6 +108,14 @@ class Cloner(object):
 
         repo_is_cloned = os.path.exists(os.path.join(dest, '.git'))
 
+        # The project under test keeps its full history, only dependencies
+        # are cloned shallow or partially.
+        depth = None
+        clone_filter = None
+        if project != self.zuul_project:
+            depth = self.clone_depth
+            clone_filter = self.clone_filter
+
         repo_cache = None
         if (self.cache_dir and not repo_is_cloned):
             if os.path.exists(git_cache_bare):
@@ -91,16 +124,34 @@ class Cloner(object):
                 repo_cache = git_cache
 
             if repo_cache:
-                if self.cache_no_hardlinks:
-                    # file:// tells git not to hard-link across repos
-                    repo_cache = 'file://%s' % repo_cache
-
-                self.log.info("Creating repo %s from cache %s",
-                              project, repo_cache)
-                new_repo = git.Repo.clone_from(repo_cache, dest)
+                # Prevent maintenance of the cache while cloning from it
+                with self.cache_lock(repo_cache):
+                    if self.cache_shared:
+                        # Objects of the cache are borrowed through git
+                        # alternates, truncating history or filtering objects
+                        # would not save anything.
+                        depth = None
+                        clone_filter = None
+                        self.log.info("Creating repo %s sharing objects with "
+                                      "cache %s", project, repo_cache)
+                        new_repo = GitRepo.clone_from(repo_cache, dest,
+                                                      shared=True)
+                    else:
+                        if self.cache_no_hardlinks or depth or clone_filter:
+                            # file:// tells git not to hard-link across
+                            # repos. It is also required for shallow and
+                            # partial local clones.
+                            repo_cache = 'file://%s' % repo_cache
+
+                        self.log.info("Creating repo %s from cache %s",
+                                      project, repo_cache)
+                        new_repo = GitRepo.clone_from(
+                            repo_cache, dest,
+                            **clone_options(depth, clone_filter))
                 self.log.info("Updating origin remote in repo %s to %s",
                               project, git_upstream)
                 new_repo.remotes.origin.config_writer.set('url', git_upstream)
+                new_repo.close()
 
         if not repo_cache:
             self.log.info("Creating repo %s from upstream %s",
@@ -110,7 +161,10 @@ class Cloner(object):
             remote=git_upstream,
             local=dest,
             email=None,
-            username=None)
+            username=None,
+            depth=depth,
+            clone_filter=clone_filter,
+            span=self.span)
 
         if not repo.isInitialized():
             raise Exception("Error cloning %s to %s" % (git_upstream, dest))
@@ -121,7 +175,9 @@ class Cloner(object):
         zuul_remote = '%s/%s' % (self.zuul_url, project)
 
         try:
-            repo.fetchFrom(zuul_remote, ref)
+            with self.span('fetch zuul ref', 'git', project=project,
+                           ref=ref):
+                repo.fetchFrom(zuul_remote, ref)
             self.log.debug("Fetched ref %s from %s", ref, project)
             return True
         except ValueError:
@@ -136,6 +192,37 @@ class Cloner(object):
                            project, ref)
             return False
 
+    def fetchZuulCommit(self, repo, project, refs):
+        """Fetch the first of refs which Zuul has and return its commit
+
+        Returns None if Zuul has none of them. With minimal_fetch, all refs
+        are fetched in a single round trip.
+        """
+        refs = [ref for (i, ref) in enumerate(refs)
+                if ref and ref not in refs[:i]]
+        if not refs:
+            return None
+
+        if self.minimal_fetch and all(r.startswith('refs/') for r in refs):
+            zuul_remote = '%s/%s' % (self.zuul_url, project)
+            with self.span('fetch zuul ref', 'git', project=project,
+                           ref=' '.join(refs)):
+                found = repo.fetchRefs(zuul_remote, refs)
+            for ref in refs:
+                if ref in found:
+                    self.log.debug("Fetched ref %s from %s", ref, project)
+                    return found[ref]
+                self.log.debug("Project %s in Zuul does not have ref %s",
+                               project, ref)
+            return None
+
+        for ref in refs:
+            if self.fetchFromZuul(repo, project, ref):
+                # Work around a bug in GitPython which can not parse
+                # FETCH_HEAD
+                return repo.createRepoObject().git.rev_parse('FETCH_HEAD')
+        return None
+
     def prepareRepo(self, project, dest):
         """Clone a repository for project at dest and apply a reference
         suitable for testing. The reference lookup is attempted in this order:
@@ -155,19 +242,41 @@ class Cloner(object):
          A) The project-specific override branch (from project_branches arg)
          B) The user specified branch (from the branch arg)
          C) ZUUL_BRANCH (from the zuul_branch arg)
-        """
 
-        repo = self.cloneUpstream(project, dest)
+        This is done in two steps which can be run concurrently for different
+        repositories: fetchRepo() talks to the network and checkoutRepo()
+        only acts on the local disk.
+        """
+        self.checkoutRepo(self.fetchRepo(project, dest))
 
-        # Ensure that we don't have stale remotes around
-        repo.prune()
-        # We must reset after pruning because reseting sets HEAD to point
-        # at refs/remotes/origin/master, but `git branch` which prune runs
-        # explodes if HEAD does not point at something in refs/heads.
-        # Later with repo.checkout() we set HEAD to something that
-        # `git branch` is happy with.
-        repo.reset()
+    def fetchRepo(self, project, dest):
+        """Clone or update a repository and fetch the reference to test
 
+        Returns what checkoutRepo() needs to check it out. The repository
+        stays open until it is checked out or given to releaseRepo().
+        """
+        if self.open_repos is not None:
+            self.open_repos.acquire()
+        try:
+            with self.span('clone', 'git', project=project):
+                repo = self.cloneUpstream(project, dest)
+        except Exception:
+            self.releaseRepo(None)
+            raise
+        try:
+            return self._fetchRefs(project, repo)
+        except Exception:
+            self.releaseRepo(repo)
+            raise
+
+    def releaseRepo(self, repo):
+        """Close a repository returned by fetchRepo()"""
+        if repo is not None:
+            repo.close()
+        if self.open_repos is not None:
+            self.open_repos.release()
+
+    def _fetchRefs(self, project, repo):
         indicated_revision = None
         if project in self.project_revisions:
             indicated_revision = self.project_revisions[project]
@@ -176,6 +285,26 @@ class Cloner(object):
         if project in self.project_branches:
             indicated_branch = self.project_branches[project]
 
+        if self.minimal_fetch:
+            # Only fetch the branches we might check out. Stale branches are
+            # pruned by the same fetch.
+            branches = ['master']
+            if indicated_branch and indicated_branch != 'master':
+                branches.append(indicated_branch)
+            with self.span('fetch', 'git', project=project):
+                repo.updateBranches(branches)
+        else:
+            # Ensure that we don't have stale remotes around
+            with self.span('prune', 'git', project=project):
+                repo.prune()
+            # We must reset after pruning because reseting sets HEAD to
+            # point at refs/remotes/origin/master, but `git branch` which
+            # prune runs explodes if HEAD does not point at something in
+            # refs/heads.  Later with repo.checkout() we set HEAD to
+            # something that `git branch` is happy with.
+            with self.span('fetch', 'git', project=project):
+                repo.update()
+
         if indicated_branch:
             override_zuul_ref = re.sub(self.zuul_branch, indicated_branch,
                                        self.zuul_ref)
@@ -198,6 +327,37 @@ class Cloner(object):
         else:
             fallback_zuul_ref = None
 
+        zuul_commit = None
+        if indicated_revision:
+            try:
+                self.fetchFromZuul(repo, project, self.zuul_ref)
+            except (ValueError, GitCommandError):
+                raise exceptions.RevNotFound(project, indicated_revision)
+        else:
+            zuul_commit = self.fetchZuulCommit(
+                repo, project, [override_zuul_ref, fallback_zuul_ref])
+
+        return (project, repo, indicated_revision, zuul_commit,
+                fallback_branch)
+
+    def checkoutRepo(self, fetched):
+        """Reset a repository and check out the reference to test
+
+        fetched: as returned by fetchRepo()
+        """
+        (project, repo, indicated_revision, zuul_commit,
+         fallback_branch) = fetched
+        try:
+            self._checkout(project, repo, indicated_revision, zuul_commit,
+                           fallback_branch)
+        finally:
+            self.releaseRepo(repo)
+
+    def _checkout(self, project, repo, indicated_revision, zuul_commit,
+                  fallback_branch):
+        with self.span('reset', 'git', project=project):
+            repo.resetToRemoteHead()
+
         # If the user has requested an explicit revision to be checked out,
         # we use it above all else, and if we cannot satisfy this requirement
         # we raise an error and do not attempt to continue.
@@ -205,30 +365,26 @@ class Cloner(object):
             self.log.info("Attempting to check out revision %s for "
                           "project %s", indicated_revision, project)
             try:
-                self.fetchFromZuul(repo, project, self.zuul_ref)
-                commit = repo.checkout(indicated_revision)
+                with self.span('checkout', 'git', project=project):
+                    commit = repo.checkout(indicated_revision)
             except (ValueError, GitCommandError):
                 raise exceptions.RevNotFound(project, indicated_revision)
             self.log.info("Prepared '%s' repo at revision '%s'", project,
                           indicated_revision)
         # If we have a non empty zuul_ref to use, use it. Otherwise we fall
         # back to checking out the branch.
-        elif ((override_zuul_ref and
-              self.fetchFromZuul(repo, project, override_zuul_ref)) or
-              (fallback_zuul_ref and
-               fallback_zuul_ref != override_zuul_ref and
-              self.fetchFromZuul(repo, project, fallback_zuul_ref))):
-            # Work around a bug in GitPython which can not parse FETCH_HEAD
-            gitcmd = git.Git(dest)
-            fetch_head = gitcmd.rev_parse('FETCH_HEAD')
-            repo.checkout(fetch_head)
+        elif zuul_commit:
+            with self.span('checkout', 'git', project=project):
+                repo.checkout(zuul_commit)
             self.log.info("Prepared %s repo with commit %s",
-                          project, fetch_head)
+                          project, zuul_commit)
         else:
             # Checkout branch
             self.log.info("Falling back to branch %s", fallback_branch)
             try:
-                commit = repo.checkout('remotes/origin/%s' % fallback_branch)
+                with self.span('checkout', 'git', project=project):
+                    commit = repo.checkout(
+                        'remotes/origin/%s' % fallback_branch)
             except (ValueError, GitCommandError):
                 self.log.exception("Fallback branch not found: %s",
                                    fallback_branch)
@@ -13,9 +13,18 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
 import git
 import os
 import logging
+import subprocess
+import threading
+
+
+@contextlib.contextmanager
+def null_span(name, category=None, **args):
+    """Default for the span argument: a context manager tracing nothing"""
+    yield dict(args)
 
 
 def reset_repo_to_head(repo):
@@ -33,6 +42,60 @@ def reset_repo_to_head(repo):
             raise
 
 
+def clone_options(depth=None, clone_filter=None):
+    """Options for git.Repo.clone_from() to make a shallow or partial clone
+
+    depth: only fetch that many commits of each branch
+    clone_filter: filter for a partial clone, eg: 'blob:none'
+    """
+    options = {}
+    if depth:
+        options['depth'] = depth
+        # Shallow clones only fetch HEAD by default
+        options['no_single_branch'] = True
+    if clone_filter:
+        options['filter'] = clone_filter
+        # Partial clones from a local repository require the server side to
+        # allow filters.
+        options['upload_pack'] = 'git -c uploadpack.allowFilter=true ' \
+                                 'upload-pack'
+    return options
+
+
+class ProcessCounter(object):
+    """Thread safe count of spawned processes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def add(self, count=1):
+        with self._lock:
+            self.count += count
+
+
+# Git processes spawned by Repo, including the persistent
+# `git cat-file --batch` helpers of GitPython
+git_processes = ProcessCounter()
+
+
+class CountingGit(git.Git):
+    def execute(self, *args, **kwargs):
+        git_processes.add()
+        return super(CountingGit, self).execute(*args, **kwargs)
+
+
+class GitRepo(git.Repo):
+    """A git.Repo counting the git processes it spawns"""
+    GitCommandWrapperType = CountingGit
+
+    @classmethod
+    def clone_from(cls, url, to_path, **kwargs):
+        # GitPython clones with a plain git.Git
+        git_processes.add()
+        return super(GitRepo, cls).clone_from(url, to_path, **kwargs)
+
+
 class ZuulReference(git.Reference):
     _common_path_default = "refs/zuul"
     _points_to_commits_only = True
@@ -41,12 +104,20 @@ class ZuulReference(git.Reference):
 class Repo(object):
     log = logging.getLogger("zuul.Repo")
 
-    def __init__(self, remote, local, email, username):
+    def __init__(self, remote, local, email, username, depth=None,
+                 clone_filter=None, span=None):
+        """span: called as span(name, category, **args) to get a context
+        manager recording git operations, does nothing by default"""
         self.remote_url = remote
+        self.span = span or null_span
         self.local_path = local
         self.email = email
         self.username = username
+        self.depth = depth
+        self.clone_filter = clone_filter
         self._initialized = False
+        self._refs = None
+        self._repo = None
         try:
             self._ensure_cloned()
         except Exception:
@@ -60,8 +131,13 @@ class Repo(object):
         if not repo_is_cloned:
             self.log.debug("Cloning from %s to %s" % (self.remote_url,
                                                       self.local_path))
-            git.Repo.clone_from(self.remote_url, self.local_path)
-        repo = git.Repo(self.local_path)
+            self.close()
+            self._repo = GitRepo.clone_from(
+                self.remote_url, self.local_path,
+                **clone_options(self.depth, self.clone_filter))
+        if self._repo is None:
+            self._repo = GitRepo(self.local_path)
+        repo = self._repo
         if self.email:
             repo.config_writer().set_value('user', 'email',
                                            self.email)
@@ -86,33 +162,87 @@ class Repo(object):
         return self._initialized
 
     def createRepoObject(self):
+        """The git.Repo of the repository, created once until close()"""
         try:
             self._ensure_cloned()
-            repo = git.Repo(self.local_path)
         except Exception:
             self.log.exception("Unable to initialize repo for %s" %
                                self.local_path)
-        return repo
+        return self._repo
+
+    def close(self):
+        """Stop the git processes GitPython keeps around for the repository
+
+        The repository can still be used afterward, a new git.Repo is then
+        created.
+        """
+        if self._repo is not None:
+            self._repo.close()
+            self._repo = None
 
-    def reset(self):
+    def reset(self, branches=None):
+        """Update from origin then reset to its HEAD
+
+        branches: when given, only fetch these branches (see updateBranches)
+        instead of every branches and tags.
+        """
         self.log.debug("Resetting repository %s" % self.local_path)
-        self.update()
+        if branches is None:
+            self.update()
+        else:
+            self.updateBranches(branches)
+        self.resetToRemoteHead()
+
+    def resetToRemoteHead(self):
+        """Point local branches to origin ones then reset to origin HEAD
+
+        Unlike reset(), does not fetch from origin.
+        """
         repo = self.createRepoObject()
-        origin = repo.remotes.origin
-        for ref in origin.refs:
-            if ref.remote_head == 'HEAD':
-                continue
-            repo.create_head(ref.remote_head, ref, force=True)
+        refs = self._refSnapshot()
+        prefix = 'refs/remotes/origin/'
+        remote_branches = [ref[len(prefix):] for ref in refs
+                           if ref.startswith(prefix)
+                           and ref != prefix + 'HEAD']
+
+        # Create or move the local branches in a single transaction instead
+        # of writing each ref with GitPython.
+        updates = ''.join('update refs/heads/%s %s\n' % (
+                          branch, refs[prefix + branch][0])
+                          for branch in remote_branches)
+        if updates:
+            git_processes.add()
+            subprocess.run(['git', 'update-ref', '--stdin'],
+                           input=updates.encode(), cwd=self.local_path,
+                           stdout=subprocess.DEVNULL, check=True)
+        self._refs = None
 
         # try reset to remote HEAD (usually origin/master)
         # If it fails, pick the first reference
-        try:
-            repo.head.reference = origin.refs['HEAD']
-        except IndexError:
-            repo.head.reference = origin.refs[0]
+        if prefix + 'HEAD' in refs:
+            repo.git.symbolic_ref('HEAD', prefix + 'HEAD')
+        else:
+            repo.git.symbolic_ref('HEAD', prefix + remote_branches[0])
         reset_repo_to_head(repo)
         repo.git.clean('-x', '-f', '-d')
 
+    def _refSnapshot(self):
+        """Refs of the repository, read with a single git for-each-ref
+
+        Returns a dict of ref names to a tuple holding the object they point
+        to and, for annotated tags, the commit the tag points to. It is kept
+        until a method of this class changes refs.
+        """
+        if self._refs is None:
+            repo = self.createRepoObject()
+            output = repo.git.for_each_ref(
+                '--format=%(refname) %(objectname) %(*objectname)')
+            self._refs = {}
+            for line in output.splitlines():
+                refname, objectname, peeled = line.split(' ')
+                self._refs[refname] = (objectname, peeled or objectname)
+        return self._refs
+
     def prune(self):
         repo = self.createRepoObject()
         origin = repo.remotes.origin
@@ -120,6 +250,7 @@ class Repo(object):
         if stale_refs:
             self.log.debug("Pruning stale refs: %s", stale_refs)
             git.refs.RemoteReference.delete(repo, *stale_refs)
+            self._refs = None
 
     def getBranchHead(self, branch):
         repo = self.createRepoObject()
@@ -127,16 +258,28 @@ class Repo(object):
         return branch_head.commit
 
     def hasBranch(self, branch):
-        repo = self.createRepoObject()
-        origin = repo.remotes.origin
-        return branch in origin.refs
+        return 'refs/remotes/origin/%s' % branch in self._refSnapshot()
 
-    def getCommitFromRef(self, refname):
-        repo = self.createRepoObject()
-        if refname not in repo.refs:
+    def resolveRef(self, ref):
+        """Commit a fully qualified ref points to, None if it does not exist
+        """
+        refs = self._refSnapshot()
+        if ref not in refs:
             return None
-        ref = repo.refs[refname]
-        return ref.commit
+        return refs[ref][1]
+
+    def getCommitFromRef(self, refname):
+        # Short name as GitPython Reference.name, eg: 'master' or
+        # 'origin/master'
+        for ref, (_, commit) in self._refSnapshot().items():
+            tokens = ref.split('/')
+            if len(tokens) < 3:
+                name = ref
+            else:
+                name = '/'.join(tokens[2:])
+            if name == refname:
+                return self.createRepoObject().commit(commit)
+        return None
 
     def checkout(self, ref):
         repo = self.createRepoObject()
@@ -150,6 +293,7 @@ class Repo(object):
         self.log.debug("Cherry-picking %s" % ref)
         self.fetch(ref)
         repo.git.cherry_pick("FETCH_HEAD")
+        self._refs = None
         return repo.head.commit
 
     def merge(self, ref, strategy=None):
@@ -161,6 +305,7 @@ class Repo(object):
         self.fetch(ref)
         self.log.debug("Merging %s with args %s" % (ref, args))
         repo.git.merge(*args)
+        self._refs = None
         return repo.head.commit
 
     def fetch(self, ref):
@@ -174,15 +319,41 @@ class Repo(object):
             origin.fetch(ref)
         except AssertionError:
             origin.fetch(ref)
+        self._refs = None
 
     def fetchFrom(self, repository, refspec):
         repo = self.createRepoObject()
         repo.git.fetch(repository, refspec)
+        self._refs = None
+
+    def fetchRefs(self, repository, refs):
+        """Fetch fully qualified refs in a single git fetch, without tags
+
+        Each ref is stored locally under the same name. Refs the repository
+        does not have are ignored instead of failing the fetch: they are
+        fetched with a glob refspec which, unlike a plain one, is allowed to
+        match nothing. As a side effect, refs sharing the ref name as prefix
+        are fetched as well.
+
+        Returns a dict of the refs that were found to their commit.
+        """
+        repo = self.createRepoObject()
+        refspecs = ['+%s*:%s*' % (ref, ref) for ref in refs]
+        with self.span('fetch refs', 'git', path=self.local_path):
+            repo.git.fetch('--no-tags', repository, *refspecs)
+        self._refs = None
+        found = {}
+        for ref in refs:
+            commit = self.resolveRef(ref)
+            if commit:
+                found[ref] = commit
+        return found
 
     def createZuulRef(self, ref, commit='HEAD'):
         repo = self.createRepoObject()
         self.log.debug("CreateZuulRef %s at %s on %s" % (ref, commit, repo))
         ref = ZuulReference.create(repo, ref, commit)
+        self._refs = None
         return ref.commit
 
     def push(self, local, remote):
@@ -195,11 +366,36 @@ class Repo(object):
         repo = self.createRepoObject()
         self.log.debug("Updating repository %s" % self.local_path)
         origin = repo.remotes.origin
-        if repo.git.version_info[:2] < (1, 9):
-            # Before 1.9, 'git fetch --tags' did not include the
-            # behavior covered by 'git --fetch', so we run both
-            # commands in that case.  Starting with 1.9, 'git fetch
-            # --tags' is all that is necessary.  See
-            # https://github.com/git/git/blob/master/Documentation/RelNotes/1.9.0.txt#L18-L20
-            origin.fetch()
-        origin.fetch(tags=True)
+        with self.span('fetch', 'git', path=self.local_path):
+            if repo.git.version_info[:2] < (1, 9):
+                # Before 1.9, 'git fetch --tags' did not include the
+                # behavior covered by 'git --fetch', so we run both
+                # commands in that case.  Starting with 1.9, 'git fetch
+                # --tags' is all that is necessary.  See
+                # https://github.com/git/git/blob/master/Documentation/RelNotes/1.9.0.txt#L18-L20
+                origin.fetch()
+            if self.depth:
+                # Keep the repository shallow
+                origin.fetch(tags=True, depth=self.depth)
+            else:
+                origin.fetch(tags=True)
+        self._refs = None
+
+    def updateBranches(self, branches):
+        """Fetch only the given branches from origin, without tags
+
+        Done in a single git fetch which also prunes the remote-tracking
+        branches deleted upstream. Branches missing upstream are ignored
+        (see fetchRefs).
+        """
+        repo = self.createRepoObject()
+        self.log.debug("Updating branches %s of repository %s" % (
+            ', '.join(branches), self.local_path))
+        refspecs = ['+refs/heads/%s*:refs/remotes/origin/%s*' % (b, b)
+                    for b in branches]
+        args = ['--no-tags', '--prune']
+        if self.depth:
+            args.append('--depth=%d' % self.depth)
+        with self.span('fetch', 'git', path=self.local_path):
+            repo.git.fetch(*args, 'origin', *refspecs)
+        self._refs = None